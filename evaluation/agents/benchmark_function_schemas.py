@@ -0,0 +1,58 @@
+"""
+Measures the per-call overhead of the function schemas given to the agents: the OpenAI function schema, the parameter
+list and the pydantic model of a nested function redefined on every call (as the parsing functions are), compiled
+on every call versus taken from the schema registry.
+
+python evaluation/agents/benchmark_function_schemas.py -n 1000
+"""
+import argparse
+import time
+
+from src.agents.function_schema import FunctionSchema, get_function_schema
+
+
+def get_add_event():
+    def add_event(header: str, text: str, brief: str, address: str, dates: str):
+        """Adds event (cultural, social, sports, etc.) with its details, the dates of the event
+        in the format [{'start': 'YYYY-MM-DDTHH:MM:SS', 'end': 'YYYY-MM-DDTHH:MM:SS'}]"""
+        return locals()
+
+    return add_event
+
+
+def compile_schemas(function) -> FunctionSchema:
+    schema = FunctionSchema(function)
+    schema.pydantic_model
+    return schema
+
+
+def get_registry_schemas(function) -> FunctionSchema:
+    schema = get_function_schema(function)
+    schema.pydantic_model
+    return schema
+
+
+def benchmark(get_schemas, number: int) -> float:
+    """Returns the mean time of getting the schemas of a freshly defined function in microseconds."""
+    start = time.perf_counter()
+    for _ in range(number):
+        get_schemas(get_add_event())
+    return (time.perf_counter() - start) / number * 1e6
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the compiled function schemas against compiling per call")
+    parser.add_argument("-n", "--number", type=int, default=1000, help="Number of calls")
+    return parser.parse_args()
+
+
+def main():
+    args = process_arguments()
+    compiled = benchmark(compile_schemas, args.number)
+    registry = benchmark(get_registry_schemas, args.number)
+    print(f"compiled per call: {compiled:.1f} us/call")
+    print(f"schema registry:   {registry:.1f} us/call ({compiled / registry:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
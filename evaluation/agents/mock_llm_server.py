@@ -0,0 +1,308 @@
+"""
+Local mock of the OpenAI chat completions API used by the agents, for load and regression testing without the models.
+It answers the tool calls (tools, tool_choice), the legacy function calls (functions, function_call), the JSON mode
+(response_format with or without a schema, guided_json) and the streamed responses.
+
+The responses are deterministic: the scripted responses of the first rule matching the last user message, the
+responses recorded in the LLM response cache, or responses generated from the request, the arguments and JSON objects
+filled from their schemas. The latency of the responses follows a log-normal distribution, the errors and malformed
+JSON are injected at the given rates. GET /stats returns the numbers of the requests, the errors and the peak of the
+requests in flight.
+
+The default port is the one of LOCAL_URL, so the local agents use the mock without changes:
+python evaluation/agents/mock_llm_server.py --latency-median 0.5 --latency-sigma 0.4 --error-rate 0.05
+
+The rules of the script are a JSON list, the first rule whose match (a regular expression) is found in the last user
+message is used:
+[{"match": "concert", "function": "get_event_info", "arguments": {"query": "concerts"}},
+ {"match": "weather", "content": "It is sunny in Brno."},
+ {"match": "", "json": {"type": "event"}}]
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+
+from aiohttp import web
+
+from src.agents.response_cache import ResponseCache
+
+ERROR_MESSAGES = {429: "Rate limit reached", 500: "Internal server error", 503: "Service unavailable"}
+
+
+class MockLLMServer:
+    """Handlers of the mock chat completions API with the scripted responses, the latency and the injected errors."""
+
+    def __init__(self, rules: list[dict] = None, cache: ResponseCache = None, latency_median: float = 0.0,
+                 latency_sigma: float = 0.0, token_delay: float = 0.0, error_rate: float = 0.0,
+                 error_statuses: list[int] = None, malformed_rate: float = 0.0, seed: int = 0):
+        """
+        :param rules: Scripted responses, the first rule matching the last user message is used
+        :param cache: LLM response cache the recorded responses are replayed from
+        :param latency_median: Median latency of the responses (time to the first token of the streams) in seconds
+        :param latency_sigma: Sigma of the log-normal distribution of the latency, zero for a fixed latency
+        :param token_delay: Delay between the parts of the streamed responses in seconds
+        :param error_rate: Share of the requests answered by an error
+        :param error_statuses: HTTP statuses of the injected errors
+        :param malformed_rate: Share of the function arguments and JSON responses that are not valid JSON
+        :param seed: Seed of the latencies and the injected errors
+        """
+        self.rules = rules or []
+        self.cache = cache
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses or [429, 500, 503]
+        self.malformed_rate = malformed_rate
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'errors': 0, 'malformed': 0, 'recorded': 0, 'scripted': 0, 'in_flight': 0,
+                      'peak_in_flight': 0}
+        self.completions = 0
+
+    def get_app(self) -> web.Application:
+        app = web.Application(client_max_size=2 ** 26)
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_get('/v1/models', self.models)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats['requests'] += 1
+        self.stats['in_flight'] += 1
+        self.stats['peak_in_flight'] = max(self.stats['peak_in_flight'], self.stats['in_flight'])
+        try:
+            await asyncio.sleep(self._get_latency())
+            if self.random.random() < self.error_rate:
+                return self._get_error_response(self.random.choice(self.error_statuses))
+            if body.get('stream'):
+                return await self._stream(request, body, self.get_message(body))
+            return web.json_response(self.get_completion(body))
+        finally:
+            self.stats['in_flight'] -= 1
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({'object': 'list', 'data': [{'id': 'mock', 'object': 'model', 'owned_by': 'mock'}]})
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def get_completion(self, body: dict) -> dict:
+        """Returns the chat completion of the request, the recorded one if it is in the response cache."""
+        recorded = self._get_recorded(body)
+        if recorded is not None:
+            self.stats['recorded'] += 1
+            return recorded
+        message = self.get_message(body)
+        finish_reason = 'tool_calls' if message.get('tool_calls') else 'stop'
+        return {'id': self._get_id(), 'object': 'chat.completion', 'created': int(time.time()),
+                'model': body.get('model', 'mock'),
+                'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+                'usage': self._get_usage(body['messages'], message)}
+
+    def get_message(self, body: dict) -> dict:
+        """Returns the message of the assistant answering the request."""
+        rule = self._get_rule(body['messages'])
+        self.stats['scripted'] += rule is not None
+        if body.get('tools'):
+            calls = self._get_calls(rule, [t['function'] for t in body['tools']], body.get('tool_choice'))
+            return {'role': 'assistant', 'content': None,
+                    'tool_calls': [{'id': f"call_{self._get_id()}_{i}", 'type': 'function', 'function': call}
+                                   for i, call in enumerate(calls)]}
+        if body.get('functions'):
+            call = self._get_calls(rule, body['functions'], body.get('function_call'))[0]
+            return {'role': 'assistant', 'content': None, 'function_call': call}
+        schema = self._get_json_schema(body)
+        if schema is not None:
+            content = rule['json'] if rule and 'json' in rule else get_example(schema) if schema else {}
+            return {'role': 'assistant', 'content': self._dump_arguments(content)}
+        if rule and 'content' in rule:
+            return {'role': 'assistant', 'content': rule['content']}
+        return {'role': 'assistant', 'content': f"Mock response of {body.get('model', 'mock')} to: "
+                                               f"{self._get_last_user_content(body['messages'])[:200]}"}
+
+    async def _stream(self, request: web.Request, body: dict, message: dict) -> web.StreamResponse:
+        """Streams the message as server-sent events, the content in parts of single words."""
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        completion_id = self._get_id()
+        chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                 'model': body.get('model', 'mock')}
+        if message.get('tool_calls'):
+            deltas = [{'role': 'assistant', 'tool_calls': [dict(call, index=i)
+                                                           for i, call in enumerate(message['tool_calls'])]}]
+        else:
+            deltas = [{'role': 'assistant', 'content': part}
+                      for part in re.findall(r'\s*\S+', message['content'] or '')] or [{'role': 'assistant'}]
+        for number, delta in enumerate(deltas):
+            if number and self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            await self._send_event(response, dict(chunk, choices=[{'index': 0, 'delta': delta,
+                                                                   'finish_reason': None}]))
+        finish_reason = 'tool_calls' if message.get('tool_calls') else 'stop'
+        await self._send_event(response, dict(chunk, choices=[{'index': 0, 'delta': {},
+                                                               'finish_reason': finish_reason}]))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    async def _send_event(response: web.StreamResponse, data: dict):
+        await response.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+    def _get_calls(self, rule: dict, functions: list[dict], choice) -> list[dict]:
+        """Returns the function calls of the rule, the call of the forced function or the first function otherwise,
+        with the arguments filled from the schema of the function."""
+        forced = self._get_forced_name(choice)
+        calls = [{'function': forced or functions[0]['name']}]
+        if rule and ('calls' in rule or 'function' in rule):
+            scripted = rule.get('calls') or [{'function': rule['function'], 'arguments': rule.get('arguments')}]
+            calls = [c for c in scripted if forced in [None, c['function']]] or calls
+        schemas = {f['name']: f.get('parameters', {}) for f in functions}
+        return [{'name': c['function'],
+                 'arguments': self._dump_arguments(c['arguments'] if c.get('arguments') is not None
+                                                   else get_example(schemas.get(c['function'], {})))}
+                for c in calls]
+
+    @staticmethod
+    def _get_forced_name(choice):
+        if isinstance(choice, dict):
+            return choice.get('function', choice).get('name')
+        return None
+
+    def _dump_arguments(self, arguments) -> str:
+        """Returns the arguments as JSON, malformed by the malformed rate."""
+        dumped = json.dumps(arguments, ensure_ascii=False)
+        if self.random.random() < self.malformed_rate:
+            self.stats['malformed'] += 1
+            return dumped[:-1]
+        return dumped
+
+    @staticmethod
+    def _get_json_schema(body: dict):
+        """Returns the schema of the JSON response, an empty schema in the JSON mode without one, None if the
+        response is not JSON."""
+        response_format = body.get('response_format') or {}
+        if 'guided_json' in body:
+            return body['guided_json']
+        if response_format.get('type') == 'json_schema':
+            return response_format.get('json_schema', {}).get('schema', {})
+        if response_format.get('type') == 'json_object':
+            return response_format.get('schema', {})
+        return None
+
+    def _get_rule(self, messages: list[dict]):
+        content = self._get_last_user_content(messages)
+        for rule in self.rules:
+            if re.search(rule.get('match', ''), content):
+                return rule
+        return None
+
+    def _get_recorded(self, body: dict):
+        if self.cache is None:
+            return None
+        key = ResponseCache.get_key(body.get('model'), body['messages'],
+                                    **{k: v for k, v in body.items() if k not in ['model', 'messages']})
+        recorded = self.cache.get(key)
+        if recorded is None:
+            return None
+        return recorded.model_dump() if hasattr(recorded, 'model_dump') else None
+
+    def _get_latency(self) -> float:
+        if self.latency_median <= 0:
+            return 0.0
+        return self.latency_median * math.exp(self.random.gauss(0, self.latency_sigma))
+
+    def _get_error_response(self, status: int) -> web.Response:
+        self.stats['errors'] += 1
+        headers = {'Retry-After': '1'} if status == 429 else None
+        return web.json_response({'error': {'message': ERROR_MESSAGES.get(status, "Injected error"),
+                                            'type': 'mock_error', 'code': status}}, status=status, headers=headers)
+
+    def _get_id(self) -> str:
+        self.completions += 1
+        return f"chatcmpl-mock-{self.completions}"
+
+    @staticmethod
+    def _get_last_user_content(messages: list[dict]) -> str:
+        for m in reversed(messages):
+            if m.get('role') == 'user':
+                return str(m.get('content') or '')
+        return ''
+
+    @staticmethod
+    def _get_usage(messages: list[dict], message: dict) -> dict:
+        """Returns the usage with the words counted as the tokens."""
+        prompt = sum(len(str(m.get('content') or '').split()) for m in messages)
+        completion = len(json.dumps(message).split())
+        return {'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion}
+
+
+def get_example(schema: dict, defs: dict = None):
+    """
+    Get an example value of the JSON schema, deterministic for the schema
+    :param schema: JSON schema
+    :param defs: Definitions the references of the schema point to
+    :return: value valid against the schema
+    """
+    defs = schema.get('$defs', defs or {})
+    if '$ref' in schema:
+        return get_example(defs.get(schema['$ref'].split('/')[-1], {}), defs)
+    if 'const' in schema:
+        return schema['const']
+    if schema.get('enum'):
+        return schema['enum'][0]
+    for key in ['oneOf', 'anyOf', 'allOf']:
+        if schema.get(key):
+            return get_example(schema[key][0], defs)
+    if 'default' in schema:
+        return schema['default']
+    kind = schema.get('type', 'object' if 'properties' in schema else 'string')
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != 'null'), 'null')
+    if kind == 'object':
+        properties = schema.get('properties', {})
+        names = list(properties) + [r for r in schema.get('required', []) if r not in properties]
+        return {name: get_example(properties.get(name, {}), defs) for name in names}
+    if kind == 'array':
+        return [get_example(schema.get('items', {}), defs)]
+    return {'string': f"{schema.get('title', 'value')}", 'integer': 0, 'number': 0.0, 'boolean': False,
+            'null': None}.get(kind, '')
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI chat completions API")
+    parser.add_argument("--host", default="localhost", help="Host of the server")
+    parser.add_argument("--port", type=int, default=8816, help="Port of the server, the one of LOCAL_URL by default")
+    parser.add_argument("--script", help="JSON file with the list of the scripted responses")
+    parser.add_argument("--cache", help="Folder of the LLM response cache the recorded responses are replayed from")
+    parser.add_argument("--latency-median", type=float, default=0.0, help="Median latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="Sigma of the log-normal latency")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Delay between the streamed parts in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the requests answered by an error")
+    parser.add_argument("--error-statuses", type=int, nargs='+', default=[429, 500, 503],
+                        help="HTTP statuses of the injected errors")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Share of the function arguments and JSON responses that are not valid JSON")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latencies and the injected errors")
+    return parser.parse_args()
+
+
+def main():
+    args = process_arguments()
+    rules = None
+    if args.script:
+        with open(args.script) as file:
+            rules = json.load(file)
+    server = MockLLMServer(rules, ResponseCache(args.cache) if args.cache else None, args.latency_median,
+                           args.latency_sigma, args.token_delay, args.error_rate, args.error_statuses,
+                           args.malformed_rate, args.seed)
+    web.run_app(server.get_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares the per-chunk and the batched extraction of the parsed contents. The chunks of evaluation/content_processing/
+eval_chunks.csv are grouped by their url into pages, every page is parsed in both modes and the number of requests, the
+tokens reported by the API and the wall time per page are written to a csv file.
+
+python evaluation/content_processing/benchmark_batched_extraction.py -a gpt -o evaluation/content_processing/batched_extraction.csv
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from src.agents_constants import GPT_3_AGENT, LLAMA3_70_AGENT, LLAMA3_8_AGENT, MIXTRAL_AGENT
+from src.data_acquisition.constants import BATCH_TOKEN_BUDGET
+from src.data_acquisition.content_processing.content_parsing import get_parsed_content_preclassified_function_call, \
+    get_parsed_contents_batched
+
+AGENTS = {'gpt': GPT_3_AGENT, 'llama3-70': LLAMA3_70_AGENT, 'llama3-8': LLAMA3_8_AGENT, 'mixtral': MIXTRAL_AGENT}
+
+
+class UsageCounter:
+    """Counts the requests sent through the client of the agent and the tokens reported in their responses."""
+
+    def __init__(self, agent):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._create = agent.client.chat.completions.create
+        agent.client.chat.completions.create = self._counted_create
+
+    def _counted_create(self, *args, **kwargs):
+        response = self._create(*args, **kwargs)
+        self.calls += 1
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.completion_tokens += usage.completion_tokens or 0
+        return response
+
+    def get_counts(self) -> tuple[int, int, int]:
+        return self.calls, self.prompt_tokens, self.completion_tokens
+
+
+def benchmark_page(agent, counter: UsageCounter, url: str, chunks: list[str], token_budget: int) -> list[dict]:
+    results = []
+    for mode in ['single', 'batched']:
+        before = counter.get_counts()
+        start = time.perf_counter()
+        if mode == 'single':
+            contents = [get_parsed_content_preclassified_function_call(agent, url, chunk) for chunk in chunks]
+        else:
+            contents = get_parsed_contents_batched(agent, [(url, chunk) for chunk in chunks],
+                                                   token_budget=token_budget)
+        wall_time = time.perf_counter() - start
+        calls, prompt_tokens, completion_tokens = [a - b for a, b in zip(counter.get_counts(), before)]
+        results.append({
+            'url': url,
+            'mode': mode,
+            'chunks': len(chunks),
+            'parsed': sum(content is not None for content in contents),
+            'calls': calls,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'wall_s': round(wall_time, 2),
+        })
+    return results
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the batched extraction against the per-chunk extraction")
+    parser.add_argument("-a", "--agent", choices=list(AGENTS), default='gpt', help="Agent used for the parsing")
+    parser.add_argument("-i", "--input", default="evaluation/content_processing/eval_chunks.csv",
+                        help="Csv file with url and chunk columns")
+    parser.add_argument("-o", "--output", default="batched_extraction.csv", help="Output csv file")
+    parser.add_argument("-b", "--batch-token-budget", type=int, default=BATCH_TOKEN_BUDGET)
+    parser.add_argument("-n", "--pages", type=int, help="Number of pages to benchmark, all by default")
+    return parser.parse_args()
+
+
+def main():
+    args = process_arguments()
+    agent = AGENTS[args.agent]
+    counter = UsageCounter(agent)
+    pages = pd.read_csv(args.input).groupby('url', sort=False)['chunk'].apply(list)
+    if args.pages:
+        pages = pages.head(args.pages)
+    results = pd.DataFrame([row for url, chunks in pages.items()
+                            for row in benchmark_page(agent, counter, url, chunks, args.batch_token_budget)])
+    results.to_csv(args.output, index=False)
+    summary = results.groupby('mode')[['chunks', 'parsed', 'calls', 'prompt_tokens', 'completion_tokens',
+                                       'wall_s']].sum()
+    summary['calls_per_page'] = summary['calls'] / len(pages)
+    summary['wall_s_per_page'] = summary['wall_s'] / len(pages)
+    print(summary.to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Compares the local pypdf backend against saved LlamaParse outputs. For every pdf in the given folder, the LlamaParse
+markdown is expected next to it as <pdf name>.md (it is created with the LlamaParse backend when --parse-missing is
+set). The throughput and the chunks produced by PdfProcessor from both markdowns are written to a csv file.
+
+python evaluation/pdf_processing/benchmark_pdf_backends.py -f pdfs -o evaluation/pdf_processing/pdf_backends.csv
+"""
+import argparse
+import os
+import re
+import time
+
+import pandas as pd
+from pypdf import PdfReader
+
+from src.constants import MAX_SIZE
+from src.data_acquisition.data_retrieval.pdf_backends import LocalPdfBackend, LlamaParseBackend
+from src.data_acquisition.data_retrieval.pdf_processor import PdfProcessor
+
+
+def get_words(text: str) -> set[str]:
+    return set(re.findall(r'\w+', text.lower()))
+
+
+def get_headers(chunks: list[str]) -> set[str]:
+    return {' '.join(get_words(chunk.split('\n')[0].strip('# '))) for chunk in chunks}
+
+
+def get_chunks(processor: PdfProcessor, md: str) -> list[str]:
+    return processor._split_md_into_chunks(processor.get_cleaned_md(md), MAX_SIZE)
+
+
+def benchmark_pdf(path: str, processor: PdfProcessor, parse_missing: bool) -> dict:
+    md_path = os.path.splitext(path)[0] + '.md'
+    if not os.path.exists(md_path):
+        if not parse_missing:
+            raise FileNotFoundError(f"Saved LlamaParse output not found: {md_path}")
+        with open(md_path, 'w') as file:
+            file.write(LlamaParseBackend().get_md(path))
+    with open(md_path) as file:
+        reference_md = file.read()
+
+    start = time.perf_counter()
+    local_md = processor.backend.get_md(path)
+    extraction_time = time.perf_counter() - start
+    start = time.perf_counter()
+    local_chunks = get_chunks(processor, local_md)
+    chunking_time = time.perf_counter() - start
+    reference_chunks = get_chunks(processor, reference_md)
+
+    pages = len(PdfReader(path).pages)
+    reference_words = get_words(' '.join(reference_chunks))
+    local_words = get_words(' '.join(local_chunks))
+    reference_headers = get_headers(reference_chunks)
+    local_headers = get_headers(local_chunks)
+    return {
+        'pdf': os.path.basename(path),
+        'pages': pages,
+        'extraction_s': round(extraction_time, 3),
+        'chunking_s': round(chunking_time, 3),
+        'pages_per_s': round(pages / extraction_time, 2) if extraction_time else None,
+        'llamaparse_chunks': len(reference_chunks),
+        'local_chunks': len(local_chunks),
+        'llamaparse_avg_chunk_len': round(sum(map(len, reference_chunks)) / len(reference_chunks)) if reference_chunks else 0,
+        'local_avg_chunk_len': round(sum(map(len, local_chunks)) / len(local_chunks)) if local_chunks else 0,
+        'word_recall': round(len(reference_words & local_words) / len(reference_words), 3) if reference_words else None,
+        'word_precision': round(len(reference_words & local_words) / len(local_words), 3) if local_words else None,
+        'header_jaccard': round(len(reference_headers & local_headers) / len(reference_headers | local_headers), 3)
+        if reference_headers | local_headers else None,
+    }
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the local pdf backend against saved LlamaParse outputs")
+    parser.add_argument("-f", "--folder", required=True, help="Folder with the pdfs and saved LlamaParse markdowns")
+    parser.add_argument("-o", "--output", default="pdf_backends.csv", help="Output csv file")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--parse-missing", action="store_true",
+                        help="Parse the pdfs without saved output with LlamaParse and save it")
+    return parser.parse_args()
+
+
+def main():
+    args = process_arguments()
+    processor = PdfProcessor([], LocalPdfBackend(args.workers))
+    paths = sorted(os.path.join(args.folder, f) for f in os.listdir(args.folder) if f.lower().endswith('.pdf'))
+    results = pd.DataFrame([benchmark_pdf(path, processor, args.parse_missing) for path in paths])
+    results.to_csv(args.output, index=False)
+    print(results.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
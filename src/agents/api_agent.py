@@ -1,61 +1,168 @@
-import inspect
+import contextvars
 import json
+import threading
 import time
 from abc import ABC
 from dataclasses import asdict
-from langchain_core.utils.function_calling import convert_to_openai_tool
 from openai import OpenAI
-from typing import Callable
+from typing import Callable, Iterator, Optional
 from pydantic import BaseModel
 from json_repair import repair_json
 import logging
 
-from src.agents.constants import FUNC_NAME, JSON_ERR, NO_CALL_ERR, RECURSION_ERR, API_ERR, CONN_ERR
-from src.agents.message import Message, AssistantMessage, UserMessage
-from src.constants import MAX_SIZE
+from src.agents.call_ledger import CallLedger, recorded, add_request, add_retry, set_failed, get_call_site, \
+    get_call_ledger
+from src.agents.constants import FUNC_NAME, JSON_ERR, NO_CALL_ERR, FUNC_ERR, CANT_CALL_ERR, USE_LLM_CACHE, \
+    USE_LLM_LEDGER, LOG_LLM_PROMPTS
+from src.agents.conversation_window import ConversationWindow
+from src.agents.function_schema import get_function_schema
+from src.agents.message import Message, SystemMessage, message_from_dict
+from src.agents.response_cache import ResponseCache, get_response_cache
+from src.agents.retry_policy import RetryPolicy, RetryError, OutputError
+from src.agents.token_counter import TokenCounter
+from src.constants import CHUNK_TOKENS, CONTEXT_TOKENS
 from src.data_acquisition.constants import ADDRESS, DEFAULT_ADDRESS
 
 logger = logging.getLogger(__name__)
 
+# responses of the running attempt of a request, cached once the attempt succeeds
+_attempt_responses = contextvars.ContextVar('attempt_responses', default=None)
 
-class ApiAgent(ABC):
-    """Base class for function calling API agents that interact through the OpenAI API."""
 
-    def __init__(self, url, api_key, model_name):
+class ApiAgent(ABC):
+    """Base class for function calling API agents that interact through the OpenAI API. The agent keeps no state of
+    the conversations, the messages of every call are kept within the call, so one agent can serve concurrent
+    sessions."""
+    # whether the model can call more functions in one response
+    parallel_tool_calls = True
+
+    def __init__(self, url, api_key, model_name, use_cache: bool = USE_LLM_CACHE, cache: ResponseCache = None,
+                 chunk_tokens: int = CHUNK_TOKENS, tokenizer: Callable[[str], list] = None,
+                 retry_policy: RetryPolicy = None, context_tokens: int = CONTEXT_TOKENS,
+                 call_ledger: CallLedger = None):
         """
         Initialize the API agent
         :param url: API url
         :param api_key: API key for the service
         :param model_name: Name of the model to be used
+        :param use_cache: Whether the function call and JSON responses are taken from the response cache
+        :param cache: Response cache, the shared one by default
+        :param chunk_tokens: Target size in tokens of the chunks parsed by the model
+        :param tokenizer: Tokenizer of the backend, the tiktoken encoding of the model by default
+        :param retry_policy: Retry policy of the requests, the default RetryPolicy by default
+        :param context_tokens: Token budget of the messages sent to the model
+        :param call_ledger: Ledger the calls are recorded in, the shared one by default if the ledger is enabled
         """
-        self.client = OpenAI(api_key=api_key, base_url=url)
+        self.client = self._get_client(url, api_key)
         self.model_name = model_name
-        self.messages_storage = []
+        self.use_cache = use_cache
+        self._cache = cache
+        self.chunk_tokens = chunk_tokens
+        self._tokenizer = tokenizer
+        self._token_counter = None
+        self._lock = threading.Lock()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.context_tokens = context_tokens
+        self._call_ledger = call_ledger
 
+    @staticmethod
+    def _get_client(url, api_key):
+        # the retries are left to the retry policy of the agent
+        return OpenAI(api_key=api_key, base_url=url, max_retries=0)
+
+    @property
+    def response_cache(self) -> ResponseCache:
+        if self._cache is None:
+            self._cache = get_response_cache()
+        return self._cache
+
+    @property
+    def call_ledger(self) -> Optional[CallLedger]:
+        if self._call_ledger is None and USE_LLM_LEDGER:
+            self._call_ledger = get_call_ledger()
+        return self._call_ledger
+
+    def _log_exchange(self, label: str, content):
+        """Logs the messages sent to the model or its response, only if the logging of the prompts is enabled, as
+        formatting them takes time on every call."""
+        if LOG_LLM_PROMPTS:
+            logger.debug("%s of %s: %s", label, self.model_name, content)
+
+    @property
+    def token_counter(self) -> TokenCounter:
+        if self._token_counter is None:
+            with self._lock:
+                if self._token_counter is None:
+                    self._token_counter = TokenCounter(self.model_name, self._tokenizer)
+        return self._token_counter
+
+    @recorded('base')
     def get_base_response(self, messages: list[dict]):
         """Get the response from the model without function calling"""
-        logger.info(f"Messages: {str(messages)}")
+        messages = self._fit_messages(messages)
+        self._log_exchange("Messages", messages)
         response = self.client.chat.completions.create(
             model=self.model_name,
             messages=messages,
             stream=False
         )
-        logger.info(f"Response: {str(response)}")
+        add_request(response.usage)
+        self._log_exchange("Response", response)
         return response
 
+    def get_streamed_response(self, messages: list[dict]) -> Iterator[str]:
+        """Get the response from the model without function calling, streamed as the parts of its text. The request
+        is sent once the iteration starts, the time to the first token is logged and recorded."""
+        messages = self._fit_messages(messages)
+        self._log_exchange("Messages", messages)
+        start = time.perf_counter()
+        stream = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            stream=True
+        )
+        parts = []
+        ttft = None
+        # closing the generator closes the response, so a stream that is not read to the end does not keep generating
+        with stream:
+            for chunk in stream:
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if not content:
+                    continue
+                if not parts:
+                    ttft = time.perf_counter() - start
+                    logger.info(f"Time to first token of {self.model_name}: {ttft:.2f} s")
+                parts.append(content)
+                yield content
+        self._record_stream(messages, parts, start, ttft)
+
+    def _record_stream(self, messages: list[dict], parts: list[str], start: float, ttft: float = None):
+        """Records the streamed response in the call ledger, the tokens are counted by the token counter of the
+        agent, as the streams do not return their usage."""
+        if self.call_ledger is None:
+            return
+        self.call_ledger.record({
+            'ts': round(time.time(), 3), 'model': self.model_name, 'kind': 'stream', 'site': get_call_site((), {}),
+            'requests': 1, 'retries': 0, 'prompt_tokens': sum(self.token_counter(m.get('content') or '') for m in messages),
+            'completion_tokens': self.token_counter(''.join(parts)), 'cached': 0,
+            'outcome': 'ok' if parts else 'failed', 'latency_s': round(time.perf_counter() - start, 3),
+            'ttft_s': None if ttft is None else round(ttft, 3)})
+
     def get_base_call_response(self, messages: list[dict], functions_schemas: list[dict]):
-        """Get the response from the model with function calling
+        """Get the response from the model with tool calling, the model may call more functions at once
         :param messages: List of messages to be sent to the model
         :param functions_schemas: List of function schemas in OpenAI tool format
         """
-        logger.info(f"Messages: {str(messages)}")
-        response = self.client.chat.completions.create(
+        tools = self._get_tools(functions_schemas)
+        messages = self._fit_messages(messages, self._count_schema_tokens(tools))
+        self._log_exchange("Messages", messages)
+        response = self._get_cached_completion(
             model=self.model_name,
             messages=messages,
-            functions=functions_schemas,
+            tools=tools,
             stream=False
         )
-        logger.info(f"Response: {str(response)}")
+        self._log_exchange("Response", response)
         return response
 
     def get_forced_call_response(self, messages: list[dict], function: Callable, function_call: dict):
@@ -64,18 +171,66 @@ class ApiAgent(ABC):
         :param function: Function to be called
         :param function_call: Function call enforcing the function name
         """
-        logger.info(f"Messages: {str(messages)}")
-        schema = [self._function_to_openai_function_schema(function)]
-        response = self.client.chat.completions.create(
+        tools = self._get_tools([self._function_to_openai_function_schema(function)])
+        messages = self._fit_messages(messages, self._count_schema_tokens(tools))
+        self._log_exchange("Messages", messages)
+        response = self._get_cached_completion(
             model=self.model_name,
             messages=messages,
-            functions=schema,
+            tools=tools,
             stream=False,
-            function_call=function_call,
+            tool_choice={"type": "function", "function": function_call},
         )
-        logger.info(f"Response: {str(response)}")
+        self._log_exchange("Response", response)
         return response
 
+    def _get_cached_completion(self, **request):
+        """
+        Get the chat completion of the request, from the response cache if it is enabled
+        :param request: Parameters of the chat completion request
+        :return: chat completion
+        """
+        if not self.use_cache:
+            response = self.client.chat.completions.create(**request)
+            add_request(response.usage)
+            return response
+        key = ResponseCache.get_key(self.model_name, request["messages"],
+                                    **{k: v for k, v in request.items() if k not in ["model", "messages"]})
+        response = self.response_cache.get(key)
+        if response is not None:
+            logger.info("Response taken from the cache")
+            add_request(cached=True)
+            return response
+        response = self.client.chat.completions.create(**request)
+        add_request(response.usage)
+        self._set_cached(key, response)
+        return response
+
+    def _set_cached(self, key: str, response):
+        """Caches the response, within an attempt of a request only once the attempt succeeds, so the responses
+        failing the parsing or validation are not replayed from the cache."""
+        pending = _attempt_responses.get()
+        if pending is None:
+            self.response_cache.set(key, response)
+        else:
+            pending.append((key, response))
+
+    def _run_cached_attempt(self, attempt: Callable[[list[dict]], object], request: list[dict]):
+        """Makes one attempt with the messages, the responses of the attempt are cached only if it succeeds."""
+        pending = []
+        token = _attempt_responses.set(pending)
+        try:
+            result = attempt(request)
+        finally:
+            _attempt_responses.reset(token)
+        self._cache_attempt_responses(pending)
+        return result
+
+    def _cache_attempt_responses(self, pending: list[tuple[str, object]]):
+        for key, response in pending:
+            self.response_cache.set(key, response)
+
+    @recorded('function')
     def get_function_call(self, module: dict, functions: list, max_retries: int = 3,
                           messages: list[Message] = None):
         """
@@ -83,19 +238,15 @@ class ApiAgent(ABC):
         :param module: Module containing the functions
         :param functions: List of functions to chosen from
         :param messages: List of messages to be sent to the model
-        :param max_retries:
+        :param max_retries: Maximal number of attempts failing on the response of the model
         :return: result of called function
         """
-        if messages:
-            self._add_messages_initially(messages)
-        con_messages = [asdict(m) for m in self.messages_storage]
         functions_schemas = [self._function_to_openai_function_schema(f) for f in functions]
-        response = self.get_base_call_response(con_messages, functions_schemas)
-        self._add_message(AssistantMessage(str(response.choices[0].message)))
-        return self._handle_response_function_call_errors(module, response, max_retries,
-                                                          lambda: self.get_function_call(module, functions,
-                                                                                         max_retries - 1))
+        return self._get_function_call_result(module, lambda request: self.get_base_call_response(request,
+                                                                                                  functions_schemas),
+                                              self._get_request(messages), max_retries)
 
+    @recorded('function')
     def get_custom_descr_function_call(self, module: dict, functions: list[tuple[Callable, str]],
                                        max_retries: int = 3,
                                        messages: list[Message] = None):
@@ -104,150 +255,200 @@ class ApiAgent(ABC):
         :param module: Module containing the functions
         :param functions: List of functions to chosen from with custom descriptions
         :param messages: List of messages to be sent to the model
-        :param max_retries:
+        :param max_retries: Maximal number of attempts failing on the response of the model
         :return: result of called function
         """
-        if messages:
-            self._add_messages_initially(messages)
-        con_messages = [asdict(m) for m in self.messages_storage]
         functions_schemas = self._get_function_schemas_with_custom_description(functions)
-        response = self.get_base_call_response(con_messages, functions_schemas)
-        self._add_message(AssistantMessage(str(response.choices[0].message)))
-        return self._handle_response_function_call_errors(module, response, max_retries,
-                                                          lambda: self.get_custom_descr_function_call(module,
-                                                                                                      functions,
-                                                                                                      max_retries - 1))
+        return self._get_function_call_result(module, lambda request: self.get_base_call_response(request,
+                                                                                                  functions_schemas),
+                                              self._get_request(messages), max_retries)
 
+    @recorded('forced')
     def get_forced_function_call(self, module: dict, function: Callable, max_retries: int = 3,
                                  messages: list[Message] = None):
         """ Get the response with forced function call
         :param module: Module containing the function
         :param function: Function to be called
-        :param max_retries: Number of retries
+        :param max_retries: Maximal number of attempts failing on the response of the model
         :param messages: List of messages to be sent to the model
         :return:
         """
-        if messages:
-            self._add_messages_initially(messages)
-        con_messages = [asdict(m) for m in self.messages_storage]
-        response = self.get_forced_call_response(con_messages, function, function.__name__)
-        self._add_message(AssistantMessage(str(response.choices[0].message)))
-        return self._handle_response_function_call_errors(module, response, max_retries,
-                                                          lambda: self.get_forced_function_call(module, function,
-                                                                                                max_retries - 1))
+        return self._get_function_call_result(module, lambda request: self.get_forced_call_response(
+            request, function, dict({"name": function.__name__})), self._get_request(messages), max_retries)
+
+    @recorded('parallel')
+    def get_parallel_function_calls(self, module: dict, functions: list, max_retries: int = 3,
+                                    messages: list[Message] = None) -> list:
+        """
+        Instruct the model to call one or more of the functions in a single response and get the results of all the
+        calls, such as querying more data sources in one step
+        :param module: Module containing the functions
+        :param functions: List of functions to chosen from
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :param messages: List of messages to be sent to the model
+        :return: results of the called functions in the order of the calls, empty list if no attempt succeeded
+        """
+        functions_schemas = [self._function_to_openai_function_schema(f) for f in functions]
+        return self._run_with_retries(lambda request: self._call_functions_from_response(
+            module, self.get_base_call_response(request, functions_schemas)), max_retries, FUNC_ERR, [],
+            self._get_request(messages))
 
+    @recorded('json')
     def get_json_format_response(self, response_model: BaseModel, messages: list[Message] = None,
                                  max_retries=3) -> dict:
         """
         Get the response in desired JSON format
         :param response_model: Desired response model
         :param messages: List of messages to be sent to the model
-        :param max_retries: Number of retries
+        :param max_retries: Maximal number of attempts failing on the response of the model
         :return: dictionary containing the formatted response
         """
-        if messages:
-            self._add_messages_initially(messages)
-        messages = [asdict(m) for m in self.messages_storage]
         schema = self._function_to_openai_function_schema(response_model)
-        response = self.get_forced_call_response(messages, response_model, dict({"name": schema["name"]}))
-        self._add_message(AssistantMessage(str(response)))
-        try:
 
-            parsed = self._repair_output_json(response.choices[0].message.function_call.arguments)
+        def attempt(request: list[dict]) -> dict:
+            response = self.get_forced_call_response(request, response_model, dict({"name": schema["name"]}))
+            parsed = self._repair_output_json(self._get_tool_calls(response)[0].function.arguments)
             return self._match_parameters(parsed, schema["name"], schema["parameters"]["required"])
-        except Exception as e:
-            return self._handle_call_exception(e, JSON_ERR, max_retries,
-                                               lambda: self.get_json_format_response(response_model,
-                                                                                     max_retries=max_retries - 1))
 
-    def _get_function_schemas_with_custom_description(self, functions):
-        functions_schemas = []
-        for f, desc in functions:
-            functions_schema = self._function_to_openai_function_schema(f)
-            functions_schema["description"] = desc
-            functions_schemas.append(functions_schema)
-        return functions_schemas
+        return self._run_with_retries(attempt, max_retries, JSON_ERR, {}, self._get_request(messages))
 
-    def _handle_response_function_call_errors(self, module, response, max_retries, handling_function):
-        """ Handle the errors in the function call part of the response
-        :param max_retries: Number of retries
+    def _get_function_call_result(self, module: dict, get_response: Callable[[list[dict]], object],
+                                  request: list[dict], max_retries: int):
+        """
+        Get the response with a function call and the result of the called function, the request is retried by the
+        retry policy
+        :param module: Module containing the functions
+        :param get_response: Function sending the messages to the model and returning its response
+        :param request: Messages of the request
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :return: result of the called function, None if no attempt succeeded
+        """
+        return self._run_with_retries(lambda messages: self._call_function_from_response(module,
+                                                                                         get_response(messages)),
+                                      max_retries, FUNC_ERR, None, request)
+
+    def _run_with_retries(self, attempt: Callable[[list[dict]], object], max_retries: int, error_text: str,
+                          default=None, request: list[dict] = None):
+        """
+        Run the attempts of the request by the retry policy, the retries add a single message with the error of the
+        previous attempt to the request. The responses of an attempt are cached only if the attempt succeeds.
+        :param attempt: Function making one attempt with the given messages
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :param error_text: Text logged and sent to the model before the error
+        :param default: Value returned if no attempt succeeded
+        :param request: Messages of the request
+        :return: result of the successful attempt, default otherwise
+        """
+        attempts = 0
+
+        def counted_attempt(correction: str = None):
+            nonlocal attempts
+            if attempts:
+                add_retry()
+            attempts += 1
+            return self._run_cached_attempt(attempt, self._get_retry_request(request or [], error_text, correction))
+
+        try:
+            return self.retry_policy.run(counted_attempt, max(max_retries, 1))
+        except RetryError as e:
+            logger.error(f"{error_text}{e}. Skipping.")
+            set_failed()
+            return default
+
+    @staticmethod
+    def _get_retry_request(request: list[dict], error_text: str, correction: str = None) -> list[dict]:
+        """Returns the original request, with the correction message of the previous attempt if there is any. The
+        correction is a system message, so fitting the request into the token budget does not drop it or the latest
+        user message."""
+        if correction is None:
+            return request
+        return request + [asdict(SystemMessage(f"{error_text}{correction}. Retry."))]
+
+    def _call_function_from_response(self, module: dict, response):
+        """
+        Call the function chosen in the response with its arguments, only the first call is made if there are more
         :param module: Module containing the functions
         :param response: Model response in API format
-        :return:
+        :return: result of the called function
+        :raises OutputError: if the response does not contain a valid call of a function of the module
         """
-        if response.choices[0].message.function_call is None:
-            return self._handle_call_exception("", NO_CALL_ERR, max_retries, handling_function)
-        if max_retries > 0:
-            return self._handle_function_call_return(handling_function, max_retries, module, response)
-        logger.error(f"Max retries reached. Skipping.")
-        return None
+        tool_calls = self._get_tool_calls(response)
+        if len(tool_calls) > 1:
+            logger.info(f"Only the first of {len(tool_calls)} function calls is made.")
+        return self._call_function(module, tool_calls[0].function)
 
-    def _handle_call_exception(self, e, error_text, max_retries, handling_function: Callable):
-        if RECURSION_ERR in str(e):
-            logger.error(f"Recursion error: {e}")
-            return {}
-        if API_ERR in str(e) or CONN_ERR in str(e):
-            time.sleep(10)
-            max_retries += 1
-        if max_retries > 0:
-            logger.error(f"{error_text}{e}. Retrying")
-            self._add_message(UserMessage(f"{error_text}{e}. Retry."))
-            return handling_function()
-        logger.error(f"{error_text}{e}. Max retries reached. Skipping.")
-        return {}
-
-    def _handle_function_call_return(self, handling_function, max_retries, module, response):
-        """
-        Handle the return of the function call
-        :param max_retries: Number of retries
+    def _call_functions_from_response(self, module: dict, response) -> list:
+        """
+        Call all the functions chosen in the response with their arguments, the calls are checked before any is made
         :param module: Module containing the functions
         :param response: Model response in API format
-        :return:
+        :return: results of the called functions
+        :raises OutputError: if the response does not contain valid calls of functions of the module
+        """
+        calls = [self._parse_function_call(module, c.function) for c in self._get_tool_calls(response)]
+        return [self._call_parsed_function(module, name, arguments) for name, arguments in calls]
+
+    @staticmethod
+    def _get_tool_calls(response) -> list:
+        """
+        Get the tool calls of the response
+        :param response: Model response in API format
+        :return: tool calls of the response
+        :raises OutputError: if the response does not contain any function call
         """
-        name = None
+        tool_calls = response.choices[0].message.tool_calls
+        if not tool_calls:
+            raise OutputError(NO_CALL_ERR)
+        return tool_calls
+
+    @staticmethod
+    def _get_tools(functions_schemas: list[dict]) -> list[dict]:
+        return [{"type": "function", "function": schema} for schema in functions_schemas]
+
+    def _call_function(self, module: dict, function_call):
+        """
+        Call the function of the function call with its arguments
+        :param module: Module containing the functions
+        :param function_call: Function call of the response with the name and the arguments
+        :return: result of the called function
+        :raises OutputError: if the call is not a valid call of a function of the module
+        """
+        name, arguments = self._parse_function_call(module, function_call)
+        return self._call_parsed_function(module, name, arguments)
+
+    @staticmethod
+    def _call_parsed_function(module: dict, name: str, arguments: dict = None):
         try:
-            name, arguments = self._parse_function_call(module, response)
-            if not name:
-                self._add_message(UserMessage("Function name not found. Retry."))
-                return self._handle_function_call_return_errors(handling_function, max_retries)
             if arguments:
                 return module[name](**arguments)
             return module[name]()
-        except RecursionError as e:
-            logger.error(f"{e}")
-            return
         except Exception as e:
-            logger.error(f"Error calling function {name}: {e}")
-            self._add_message(UserMessage(f"Error calling function {name}: {e}. Retry."))
-            return self._handle_function_call_return_errors(handling_function, max_retries)
+            raise OutputError(f"{CANT_CALL_ERR}{name}: {e}") from e
 
-    @staticmethod
-    def _handle_function_call_return_errors(handling_function, max_retries):
-        if max_retries > 0:
-            logger.error("Could not make function call, retrying.")
-            return handling_function()
-        logger.error("Could not make function call, max retries reached. Skipping.")
-        return None
+    def _get_function_schemas_with_custom_description(self, functions):
+        functions_schemas = []
+        for f, desc in functions:
+            functions_schema = self._function_to_openai_function_schema(f)
+            functions_schema["description"] = desc
+            functions_schemas.append(functions_schema)
+        return functions_schemas
 
-    def _parse_function_call(self, module: dict, response) -> [str, dict]:
+    def _parse_function_call(self, module: dict, function_call) -> [str, dict]:
         """
-        Parse the response from the model to get the function call
+        Parse the function call of the response
         :param module: Module containing the function
-        :param response: Model response in API format
-        :return: result of called function
+        :param function_call: Function call of the response with the name and the arguments
+        :return: name of the called function and its arguments
+        :raises OutputError: if the function does not exist or its arguments are missing
         """
-        function_name = response.choices[0].message.function_call.name
+        function_name = function_call.name
         if not self._does_function_exist(function_name, module):
-            logger.error(f"Function {function_name} not found in the module.")
-            return None, None
+            raise OutputError(f"Function {function_name} not found")
         params = self._get_function_parameters(module, function_name)
         if not params:
             return function_name, None
-        function_arguments = self._parse_function_arguments(response.choices[0].message.function_call.arguments)
-        matched_arguments = self._match_parameters(function_arguments, function_name, params)
-        if matched_arguments:
-            return function_name, matched_arguments
-        return None, None
+        function_arguments = self._parse_function_arguments(function_call.arguments)
+        return function_name, self._match_parameters(function_arguments, function_name, params)
 
     def _parse_function_arguments(self, function_arguments: dict) -> dict:
         """
@@ -264,25 +465,33 @@ class ApiAgent(ABC):
             result[key] = function_arguments[key].get("description", "")
         return self._fix_encoding(result)
 
-    def _add_message(self, message: Message):
+    def _get_request(self, messages: list[Message] = None) -> list[dict]:
         """
-        Add a message to the message storage
-        :param message: Message to be added
-        :return:
+        Get the messages of a new request, the context of a single call of the agent
+        :param messages: Messages of the call
+        :return: messages fitted into the token budget in dictionary format
         """
-        if len(self.messages_storage) > 10 or len(str(self.messages_storage)) > MAX_SIZE:
-            self.messages_storage = self.messages_storage[:3]
-        self.messages_storage.append(message)
+        return self._get_window(messages).as_dicts()
 
-    def _add_messages_initially(self, messages: list[Message]):
+    def _get_window(self, messages: list[Message] = None, reserved_tokens: int = 0) -> ConversationWindow:
         """
-        Add a list of messages to the message storage
-        :param messages: List of messages to be added
+        Get a conversation window within the token budget of the agent
+        :param messages: Initial messages of the window
+        :param reserved_tokens: Tokens of the budget taken by the rest of the request, such as the function schemas
+        :return: conversation window
         """
-        self.messages_storage = []
-        for m in messages:
-            if isinstance(m, Message):
-                self._add_message(m)
+        # the token counter is loaded on the first count, not when the agent is created
+        window = ConversationWindow(self.context_tokens - reserved_tokens, lambda text: self.token_counter(text))
+        window.extend(messages or [])
+        return window
+
+    def _fit_messages(self, messages: list[dict], reserved_tokens: int = 0) -> list[dict]:
+        """Fit the messages in dictionary format into the token budget of the agent, less the reserved tokens."""
+        return self._get_window([message_from_dict(m) for m in messages], reserved_tokens).as_dicts()
+
+    def _count_schema_tokens(self, schema) -> int:
+        """Returns the tokens of the schemas sent with the messages, such as the tools or the response model."""
+        return self.token_counter(json.dumps(schema, ensure_ascii=False))
 
     @staticmethod
     def _repair_output_json(function_arguments) -> dict:
@@ -319,10 +528,7 @@ class ApiAgent(ABC):
         :return:
         """
         if func_name in module:
-            function_obj = module[func_name]
-            signature = inspect.signature(function_obj)
-            parameter_names = list(signature.parameters.keys())
-            return parameter_names
+            return list(get_function_schema(module[func_name]).parameters)
         else:
             logger.error(f"Function {func_name} not found in the module.")
             return []
@@ -330,18 +536,21 @@ class ApiAgent(ABC):
     @staticmethod
     def _function_to_openai_function_schema(function: Callable) -> dict:
         """
-        Convert the function to OpenAI function schema
+        Convert the function to OpenAI function schema, the schema is compiled once per function
         :param function: Function to be converted
         :return: dictionary containing the function schema
         """
-        converted = {}
-        try:
-            converted = dict(convert_to_openai_tool(function)["function"])
-        except Exception as e:
-            logger.error(f"Error converting function to OpenAI function schema: {e}")
-        return converted
+        return dict(get_function_schema(function).openai_schema)
 
     def _match_parameters(self, received_arguments: dict, function_name: str, function_params: list) -> dict:
+        """
+        Match the received arguments to the parameters of the function
+        :param received_arguments: Arguments provided by the model
+        :param function_name: Name of the function
+        :param function_params: Names of the parameters of the function
+        :return: dictionary of the arguments of the function
+        :raises OutputError: if a required argument is missing
+        """
         matched_args = {}
         for arg in function_params:
             if arg not in received_arguments:
@@ -353,15 +562,11 @@ class ApiAgent(ABC):
                 if arg == "sources":
                     matched_args[arg] = ''
                     continue
-                logger.error(f"Parameter {arg} required but not found in call for function {function_name}.")
-                self._add_message(
-                    UserMessage(
-                        f"Error: Parameter {arg} required but not found in call for function {function_name}. Retry."))
-                return {}
+                raise OutputError(f"Parameter {arg} required but not found in call for function {function_name}")
             matched_args[arg] = received_arguments[arg] if received_arguments[arg] not in ["None", "null"] else ""
         redundant_args = [arg for arg in received_arguments if arg not in function_params]
         if redundant_args:
-            self._add_message(UserMessage(f"Redundant arguments provided: {redundant_args}."))
+            logger.info(f"Redundant arguments provided for function {function_name}: {redundant_args}.")
         return matched_args
 
     @staticmethod
@@ -398,6 +603,4 @@ class ApiAgent(ABC):
 
     @staticmethod
     def _get_function_params_dict(function: Callable) -> dict:
-        sig = inspect.signature(function)
-        params = {param.name: param.annotation.__name__ for param in sig.parameters.values()}
-        return params
+        return dict(get_function_schema(function).parameter_types)
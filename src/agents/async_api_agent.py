@@ -0,0 +1,298 @@
+import asyncio
+import inspect
+import logging
+import time
+import weakref
+from typing import AsyncIterator, Awaitable, Callable
+
+from openai import AsyncOpenAI
+from pydantic import BaseModel
+
+from src.agents.api_agent import ApiAgent, _attempt_responses
+from src.agents.call_ledger import recorded, add_request, add_retry, set_failed
+from src.agents.constants import JSON_ERR, FUNC_ERR, MAX_CONCURRENT_REQUESTS
+from src.agents.message import Message
+from src.agents.response_cache import ResponseCache
+from src.agents.retry_policy import RetryError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncApiAgent(ApiAgent):
+    """Asynchronous variant of ApiAgent built on AsyncOpenAI. At most max_concurrency requests of the agent are in
+    flight at once."""
+
+    def __init__(self, url, api_key, model_name, max_concurrency: int = MAX_CONCURRENT_REQUESTS, **kwargs):
+        """
+        Initialize the API agent
+        :param url: API url
+        :param api_key: API key for the service
+        :param model_name: Name of the model to be used
+        :param max_concurrency: Maximal number of requests in flight at once
+        :param kwargs: Other parameters of ApiAgent
+        """
+        super().__init__(url, api_key, model_name, **kwargs)
+        self.max_concurrency = max_concurrency
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _get_client(url, api_key):
+        return AsyncOpenAI(api_key=api_key, base_url=url, max_retries=0)
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """Semaphore limiting the requests in flight, one per event loop."""
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    async def _create(self, create: Callable = None, **request):
+        """
+        Send the chat completion request once a slot of the semaphore is free
+        :param create: Function creating the chat completion, the one of the client by default
+        :param request: Parameters of the chat completion request
+        :return: chat completion
+        """
+        async with self.semaphore:
+            return await (create or self.client.chat.completions.create)(**request)
+
+    @recorded('base')
+    async def get_base_response(self, messages: list[dict]):
+        """Get the response from the model without function calling"""
+        messages = self._fit_messages(messages)
+        self._log_exchange("Messages", messages)
+        response = await self._create(model=self.model_name, messages=messages, stream=False)
+        add_request(response.usage)
+        self._log_exchange("Response", response)
+        return response
+
+    async def get_streamed_response(self, messages: list[dict]) -> AsyncIterator[str]:
+        """Get the response from the model without function calling, streamed as the parts of its text"""
+        messages = self._fit_messages(messages)
+        self._log_exchange("Messages", messages)
+        start = time.perf_counter()
+        parts = []
+        ttft = None
+        async with self.semaphore:
+            stream = await self.client.chat.completions.create(model=self.model_name, messages=messages, stream=True)
+            async for chunk in stream:
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if not content:
+                    continue
+                if not parts:
+                    ttft = time.perf_counter() - start
+                    logger.info(f"Time to first token of {self.model_name}: {ttft:.2f} s")
+                parts.append(content)
+                yield content
+        self._record_stream(messages, parts, start, ttft)
+
+    async def get_base_call_response(self, messages: list[dict], functions_schemas: list[dict]):
+        """Get the response from the model with tool calling, the model may call more functions at once
+        :param messages: List of messages to be sent to the model
+        :param functions_schemas: List of function schemas in OpenAI tool format
+        """
+        tools = self._get_tools(functions_schemas)
+        messages = self._fit_messages(messages, self._count_schema_tokens(tools))
+        self._log_exchange("Messages", messages)
+        response = await self._get_cached_completion(
+            model=self.model_name,
+            messages=messages,
+            tools=tools,
+            stream=False
+        )
+        self._log_exchange("Response", response)
+        return response
+
+    async def get_forced_call_response(self, messages: list[dict], function: Callable, function_call: dict):
+        """Get the response from the model with forced function call
+        :param messages: List of messages to be sent to the model
+        :param function: Function to be called
+        :param function_call: Function call enforcing the function name
+        """
+        tools = self._get_tools([self._function_to_openai_function_schema(function)])
+        messages = self._fit_messages(messages, self._count_schema_tokens(tools))
+        self._log_exchange("Messages", messages)
+        response = await self._get_cached_completion(
+            model=self.model_name,
+            messages=messages,
+            tools=tools,
+            stream=False,
+            tool_choice={"type": "function", "function": function_call},
+        )
+        self._log_exchange("Response", response)
+        return response
+
+    async def _get_cached_completion(self, **request):
+        """
+        Get the chat completion of the request, from the response cache if it is enabled
+        :param request: Parameters of the chat completion request
+        :return: chat completion
+        """
+        if not self.use_cache:
+            response = await self._create(**request)
+            add_request(response.usage)
+            return response
+        key = ResponseCache.get_key(self.model_name, request["messages"],
+                                    **{k: v for k, v in request.items() if k not in ["model", "messages"]})
+        response = self.response_cache.get(key)
+        if response is not None:
+            logger.info("Response taken from the cache")
+            add_request(cached=True)
+            return response
+        response = await self._create(**request)
+        add_request(response.usage)
+        self._set_cached(key, response)
+        return response
+
+    @recorded('function')
+    async def get_function_call(self, module: dict, functions: list, max_retries: int = 3,
+                                messages: list[Message] = None):
+        """
+        Instruct the model to call a function and get the result of the function call
+        :param module: Module containing the functions
+        :param functions: List of functions to chosen from
+        :param messages: List of messages to be sent to the model
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :return: result of called function
+        """
+        functions_schemas = [self._function_to_openai_function_schema(f) for f in functions]
+        return await self._get_function_call_result(
+            module, lambda request: self.get_base_call_response(request, functions_schemas),
+            self._get_request(messages), max_retries)
+
+    @recorded('function')
+    async def get_custom_descr_function_call(self, module: dict, functions: list[tuple[Callable, str]],
+                                             max_retries: int = 3,
+                                             messages: list[Message] = None):
+        """
+        Instruct the model to call a function and get the result of the function call
+        :param module: Module containing the functions
+        :param functions: List of functions to chosen from with custom descriptions
+        :param messages: List of messages to be sent to the model
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :return: result of called function
+        """
+        functions_schemas = self._get_function_schemas_with_custom_description(functions)
+        return await self._get_function_call_result(
+            module, lambda request: self.get_base_call_response(request, functions_schemas),
+            self._get_request(messages), max_retries)
+
+    @recorded('forced')
+    async def get_forced_function_call(self, module: dict, function: Callable, max_retries: int = 3,
+                                       messages: list[Message] = None):
+        """ Get the response with forced function call
+        :param module: Module containing the function
+        :param function: Function to be called
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :param messages: List of messages to be sent to the model
+        :return:
+        """
+        return await self._get_function_call_result(
+            module, lambda request: self.get_forced_call_response(request, function,
+                                                                  dict({"name": function.__name__})),
+            self._get_request(messages), max_retries)
+
+    @recorded('parallel')
+    async def get_parallel_function_calls(self, module: dict, functions: list, max_retries: int = 3,
+                                          messages: list[Message] = None) -> list:
+        """
+        Instruct the model to call one or more of the functions in a single response and get the results of all the
+        calls, the coroutine functions are awaited concurrently
+        :param module: Module containing the functions
+        :param functions: List of functions to chosen from
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :param messages: List of messages to be sent to the model
+        :return: results of the called functions in the order of the calls, empty list if no attempt succeeded
+        """
+        functions_schemas = [self._function_to_openai_function_schema(f) for f in functions]
+
+        async def attempt(request: list[dict]) -> list:
+            results = self._call_functions_from_response(module, await self.get_base_call_response(request,
+                                                                                                    functions_schemas))
+            return list(await asyncio.gather(*[self._await_result(r) for r in results]))
+
+        return await self._run_with_retries(attempt, max_retries, FUNC_ERR, [], self._get_request(messages))
+
+    @recorded('json')
+    async def get_json_format_response(self, response_model: BaseModel, messages: list[Message] = None,
+                                       max_retries=3) -> dict:
+        """
+        Get the response in desired JSON format
+        :param response_model: Desired response model
+        :param messages: List of messages to be sent to the model
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :return: dictionary containing the formatted response
+        """
+        schema = self._function_to_openai_function_schema(response_model)
+
+        async def attempt(request: list[dict]) -> dict:
+            response = await self.get_forced_call_response(request, response_model, dict({"name": schema["name"]}))
+            parsed = self._repair_output_json(self._get_tool_calls(response)[0].function.arguments)
+            return self._match_parameters(parsed, schema["name"], schema["parameters"]["required"])
+
+        return await self._run_with_retries(attempt, max_retries, JSON_ERR, {}, self._get_request(messages))
+
+    async def _get_function_call_result(self, module: dict, get_response: Callable[[list[dict]], Awaitable],
+                                        request: list[dict], max_retries: int):
+        """
+        Get the response with a function call and the result of the called function, the request is retried by the
+        retry policy
+        :param module: Module containing the functions
+        :param get_response: Function sending the messages to the model and returning the awaitable response
+        :param request: Messages of the request
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :return: result of the called function, None if no attempt succeeded
+        """
+
+        async def attempt(messages: list[dict]):
+            return await self._await_result(self._call_function_from_response(module, await get_response(messages)))
+
+        return await self._run_with_retries(attempt, max_retries, FUNC_ERR, None, request)
+
+    @staticmethod
+    async def _await_result(result):
+        """Returns the result of the called function, awaited if the function is a coroutine function."""
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+    async def _run_cached_attempt(self, attempt: Callable[[list[dict]], Awaitable], request: list[dict]):
+        """Makes one attempt with the messages, the responses of the attempt are cached only if it succeeds."""
+        pending = []
+        token = _attempt_responses.set(pending)
+        try:
+            result = await attempt(request)
+        finally:
+            _attempt_responses.reset(token)
+        self._cache_attempt_responses(pending)
+        return result
+
+    async def _run_with_retries(self, attempt: Callable[[list[dict]], Awaitable], max_retries: int, error_text: str,
+                                default=None, request: list[dict] = None):
+        """
+        Run the attempts of the request by the retry policy, the retries add a single message with the error of the
+        previous attempt to the request. The responses of an attempt are cached only if the attempt succeeds.
+        :param attempt: Function making one attempt with the given messages
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :param error_text: Text logged and sent to the model before the error
+        :param default: Value returned if no attempt succeeded
+        :param request: Messages of the request
+        :return: result of the successful attempt, default otherwise
+        """
+        attempts = 0
+
+        async def counted_attempt(correction: str = None):
+            nonlocal attempts
+            if attempts:
+                add_retry()
+            attempts += 1
+            return await self._run_cached_attempt(attempt, self._get_retry_request(request or [], error_text,
+                                                                                   correction))
+
+        try:
+            return await self.retry_policy.arun(counted_attempt, max(max_retries, 1))
+        except RetryError as e:
+            logger.error(f"{error_text}{e}. Skipping.")
+            set_failed()
+            return default
@@ -0,0 +1,152 @@
+import logging
+from typing import Type, Callable
+
+from pydantic import BaseModel
+
+from src.agents.async_api_agent import AsyncApiAgent
+from src.agents.call_ledger import recorded
+from src.agents.constants import JSON_ERR, FUNC_NAME, CANT_CALL_ERR, FUNC_ERR
+from src.agents.local_api_agent import LocalApiAgent, ChosenFunction
+from src.agents.message import Message
+from src.agents.function_schema import get_function_call_model
+from src.agents.retry_policy import OutputError, RetryError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLocalApiAgent(AsyncApiAgent, LocalApiAgent):
+    """Asynchronous variant of LocalApiAgent, the patched client is an asynchronous one. The requests and the responses
+    are handled by the methods of LocalApiAgent, only the requests and the called functions are awaited here."""
+
+    @recorded('json')
+    async def get_json_format_response(self, response_model: BaseModel, messages: list[Message] = None,
+                                       max_retries=2) -> dict:
+        """
+        Get the response in desired JSON format
+        :param response_model: Desired response model
+        :param messages: List of messages to be sent to the model
+        :param max_retries: Maximal number of attempts failing on the response of the model
+        :return: dictionary containing the formatted response
+        """
+        return await self._run_with_retries(lambda request: self._get_json_response(response_model, request),
+                                            max_retries, JSON_ERR, {}, self._get_request(messages))
+
+    async def _get_json_response(self, response_model: Type[BaseModel], messages: list[dict]) -> dict:
+        """Get a single response of the model in the response model as a dictionary."""
+        return dict(await self._get_cached_model_response(messages, response_model))
+
+    async def _get_cached_model_response(self, messages: list[dict], response_model: Type[BaseModel]) -> BaseModel:
+        """Get the response of the patched client in the response model, from the response cache if it is enabled."""
+        key, request = self._get_model_request(messages, response_model)
+        cached = self._get_cached_model(key, response_model)
+        if cached is not None:
+            return cached
+        return self._add_model_response(key, await self._create(self.instructor_client.chat.completions.create,
+                                                                **request))
+
+    @recorded('function')
+    async def get_function_call(self, module: dict, functions: list, max_retries: int = 2,
+                                messages: list[Message] = None):
+        """
+        Instruct the model to call a function and get the result of the function call
+        :param module: Module containing the functions
+        :param functions: List of functions to be chosen from
+        :param messages: List of messages to be sent to the model
+        :param max_retries: Number of retries
+        :return: result of the called function
+        """
+        names_and_descriptions = [self._get_func_name_and_descr_dict(f) for f in functions]
+        return await self._get_chosen_function_call(module, functions, names_and_descriptions, max_retries, messages)
+
+    @recorded('function')
+    async def get_custom_descr_function_call(self, module: dict, functions: list[tuple[Callable, str]],
+                                             max_retries: int = 2,
+                                             messages: list[Message] = None):
+        """
+        Instruct the model to call a function and get the result of the function call, with providing custom descriptions
+        :param module: Module containing the functions
+        :param functions: list of [function, description] to be chosen from
+        :param max_retries: Number of retries
+        :param messages: List of messages to be sent to the model
+        :return: result of the called function
+        """
+        names_and_descriptions = [{FUNC_NAME: f.__name__, "description": descr} for f, descr in functions]
+        return await self._get_chosen_function_call(module, [f for f, _ in functions], names_and_descriptions,
+                                                    max_retries, messages)
+
+    @recorded('parallel')
+    async def get_parallel_function_calls(self, module: dict, functions: list, max_retries: int = 2,
+                                          messages: list[Message] = None) -> list:
+        result = await self.get_function_call(module, functions, max_retries, messages)
+        return [] if result is None else [result]
+
+    async def _get_chosen_function_call(self, module, functions, names_and_descriptions, max_retries, messages):
+        if self.one_step_call and len(functions) > 1:
+            try:
+                return await self._call_in_one_step(module, functions, names_and_descriptions, messages)
+            except RetryError as e:
+                logger.info(f"Error getting the function call in one step: {e}. Choosing the function first.")
+        try:
+            name, model = await self._get_func_name_and_model(module, functions, names_and_descriptions,
+                                                               max_retries, messages)
+        except Exception as e:
+            logger.error(f"Error choosing function and schema: {e}")
+            return
+        messages = self._get_arguments_request(module, name, names_and_descriptions, messages)
+        if self._get_function_parameters(module, name):
+            return await self._call_for_arguments(name, module, model, messages, max_retries)
+        return await self._acall_parsed_function(module, name)
+
+    @recorded('forced')
+    async def get_forced_function_call(self, module: dict, function: Callable, max_retries: int = 2,
+                                       messages: list[Message] = None):
+        function_name = function.__name__
+        function_schema = self._function_to_pydantic_model(function)
+        messages = self._get_messages_with_params_config(messages, self._get_function_params_dict(function),
+                                                         function.__doc__)
+        if self._get_function_parameters(module, function_name):
+            return await self._call_for_arguments(function_name, module, function_schema, messages, max_retries)
+        return await self._acall_parsed_function(module, function_name)
+
+    async def _call_in_one_step(self, module, functions, names_and_descriptions, messages):
+        call_model = get_function_call_model(functions)
+
+        async def attempt(request: list[dict]):
+            name, arguments = self._parse_chosen_call(module, await self._get_json_response(call_model, request))
+            return await self._acall_parsed_function(module, name, arguments)
+
+        request = self._get_one_step_request(module, functions, names_and_descriptions, messages)
+        return await self.retry_policy.arun(lambda _: self._run_cached_attempt(attempt, request), 1)
+
+    async def _get_func_name_and_model(self, module, functions, names_and_descriptions, max_retries=1, messages=None):
+        name = functions[0].__name__
+        if len(functions) > 1:
+            name = await self._choose_from_functions(module, self._get_choice_request(messages,
+                                                                                      names_and_descriptions),
+                                                     max_retries)
+        return name, self._function_to_pydantic_model(module[name])
+
+    async def _choose_from_functions(self, module, request, max_retries):
+
+        async def attempt(messages: list[dict]) -> str:
+            return self._get_chosen_name(module, await self._get_json_response(ChosenFunction, messages))
+
+        return await self._run_with_retries(attempt, max_retries, FUNC_ERR, None, request)
+
+    async def _call_for_arguments(self, function_name, module, function_schema, messages=None, max_retries=2):
+        """Get the arguments for the function call and return the result of the function"""
+
+        async def attempt(request: list[dict]):
+            arguments = self._get_arguments(module, function_name,
+                                            await self._get_json_response(function_schema, request))
+            return await self._acall_parsed_function(module, function_name, arguments)
+
+        return await self._run_with_retries(attempt, max_retries, JSON_ERR, None, self._get_request(messages))
+
+    async def _acall_parsed_function(self, module: dict, name: str, arguments: dict = None):
+        """Asynchronous variant of _call_parsed_function, the coroutine functions are awaited."""
+        result = self._call_parsed_function(module, name, arguments)
+        try:
+            return await self._await_result(result)
+        except Exception as e:
+            raise OutputError(f"{CANT_CALL_ERR}{name}: {e}") from e
@@ -0,0 +1,10 @@
+from typing import Callable
+
+from src.agents.async_api_agent import AsyncApiAgent
+from src.agents.message import Message
+
+
+class AsyncOpenAIApiAgent(AsyncApiAgent):
+    async def get_forced_function_call(self, module: dict, function: Callable, max_retries: int = 2,
+                                       messages: list[Message] = None):
+        return await super().get_forced_function_call(module, function, max_retries, messages)
@@ -0,0 +1,194 @@
+"""
+Ledger of the model calls of the agents. Every call of an agent method is recorded as one JSON line with the model,
+the kind of the call, the call site, the latency, the number of requests and retries, the prompt and completion
+tokens and the outcome. The summary of the ledger shows the latency and token percentiles per model and per call site.
+
+python -m src.agents.call_ledger -f llm_calls.jsonl
+"""
+import argparse
+import contextvars
+import functools
+import inspect
+import json
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable
+
+import pandas as pd
+
+from src.agents.constants import LLM_LEDGER_PATH, LLM_LEDGER_SAMPLE_RATE
+
+# entry of the call in progress in the current thread or task, the calls made within it are a part of it
+_current_call = contextvars.ContextVar('current_call', default=None)
+
+
+class CallLedger:
+    """Appends the records of the model calls to a JSONL file. The file can be shared by more agents and processes,
+    only a sample of the calls is recorded if the sample rate is lower than one."""
+
+    def __init__(self, path: str = LLM_LEDGER_PATH, sample_rate: float = LLM_LEDGER_SAMPLE_RATE):
+        """
+        :param path: Path of the JSONL file
+        :param sample_rate: Share of the calls recorded
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+
+    def record(self, entry: dict):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        with self.lock:
+            with open(self.path, 'a') as file:
+                file.write(line + '\n')
+
+    @contextmanager
+    def call(self, model: str, kind: str, site: str):
+        """
+        Records the call made within the context, the requests and retries made within it are counted in its entry
+        :param model: Name of the model
+        :param kind: Kind of the call, such as function, forced or json
+        :param site: Function making the call
+        :return: entry of the call, updated during the call
+        """
+        entry = {'ts': round(time.time(), 3), 'model': model, 'kind': kind, 'site': site, 'requests': 0,
+                 'retries': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached': 0, 'outcome': 'ok'}
+        token = _current_call.set(entry)
+        start = time.perf_counter()
+        try:
+            yield entry
+        except BaseException:
+            entry['outcome'] = 'error'
+            raise
+        finally:
+            _current_call.reset(token)
+            entry['latency_s'] = round(time.perf_counter() - start, 3)
+            self.record(entry)
+
+
+def recorded(kind: str):
+    """Decorator of the agent methods recording their calls in the call ledger of the agent, the calls of the methods
+    made within a recorded call are not recorded separately."""
+
+    def decorator(method: Callable):
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(agent, *args, **kwargs):
+                if agent.call_ledger is None or _current_call.get() is not None:
+                    return await method(agent, *args, **kwargs)
+                with agent.call_ledger.call(agent.model_name, kind, get_call_site(args, kwargs)):
+                    return await method(agent, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(agent, *args, **kwargs):
+            if agent.call_ledger is None or _current_call.get() is not None:
+                return method(agent, *args, **kwargs)
+            with agent.call_ledger.call(agent.model_name, kind, get_call_site(args, kwargs)):
+                return method(agent, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_retry():
+    entry = _current_call.get()
+    if entry is not None:
+        entry['retries'] += 1
+
+
+def add_request(usage=None, cached: bool = False):
+    """
+    Adds a request of the model and the tokens of its response to the call in progress
+    :param usage: Usage of the response with the prompt and completion tokens
+    :param cached: Whether the response was taken from the response cache
+    """
+    entry = _current_call.get()
+    if entry is None:
+        return
+    entry['requests'] += 1
+    if cached:
+        entry['cached'] += 1
+    if usage is not None:
+        entry['prompt_tokens'] += usage.prompt_tokens or 0
+        entry['completion_tokens'] += usage.completion_tokens or 0
+
+
+def set_failed():
+    """Marks the call in progress as failed, none of its attempts succeeded."""
+    entry = _current_call.get()
+    if entry is not None:
+        entry['outcome'] = 'failed'
+
+
+def get_call_site(args: tuple, kwargs: dict) -> str:
+    """Returns the function making the call: the function the functions given to the agent are nested in, the first
+    caller outside the agents otherwise."""
+    for arg in list(args) + list(kwargs.values()):
+        for function in arg if isinstance(arg, list) else [arg]:
+            function = function[0] if isinstance(function, tuple) else function
+            if callable(function) and hasattr(function, '__qualname__'):
+                return function.__qualname__.split('.<locals>')[0]
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get('__name__', '').startswith('src.agents'):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else ''
+
+
+@lru_cache(maxsize=None)
+def get_call_ledger(path: str = LLM_LEDGER_PATH) -> CallLedger:
+    """Returns the call ledger of the path, one per process."""
+    return CallLedger(path)
+
+
+def get_summary(path: str, by: str = 'model') -> pd.DataFrame:
+    """
+    Summarizes the recorded calls
+    :param path: Path of the JSONL file of the ledger
+    :param by: Column the calls are grouped by, model or site
+    :return: number of calls, latency and token percentiles, retries and failures of the groups, the time to first
+    token percentiles of the streamed calls
+    """
+    calls = pd.read_json(path, lines=True)
+    calls['failed'] = calls['outcome'] != 'ok'
+    grouped = calls.groupby(by)
+    summary = pd.DataFrame({
+        'calls': grouped.size(),
+        'latency_p50_s': grouped['latency_s'].quantile(0.5),
+        'latency_p95_s': grouped['latency_s'].quantile(0.95),
+        'prompt_tokens_p50': grouped['prompt_tokens'].quantile(0.5),
+        'prompt_tokens_p95': grouped['prompt_tokens'].quantile(0.95),
+        'completion_tokens_p50': grouped['completion_tokens'].quantile(0.5),
+        'completion_tokens_p95': grouped['completion_tokens'].quantile(0.95),
+        'retries': grouped['retries'].sum(),
+        'cached': grouped['cached'].sum(),
+        'failed': grouped['failed'].sum(),
+    })
+    if 'ttft_s' in calls:
+        summary['ttft_p50_s'] = grouped['ttft_s'].quantile(0.5)
+        summary['ttft_p95_s'] = grouped['ttft_s'].quantile(0.95)
+    return summary.round(3)
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Summarize the latency and token use of the recorded model calls")
+    parser.add_argument("-f", "--file", default=LLM_LEDGER_PATH, help="JSONL file of the call ledger")
+    return parser.parse_args()
+
+
+def main():
+    args = process_arguments()
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        for by in ['model', 'site']:
+            print(get_summary(args.file, by).to_string(), end='\n\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,44 @@
-API_ERR = "api_error"
-CONN_ERR = "Connection error"
-RECURSION_ERR = "recursion"
+from configparser import ConfigParser
+
+from src.constants import CONSTANTS_CONFIG_PATH
+
+_config = ConfigParser()
+_config.read(CONSTANTS_CONFIG_PATH)
+
 FUNC_ERR = "Error getting function call response: "
 JSON_ERR = "Error getting JSON format response: "
 NO_CALL_ERR = "No function call found in the response."
 CANT_CALL_ERR = "Error calling function "
 
 FUNC_NAME = "function_name"
+
+LLM_CACHE_FOLDER = _config.get('LLM_CACHE', 'LLM_CACHE_FOLDER', fallback='../../llm_cache')
+LLM_CACHE_SIZE_LIMIT = _config.getint('LLM_CACHE', 'LLM_CACHE_SIZE_LIMIT', fallback=2 ** 30)
+USE_LLM_CACHE = _config.getboolean('LLM_CACHE', 'USE_LLM_CACHE', fallback=True)
+
+# encoding used for the models unknown to tiktoken, close to the tokenizers of llama3 and mixtral
+DEFAULT_ENCODING = 'cl100k_base'
+# tokens of the role and separators of a chat message
+MESSAGE_TOKENS = 4
+
+MAX_CONCURRENT_REQUESTS = _config.getint('LLM_CONCURRENCY', 'MAX_CONCURRENT_REQUESTS', fallback=16)
+
+RETRY_MAX_ATTEMPTS = _config.getint('LLM_RETRY', 'RETRY_MAX_ATTEMPTS', fallback=6)
+RETRY_BASE_DELAY = _config.getfloat('LLM_RETRY', 'RETRY_BASE_DELAY', fallback=1.0)
+RETRY_MAX_DELAY = _config.getfloat('LLM_RETRY', 'RETRY_MAX_DELAY', fallback=30.0)
+RETRY_MAX_TOTAL_TIME = _config.getfloat('LLM_RETRY', 'RETRY_MAX_TOTAL_TIME', fallback=120.0)
+
+USE_LLM_LEDGER = _config.getboolean('LLM_LEDGER', 'USE_LLM_LEDGER', fallback=True)
+LLM_LEDGER_PATH = _config.get('LLM_LEDGER', 'LLM_LEDGER_PATH', fallback='../../llm_calls.jsonl')
+LLM_LEDGER_SAMPLE_RATE = _config.getfloat('LLM_LEDGER', 'LLM_LEDGER_SAMPLE_RATE', fallback=1.0)
+LOG_LLM_PROMPTS = _config.getboolean('LLM_LEDGER', 'LOG_LLM_PROMPTS', fallback=False)
+
+ROUTER_WINDOW = _config.getint('LLM_ROUTER', 'ROUTER_WINDOW', fallback=50)
+ROUTER_EXPLORE_RATE = _config.getfloat('LLM_ROUTER', 'ROUTER_EXPLORE_RATE', fallback=0.05)
+ROUTER_HEDGE = _config.getboolean('LLM_ROUTER', 'ROUTER_HEDGE', fallback=True)
+ROUTER_HEDGE_PERCENTILE = _config.getfloat('LLM_ROUTER', 'ROUTER_HEDGE_PERCENTILE', fallback=0.9)
+ROUTER_HEDGE_DELAY = _config.getfloat('LLM_ROUTER', 'ROUTER_HEDGE_DELAY', fallback=5.0)
+ROUTER_MIN_SAMPLES = _config.getint('LLM_ROUTER', 'ROUTER_MIN_SAMPLES', fallback=5)
+
+ONE_STEP_FUNCTION_CALL = _config.getboolean('LOCAL_LLM', 'ONE_STEP_FUNCTION_CALL', fallback=True)
+LOCAL_JSON_CONSTRAINT = _config.get('LOCAL_LLM', 'LOCAL_JSON_CONSTRAINT', fallback='json_schema')
@@ -0,0 +1,67 @@
+import logging
+from collections import deque
+from dataclasses import asdict
+from typing import Callable, Iterator
+
+from src.agents.constants import MESSAGE_TOKENS
+from src.agents.message import Message
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationWindow:
+    """Messages of a conversation kept within a token budget. The tokens of every message are counted once when it is
+    appended, so the appends do not go through the whole conversation. When the budget is exceeded, the oldest
+    messages are dropped first, except for the system messages and the latest user message."""
+
+    def __init__(self, max_tokens: int, count_tokens: Callable[[str], int]):
+        """
+        :param max_tokens: Token budget of the messages
+        :param count_tokens: Function counting the tokens of a text
+        """
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.tokens = 0
+        self._entries = deque()
+        self._latest_user = None
+
+    def __iter__(self) -> Iterator[Message]:
+        return (message for message, _ in self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def append(self, message: Message):
+        """
+        Append a message, the oldest messages are dropped if the budget is exceeded
+        :param message: Message to be added
+        """
+        entry = (message, self.count_tokens(message.content or '') + MESSAGE_TOKENS)
+        self._entries.append(entry)
+        self.tokens += entry[1]
+        if message.is_user():
+            self._latest_user = entry
+        if self.tokens > self.max_tokens:
+            self._trim()
+
+    def extend(self, messages: list[Message]):
+        for m in messages:
+            if isinstance(m, Message):
+                self.append(m)
+
+    def as_dicts(self) -> list[dict]:
+        return [asdict(m) for m in self]
+
+    def _trim(self):
+        """Drops the oldest messages that are not kept until the messages fit into the budget."""
+        kept = []
+        while self.tokens > self.max_tokens and self._entries:
+            entry = self._entries.popleft()
+            if entry is self._latest_user or entry[0].is_system():
+                kept.append(entry)
+            else:
+                self.tokens -= entry[1]
+        self._entries.extendleft(reversed(kept))
+        if self.tokens > self.max_tokens:
+            logger.warning(f"The system messages and the latest user message alone take {self.tokens} tokens, "
+                           f"over the budget of {self.max_tokens} tokens.")
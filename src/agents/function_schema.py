@@ -0,0 +1,113 @@
+import inspect
+import logging
+import weakref
+from functools import cached_property, lru_cache
+from typing import Callable, Literal, Type, Union
+
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_core.utils.json_schema import dereference_refs
+from pydantic import BaseModel, Field, create_model
+
+from src.agents.constants import FUNC_NAME
+
+logger = logging.getLogger(__name__)
+
+
+class FunctionSchema:
+    """Compiled schemas of a function given to the model: the OpenAI function schema, the names and types of the
+    parameters and the pydantic model of the arguments. They are compiled once on the first use."""
+
+    def __init__(self, function: Callable):
+        """
+        :param function: Function or pydantic model the schemas are compiled from
+        """
+        self.name = function.__name__
+        self.openai_schema = self._get_openai_schema(function)
+        if isinstance(function, type) and issubclass(function, BaseModel):
+            self.parameters = list(function.model_fields)
+            self.parameter_types = {}
+        else:
+            parameters = inspect.signature(function).parameters
+            self.parameters = list(parameters)
+            self.parameter_types = {p.name: getattr(p.annotation, '__name__', str(p.annotation))
+                                    for p in parameters.values()}
+            self._fields = {
+                name: (p.annotation if p.annotation is not inspect.Parameter.empty else 'str', ...)
+                for name, p in parameters.items()
+            }
+
+    @cached_property
+    def pydantic_model(self) -> Type[BaseModel]:
+        """Pydantic model constructed from the parameters of the function, assuming all parameters are required and
+        of type str if not annotated."""
+        return create_model(self.name, **self._fields)
+
+    @cached_property
+    def call_model(self) -> Type[BaseModel]:
+        """Pydantic model of a call of the function: the name of the function and its arguments."""
+        return create_model(self.name, __doc__=self.openai_schema.get("description"),
+                            **{FUNC_NAME: (Literal[self.name], ...)}, **self._fields)
+
+    @staticmethod
+    def _get_openai_schema(function: Callable) -> dict:
+        try:
+            if isinstance(function, type) and issubclass(function, BaseModel):
+                return model_to_openai_function_schema(function)
+            return dict(convert_to_openai_tool(function)["function"])
+        except Exception as e:
+            logger.error(f"Error converting function to OpenAI function schema: {e}")
+            return {}
+
+
+# the nested functions given to the agents are redefined on every call, but their code objects are not, so the
+# schemas are kept by the code object and the docstring, the pydantic models are kept while they exist
+_function_schemas: dict[tuple, FunctionSchema] = {}
+_model_schemas = weakref.WeakKeyDictionary()
+
+
+def get_function_schema(function: Callable) -> FunctionSchema:
+    """
+    Get the compiled schemas of the function, compiled on the first call only
+    :param function: Function or pydantic model
+    :return: compiled schemas of the function
+    """
+    if isinstance(function, type):
+        if function not in _model_schemas:
+            _model_schemas[function] = FunctionSchema(function)
+        return _model_schemas[function]
+    code = getattr(function, '__code__', None)
+    if code is None:
+        return FunctionSchema(function)
+    key = (code, function.__doc__)
+    schema = _function_schemas.get(key)
+    if schema is None:
+        schema = _function_schemas[key] = FunctionSchema(function)
+    return schema
+
+
+def get_function_call_model(functions: list[Callable]) -> Type[BaseModel]:
+    """
+    Get the pydantic model of a call of one of the functions, the call is validated against the schema of the function
+    it names
+    :param functions: Functions to be chosen from, at least two
+    :return: model with the call of the chosen function in the call field
+    """
+    return _get_call_model(tuple(get_function_schema(f) for f in functions))
+
+
+@lru_cache(maxsize=256)
+def _get_call_model(schemas: tuple[FunctionSchema, ...]) -> Type[BaseModel]:
+    calls = tuple(s.call_model for s in schemas)
+    return create_model("FunctionCall", call=(Union[calls], Field(..., discriminator=FUNC_NAME)))
+
+
+def model_to_openai_function_schema(model: Type[BaseModel]) -> dict:
+    """
+    Convert the pydantic model to OpenAI function schema, with the nested models inlined
+    :param model: Pydantic model to be converted
+    :return: dictionary containing the function schema
+    """
+    schema = dereference_refs(model.model_json_schema())
+    schema.pop("$defs", None)
+    return {"name": schema.pop("title", model.__name__), "description": schema.pop("description", ""),
+            "parameters": schema}
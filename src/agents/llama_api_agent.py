@@ -2,4 +2,7 @@ from src.agents.api_agent import ApiAgent
 
 
 class LlamaApiAgent(ApiAgent):
-    pass
+    """API agent of the Llama API. The support of more tool calls in one response is not verified for the endpoint,
+    so the actions are chosen by the single function calls."""
+    # whether the model can call more functions in one response
+    parallel_tool_calls = False
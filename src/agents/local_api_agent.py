@@ -1,50 +1,125 @@
-import inspect
-from dataclasses import asdict
 import instructor
-from typing import Type, Callable
-from pydantic import BaseModel, create_model, Field
+from typing import Type, Callable, Optional
+from pydantic import BaseModel, Field
 import logging
 
 from src.agents.api_agent import ApiAgent
-from src.agents.constants import JSON_ERR, FUNC_NAME, CANT_CALL_ERR, FUNC_ERR
-from src.agents.message import Message, AssistantMessage, UserMessage, SystemMessage
+from src.agents.call_ledger import recorded, add_request
+from src.agents.constants import JSON_ERR, FUNC_NAME, FUNC_ERR, ONE_STEP_FUNCTION_CALL, \
+    LOCAL_JSON_CONSTRAINT
+from src.agents.function_schema import get_function_schema, get_function_call_model
+from src.agents.message import Message, SystemMessage
+from src.agents.response_cache import ResponseCache
+from src.agents.retry_policy import OutputError, RetryError
 
 logger = logging.getLogger(__name__)
 
+# instructor modes of the JSON constraints, the schema of the guided_json constraint is sent in the request body
+JSON_MODES = {'json_object': instructor.Mode.JSON, 'json_schema': instructor.Mode.JSON_SCHEMA,
+              'guided_json': instructor.Mode.JSON}
+
+
+class ChosenFunction(BaseModel):
+    """Chosen function to be called"""
+    function_name: str = Field(..., description="Name of one of the provided functions that was chosen to be called")
+
 
 class LocalApiAgent(ApiAgent):
+    """API agent of the models of a local OpenAI-compatible server. The JSON responses are requested through a client
+    patched by instructor once, the plain client is left unpatched. The requests and the responses are handled by the
+    methods shared with AsyncLocalApiAgent, the subclass only awaits the requests and the called functions."""
+    parallel_tool_calls = False
 
+    def __init__(self, url, api_key, model_name, one_step_call: bool = ONE_STEP_FUNCTION_CALL,
+                 json_constraint: str = LOCAL_JSON_CONSTRAINT, **kwargs):
+        """
+        Initialize the API agent
+        :param url: API url
+        :param api_key: API key for the service
+        :param model_name: Name of the model to be used
+        :param one_step_call: Whether the function is chosen with its arguments in one response, the function is
+        chosen and its arguments are requested in two responses only if the response is not valid
+        :param json_constraint: Constraint of the JSON responses supported by the server: json_object, json_schema
+        (llama.cpp server) or guided_json (vLLM), the responses of the schema constraints are valid by construction
+        :param kwargs: Other parameters of ApiAgent
+        """
+        if json_constraint not in JSON_MODES:
+            raise ValueError(f"Unknown JSON constraint: {json_constraint}, expected one of {list(JSON_MODES)}")
+        super().__init__(url, api_key, model_name, **kwargs)
+        self.one_step_call = one_step_call
+        self.json_constraint = json_constraint
+        self.instructor_client = instructor.patch(self._get_client(url, api_key), mode=JSON_MODES[json_constraint])
+
+    @recorded('json')
     def get_json_format_response(self, response_model: BaseModel, messages: list[Message] = None,
                                  max_retries=2) -> dict:
         """
         Get the response in desired JSON format
         :param response_model: Desired response model
         :param messages: List of messages to be sent to the model
-        :param max_retries: Number of retries
+        :param max_retries: Maximal number of attempts failing on the response of the model
         :return: dictionary containing the formatted response
         """
-        if messages:
-            self._add_messages_initially(messages)
-        messages = [asdict(m) for m in self.messages_storage]
-        client = instructor.patch(
-            self.client,
-            mode=instructor.Mode.JSON,
-        )
-        logger.info(f"Messages: {messages}")
-        response = client.chat.completions.create(
-            model=self.model_name,
-            messages=messages,
-            response_model=response_model,
-            max_retries=1
-        )
-        self._add_message(AssistantMessage(str(response)))
-        try:
-            return dict(response)
-        except Exception as e:
-            return self._handle_call_exception(e, JSON_ERR, max_retries - 1,
-                                               lambda: self.get_json_format_response(response_model,
-                                                                                     max_retries=max_retries - 1))
+        return self._run_with_retries(lambda request: self._get_json_response(response_model, request), max_retries,
+                                      JSON_ERR, {}, self._get_request(messages))
+
+    def _get_json_response(self, response_model: Type[BaseModel], messages: list[dict]) -> dict:
+        """
+        Get a single response of the model in the response model
+        :param response_model: Desired response model
+        :param messages: List of messages to be sent to the model
+        :return: dictionary containing the formatted response
+        """
+        return dict(self._get_cached_model_response(messages, response_model))
+
+    def _get_cached_model_response(self, messages: list[dict], response_model: Type[BaseModel]) -> BaseModel:
+        """
+        Get the response of the patched client in the response model, from the response cache if it is enabled. The
+        response is cached as a dictionary, as the response models are created at runtime.
+        :param messages: List of messages to be sent to the model
+        :param response_model: Desired response model
+        :return: response in the response model
+        """
+        key, request = self._get_model_request(messages, response_model)
+        cached = self._get_cached_model(key, response_model)
+        if cached is not None:
+            return cached
+        return self._add_model_response(key, self.instructor_client.chat.completions.create(**request))
+
+    def _get_model_request(self, messages: list[dict], response_model: Type[BaseModel]) -> tuple[str, dict]:
+        """
+        Get the request of the patched client, its messages are fitted into the token budget less the tokens of the
+        schema of the response model
+        :param messages: List of messages to be sent to the model
+        :param response_model: Desired response model
+        :return: cache key and parameters of the request
+        """
+        schema = response_model.model_json_schema()
+        messages = self._fit_messages(messages, self._count_schema_tokens(schema))
+        self._log_exchange("Messages", messages)
+        request = dict(model=self.model_name, messages=messages, response_model=response_model, max_retries=1,
+                       **self._get_constraint_params(response_model))
+        return ResponseCache.get_key(self.model_name, messages, response_model=schema), request
+
+    def _get_cached_model(self, key: str, response_model: Type[BaseModel]) -> Optional[BaseModel]:
+        """Returns the cached response in the response model, None if it is not cached or the cache is disabled."""
+        if not self.use_cache:
+            return None
+        cached = self.response_cache.get(key)
+        if cached is None:
+            return None
+        logger.info("Response taken from the cache")
+        add_request(cached=True)
+        return response_model.model_validate(cached)
+
+    def _add_model_response(self, key: str, response: BaseModel) -> BaseModel:
+        """Records the request of the response, the response is cached once the attempt of the request succeeds."""
+        add_request(self._get_usage(response))
+        if self.use_cache:
+            self._set_cached(key, response.model_dump())
+        return response
 
+    @recorded('function')
     def get_function_call(self, module: dict, functions: list, max_retries: int = 2,
                           messages: list[Message] = None):
         """
@@ -55,15 +130,10 @@ class LocalApiAgent(ApiAgent):
         :param max_retries: Number of retries
         :return: result of the called function
         """
-        try:
-            names_and_descriptions = [self._get_func_name_and_descr_dict(f) for f in functions]
-            name, model = self._get_func_name_and_model(module, functions, names_and_descriptions, max_retries,
-                                                        messages)
-        except Exception as e:
-            logger.error(f"Error choosing function and schema: {e}")
-            return
-        return self._end_func_call(messages, model, module, name, names_and_descriptions, max_retries)
+        names_and_descriptions = [self._get_func_name_and_descr_dict(f) for f in functions]
+        return self._get_chosen_function_call(module, functions, names_and_descriptions, max_retries, messages)
 
+    @recorded('function')
     def get_custom_descr_function_call(self, module: dict, functions: list[tuple[Callable, str]],
                                        max_retries: int = 2,
                                        messages: list[Message] = None):
@@ -76,24 +146,42 @@ class LocalApiAgent(ApiAgent):
         :param messages: List of messages to be sent to the model
         :return: result of the called function
         """
+        names_and_descriptions = [{FUNC_NAME: f.__name__, "description": descr} for f, descr in functions]
+        return self._get_chosen_function_call(module, [f for f, _ in functions], names_and_descriptions,
+                                              max_retries, messages)
+
+    @recorded('parallel')
+    def get_parallel_function_calls(self, module: dict, functions: list, max_retries: int = 2,
+                                    messages: list[Message] = None) -> list:
+        """
+        Get the results of the function calls of the model, the local models call a single function per response
+        :param module: Module containing the functions
+        :param functions: List of functions to be chosen from
+        :param max_retries: Number of retries
+        :param messages: List of messages to be sent to the model
+        :return: list with the result of the called function, empty list if no function was called
+        """
+        result = self.get_function_call(module, functions, max_retries, messages)
+        return [] if result is None else [result]
+
+    def _get_chosen_function_call(self, module, functions, names_and_descriptions, max_retries, messages):
+        if self.one_step_call and len(functions) > 1:
+            try:
+                return self._call_in_one_step(module, functions, names_and_descriptions, messages)
+            except RetryError as e:
+                logger.info(f"Error getting the function call in one step: {e}. Choosing the function first.")
         try:
-            names_and_descriptions = [{FUNC_NAME: f.__name__, "description": descr} for f, descr in functions]
-            name, model = self._get_func_name_and_model(module, [f for f, _ in functions], names_and_descriptions,
-                                                        max_retries, messages)
+            name, model = self._get_func_name_and_model(module, functions, names_and_descriptions, max_retries,
+                                                        messages)
         except Exception as e:
             logger.error(f"Error choosing function and schema: {e}")
             return
-        return self._end_func_call(messages, model, module, name, names_and_descriptions, max_retries)
-
-    def _end_func_call(self, messages, model, module, name, names_and_descriptions, max_retries):
-        chosen_descr = self._get_chosen_description(names_and_descriptions, name)
-        messages = self._get_messages_with_params_config(messages,
-                                                         self._get_function_params_dict(module[name]),
-                                                         chosen_descr)
+        messages = self._get_arguments_request(module, name, names_and_descriptions, messages)
         if self._get_function_parameters(module, name):
             return self._call_for_arguments(name, module, model, messages, max_retries)
-        return module[name]()
+        return self._call_parsed_function(module, name)
 
+    @recorded('forced')
     def get_forced_function_call(self, module: dict, function: Callable, max_retries: int = 2,
                                  messages: list[Message] = None):
         function_name = function.__name__
@@ -102,96 +190,103 @@ class LocalApiAgent(ApiAgent):
                                                          function.__doc__)
         if self._get_function_parameters(module, function_name):
             return self._call_for_arguments(function_name, module, function_schema, messages, max_retries)
-        return module[function_name]()
+        return self._call_parsed_function(module, function_name)
+
+    def _call_in_one_step(self, module, functions, names_and_descriptions, messages):
+        """
+        Get the chosen function with its arguments in one response, validated against the schema of the chosen
+        function, and return the result of the function
+        :raises RetryError: if the response is not valid or the function cannot be called with the arguments
+        """
+        call_model = get_function_call_model(functions)
+
+        def attempt(request: list[dict]):
+            name, arguments = self._parse_chosen_call(module, self._get_json_response(call_model, request))
+            return self._call_parsed_function(module, name, arguments)
+
+        request = self._get_one_step_request(module, functions, names_and_descriptions, messages)
+        return self.retry_policy.run(lambda _: self._run_cached_attempt(attempt, request), 1)
+
+    def _get_one_step_request(self, module, functions, names_and_descriptions, messages) -> list[dict]:
+        templates = {f.__name__: self._get_function_params_dict(module[f.__name__]) for f in functions}
+        config_message = SystemMessage(
+            f"You are a smart function calling assistant with access to the following functions: ```{names_and_descriptions}```. Your task is to choose one of the functions according to the descriptions and provide the {FUNC_NAME} of the chosen function with its arguments following its template {templates} according to the instructions."
+            f"Return valid JSON only as a response, no additional text.")
+        return self._get_request(messages + [config_message] if messages else [config_message])
+
+    def _parse_chosen_call(self, module: dict, response: dict) -> tuple[str, dict]:
+        """Returns the name of the chosen function and its arguments from the validated one-step response."""
+        arguments = dict(response["call"])
+        name = arguments.pop(FUNC_NAME)
+        if not self._does_function_exist(name, module):
+            raise OutputError(f"Got incorrect function name: {name}, function not found in the module")
+        return name, self._match_parameters(arguments, name, self._get_function_parameters(module, name))
 
     def _get_func_name_and_model(self, module, functions, names_and_descriptions, max_retries=1, messages=None):
+        name = functions[0].__name__
         if len(functions) > 1:
-            self._setup_messages(messages, names_and_descriptions)
-            try:
-                name = self._choose_from_functions(module, max_retries)
-                model = self._function_to_pydantic_model(module[name])
-            except Exception as e:
-                return self._handle_call_exception(e, FUNC_ERR, max_retries - 1,
-                                                   lambda: self._get_func_name_and_model(module, functions,
-                                                                                         max_retries - 1))
-        else:
-            name = functions[0].__name__
-            model = self._function_to_pydantic_model(functions[0])
-        return name, model
-
-    def _setup_messages(self, messages, names_and_descriptions):
-        if messages:
-            config_message = SystemMessage(
-                f"You are a helpful assistant with access to the following functions, your task is to choose one of the functions according to the descriptions: ```{names_and_descriptions}```."
-                f"Return valid JSON only as a response.")
-            self._add_messages_initially([config_message] + [self._get_first_user_message(messages)])
-
-    def _choose_from_functions(self, module, max_retires):
-
-        class ChosenFunction(BaseModel):
-            """Chosen function to be called"""
-            function_name: str = Field(...,
-                                       description="Name of one of the provided functions that was chosen to be called")
+            name = self._choose_from_functions(module, self._get_choice_request(messages, names_and_descriptions),
+                                               max_retries)
+        return name, self._function_to_pydantic_model(module[name])
 
-        try:
+    def _get_choice_request(self, messages, names_and_descriptions) -> list[dict]:
+        config_message = SystemMessage(
+            f"You are a helpful assistant with access to the following functions, your task is to choose one of the functions according to the descriptions: ```{names_and_descriptions}```."
+            f"Return valid JSON only as a response.")
+        return self._get_request([config_message, self._get_first_user_message(messages or [])])
 
-            response = self.get_json_format_response(ChosenFunction, self.messages_storage)
-            self._add_message(AssistantMessage(str(response)))
-            function_name = response[FUNC_NAME]
-            if not self._does_function_exist(function_name, module):
-                error_msg = f"Got incorrect function name: {function_name}, function not found in the module. Retry."
-                return self._handle_call_exception("", error_msg, max_retires - 1,
-                                                   lambda: self._choose_from_functions(module, max_retires - 1))
-        except RecursionError as e:
-            logger.error(f"RecError: {e}")
-            return
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            return
+    def _choose_from_functions(self, module, request, max_retries):
+        return self._run_with_retries(lambda messages: self._get_chosen_name(
+            module, self._get_json_response(ChosenFunction, messages)), max_retries, FUNC_ERR, None, request)
+
+    def _get_chosen_name(self, module: dict, response: dict) -> str:
+        """Returns the name of the function chosen in the response.
+        :raises OutputError: if the function is not in the module"""
+        function_name = response[FUNC_NAME]
+        if not self._does_function_exist(function_name, module):
+            raise OutputError(f"Got incorrect function name: {function_name}, function not found in the module")
         return function_name
 
+    def _get_constraint_params(self, response_model: Type[BaseModel]) -> dict:
+        """Returns the parameters of the request constraining the response to the schema of the response model, the
+        json_object and json_schema constraints are set by the mode of the patched client."""
+        if self.json_constraint == 'guided_json':
+            return {'extra_body': {'guided_json': response_model.model_json_schema()}}
+        return {}
+
+    @staticmethod
+    def _get_usage(response: BaseModel):
+        """Returns the usage of the completion the response of the patched client was parsed from."""
+        return getattr(getattr(response, '_raw_response', None), 'usage', None)
+
     @staticmethod
     def _function_to_pydantic_model(function: Callable) -> Type[BaseModel]:
         """
         Takes a function and returns a Pydantic BaseModel class constructed
         from the function's parameters, assuming all parameters are required
-        and of type str if not annotated.
+        and of type str if not annotated. The model is created once per function.
         """
-
-        params = inspect.signature(function).parameters
-        fields = {
-            name: (
-                param.annotation if param.annotation is not inspect.Parameter.empty else 'str', ...)
-            for name, param in params.items()
-        }
-        return create_model(function.__name__, **fields)
+        return get_function_schema(function).pydantic_model
 
     def _call_for_arguments(self, function_name, module, function_schema, messages=None, max_retries=2):
-        """Get the arguments for the function call"""
+        """Get the arguments for the function call and return the result of the function"""
 
-        if messages:
-            self._add_messages_initially(messages)
-        try:
-            response = self.get_json_format_response(function_schema, self.messages_storage, max_retries=max_retries)
-            return self._handle_json_call_return(function_name, function_schema, max_retries, module, response)
-        except Exception as e:
-            return self._handle_call_exception(e, JSON_ERR, max_retries - 1,
-                                               lambda: self._call_for_arguments(function_name, module, function_schema,
-                                                                                max_retries=max_retries - 1))
+        def attempt(request: list[dict]):
+            arguments = self._get_arguments(module, function_name, self._get_json_response(function_schema, request))
+            return self._call_parsed_function(module, function_name, arguments)
 
-    def _handle_json_call_return(self, function_name, function_schema, max_retries, module, response):
-        """Handle the return of the response JSON format"""
-        try:
-            arguments = self._match_parameters(response, function_name,
-                                               self._get_function_parameters(module, function_name))
-            if arguments:
-                return module[function_name](**arguments)
-            return module[function_name]()
-        except Exception as e:
-            logger.error(f"{CANT_CALL_ERR}{function_name}: {e}")
-            self._add_message(UserMessage(f"{CANT_CALL_ERR}{function_name}: {e}. Retry."))
-            return self._call_for_arguments(function_name, module, function_schema,
-                                            max_retries=max_retries - 1)
+        return self._run_with_retries(attempt, max_retries, JSON_ERR, None, self._get_request(messages))
+
+    def _get_arguments(self, module: dict, function_name: str, response: dict) -> dict:
+        """Returns the arguments of the function from the response.
+        :raises OutputError: if a required argument is missing"""
+        return self._match_parameters(response, function_name, self._get_function_parameters(module, function_name))
+
+    def _get_arguments_request(self, module: dict, name: str, names_and_descriptions: list[dict],
+                               messages: list[Message] = None) -> list[Message]:
+        """Returns the messages of the request of the arguments of the chosen function."""
+        return self._get_messages_with_params_config(messages, self._get_function_params_dict(module[name]),
+                                                     self._get_chosen_description(names_and_descriptions, name))
 
     @staticmethod
     def _get_messages_with_params_config(messages, parameters, description=None):
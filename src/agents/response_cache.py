@@ -0,0 +1,70 @@
+import hashlib
+import json
+import threading
+from functools import lru_cache
+
+from diskcache import Cache
+
+from src.agents.constants import LLM_CACHE_FOLDER, LLM_CACHE_SIZE_LIMIT
+
+
+class ResponseCache:
+    """Disk cache of the model responses. The responses are stored under the hash of the model name, the normalised
+    messages and the other request parameters (such as the function schemas), the least recently used ones are evicted
+    when the cache grows over the size limit. The cache can be shared by more agents and processes."""
+
+    def __init__(self, directory: str = LLM_CACHE_FOLDER, size_limit: int = LLM_CACHE_SIZE_LIMIT):
+        """
+        :param directory: Directory of the cache
+        :param size_limit: Maximal size of the cache in bytes
+        """
+        self.cache = Cache(directory, size_limit=size_limit, eviction_policy='least-recently-used')
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        """Returns the cached response of the key, None if it is not cached."""
+        response = self.cache.get(key)
+        with self.lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def set(self, key: str, response):
+        self.cache.set(key, response)
+
+    def get_stats(self) -> dict:
+        """Returns the hits and misses of this process and the size of the cache."""
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / requests, 3) if requests else None,
+                'entries': len(self.cache), 'size_bytes': self.cache.volume()}
+
+    def clear(self):
+        self.cache.clear()
+
+    def close(self):
+        self.cache.close()
+
+    @staticmethod
+    def get_key(model_name: str, messages: list[dict], **params) -> str:
+        """
+        Returns the key of the request.
+        :param model_name: Name of the model
+        :param messages: Messages of the request, only their roles and stripped contents are used
+        :param params: Other parameters of the request, such as the function schemas or the response model schema
+        :return: sha256 hash of the request
+        """
+        normalised = [{'role': m['role'], 'content': ' '.join(str(m['content']).split())} for m in messages]
+        request = json.dumps({'model': model_name, 'messages': normalised, **params}, sort_keys=True,
+                             ensure_ascii=False, default=str)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_response_cache(directory: str = LLM_CACHE_FOLDER) -> ResponseCache:
+    """Returns the response cache of the directory, opened once per process."""
+    return ResponseCache(directory)
@@ -0,0 +1,146 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import openai
+
+from src.agents.constants import RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_MAX_TOTAL_TIME
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+class OutputError(Exception):
+    """The response of the model can not be used, the request is retried with the error as a correction message."""
+
+
+class RetryError(Exception):
+    """All the attempts of the request failed, or the error can not be fixed by retrying."""
+
+    def __init__(self, message: str, last_error: Exception = None):
+        super().__init__(message)
+        self.last_error = last_error
+
+
+class RetryPolicy:
+    """Iterative retry policy of the model requests. The transient API errors (connection errors, timeouts, rate
+    limits and server errors) are retried with an exponential backoff with full jitter, or after the time given by
+    the Retry-After header. The other errors are retried immediately with a correction message, except for the API
+    errors that retrying does not fix (such as authentication errors), which end the retries at once. Both the
+    number of attempts and the total time are capped."""
+
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY, max_total_time: float = RETRY_MAX_TOTAL_TIME):
+        """
+        :param max_attempts: Maximal number of attempts of a request, including the retries of the transient errors
+        :param base_delay: Delay before the first retry of a transient error in seconds, doubled with every retry
+        :param max_delay: Maximal delay between two attempts in seconds
+        :param max_total_time: Maximal time spent on a request including the delays in seconds
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total_time = max_total_time
+
+    def run(self, attempt: Callable[[Optional[str]], Any], max_corrections: int = None) -> Any:
+        """
+        Runs the attempts of a request until one of them succeeds.
+        :param attempt: Function making one attempt, it is given the correction message of the previous failed
+        attempt (None for the first attempt) and returns the result or raises an error
+        :param max_corrections: Maximal number of attempts failing on the output of the model, max_attempts by default
+        :return: result of the first successful attempt
+        :raises RetryError: if no attempt succeeded
+        """
+        start = time.monotonic()
+        correction = None
+        corrections = 0
+        for number in range(1, self.max_attempts + 1):
+            try:
+                return attempt(correction)
+            except Exception as e:
+                delay, correction, corrections = self._handle_error(e, number, start, correction, corrections,
+                                                                    max_corrections)
+                if delay:
+                    time.sleep(delay)
+        raise RetryError(f"Max attempts ({self.max_attempts}) reached")
+
+    async def arun(self, attempt: Callable[[Optional[str]], Awaitable[Any]], max_corrections: int = None) -> Any:
+        """Asynchronous variant of run, the attempt function returns an awaitable."""
+        start = time.monotonic()
+        correction = None
+        corrections = 0
+        for number in range(1, self.max_attempts + 1):
+            try:
+                return await attempt(correction)
+            except Exception as e:
+                delay, correction, corrections = self._handle_error(e, number, start, correction, corrections,
+                                                                    max_corrections)
+                if delay:
+                    await asyncio.sleep(delay)
+        raise RetryError(f"Max attempts ({self.max_attempts}) reached")
+
+    def _handle_error(self, error: Exception, number: int, start: float, correction: Optional[str],
+                      corrections: int, max_corrections: int = None) -> tuple[float, Optional[str], int]:
+        """
+        Decides how the failed attempt is retried.
+        :return: delay before the next attempt, correction message of the next attempt, number of the corrections
+        :raises RetryError: if the request should not be retried
+        """
+        if self.is_retryable(error):
+            delay = self.get_delay(number, error)
+            if time.monotonic() - start + delay > self.max_total_time:
+                raise RetryError(f"Max total time ({self.max_total_time} s) reached: {error}", error) from error
+            logger.warning(f"Attempt {number} failed: {error}. Retrying in {delay:.1f} s")
+            return delay, correction, corrections
+        if isinstance(error, openai.APIError):
+            raise RetryError(f"Not retryable: {error}", error) from error
+        corrections += 1
+        if corrections >= (max_corrections or self.max_attempts):
+            raise RetryError(f"Max corrections reached: {error}", error) from error
+        if time.monotonic() - start > self.max_total_time:
+            raise RetryError(f"Max total time ({self.max_total_time} s) reached: {error}", error) from error
+        logger.warning(f"Attempt {number} failed: {error}. Retrying with correction")
+        return 0, str(error), corrections
+
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        """Tells if the error is transient, so the same request may succeed later."""
+        if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+        return False
+
+    def get_delay(self, number: int, error: Exception = None) -> float:
+        """Returns the delay before the next attempt after the given number of attempts, the time given by the
+        Retry-After header of the error if present (even over max_delay, the total time cap still applies), otherwise
+        the exponential backoff with full jitter."""
+        retry_after = self.get_retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (number - 1)))
+
+    @staticmethod
+    def get_retry_after(error: Exception) -> Optional[float]:
+        """Returns the delay in seconds requested by the retry-after-ms or Retry-After header of the error response."""
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000
+            retry_after = headers.get('retry-after')
+            if retry_after is None:
+                return None
+            try:
+                return max(float(retry_after), 0)
+            except ValueError:
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                return max(retry_date.timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
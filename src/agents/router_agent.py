@@ -0,0 +1,244 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterator, Optional
+
+from pydantic import BaseModel
+
+from src.agents.api_agent import ApiAgent
+from src.agents.constants import MAX_CONCURRENT_REQUESTS, ROUTER_WINDOW, ROUTER_EXPLORE_RATE, ROUTER_HEDGE, \
+    ROUTER_HEDGE_PERCENTILE, ROUTER_HEDGE_DELAY, ROUTER_MIN_SAMPLES
+from src.agents.message import Message
+from src.agents.token_counter import TokenCounter
+
+logger = logging.getLogger(__name__)
+
+
+class BackendStats:
+    """Rolling latencies and errors of the last calls of a backend. The latency of a call is the time to its result,
+    the time to the first token for the streamed answers."""
+
+    def __init__(self, window: int = ROUTER_WINDOW):
+        """
+        :param window: Number of the last calls kept
+        """
+        self.latencies = deque(maxlen=window)
+        self.errors = deque(maxlen=window)
+        self.in_flight = 0
+
+    def add(self, latency: float, failed: bool):
+        self.latencies.append(latency)
+        self.errors.append(failed)
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.errors) / len(self.errors) if self.errors else 0.0
+
+    def get_latency(self, percentile: float) -> Optional[float]:
+        """Returns the percentile of the latencies, None if there are no calls."""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(percentile * len(latencies)), len(latencies) - 1)]
+
+    def get_score(self) -> float:
+        """Returns the expected latency of the next call, the lower the better: the median latency raised by the calls
+        in flight and by the error rate. A backend without calls scores zero, so it is tried first."""
+        if not self.latencies:
+            return 0.0
+        return self.get_latency(0.5) * (1 + self.in_flight) / max(1 - self.error_rate, 0.05)
+
+
+class RouterAgent:
+    """Agent routing every call to the healthiest of its backends by their rolling latencies and error rates. The
+    answers (base and streamed responses) can be hedged: if the best backend does not respond until the percentile of
+    its latencies, the second best one gets the same request, the first successful response is used and the other
+    request is cancelled. A call raising an error is passed to the next backend.
+
+    The backends are synchronous agents, the hedged requests run in a thread pool. A streamed request that loses is
+    closed once its first token arrives, a base request that already started is left to finish and its response is
+    dropped."""
+
+    def __init__(self, backends: list[ApiAgent], hedge: bool = ROUTER_HEDGE,
+                 hedge_percentile: float = ROUTER_HEDGE_PERCENTILE, hedge_delay: float = ROUTER_HEDGE_DELAY,
+                 window: int = ROUTER_WINDOW, explore_rate: float = ROUTER_EXPLORE_RATE,
+                 max_concurrency: int = MAX_CONCURRENT_REQUESTS):
+        """
+        Initialize the router agent
+        :param backends: Agents the calls are routed to
+        :param hedge: Whether the answers are hedged
+        :param hedge_percentile: Percentile of the latencies of the backend after which the answer is hedged
+        :param hedge_delay: Delay after which the answer is hedged while the backend has too few calls, in seconds
+        :param window: Number of the last calls of a backend the latency and the error rate are taken from
+        :param explore_rate: Share of the calls sent to a random backend
+        :param max_concurrency: Maximal number of the hedged requests running at once
+        """
+        if not backends:
+            raise ValueError("The router agent needs at least one backend")
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.explore_rate = explore_rate
+        self.stats = [BackendStats(window) for _ in backends]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='router')
+
+    @property
+    def model_name(self) -> str:
+        return f"router({', '.join(b.model_name for b in self.backends)})"
+
+    @property
+    def parallel_tool_calls(self) -> bool:
+        return all(b.parallel_tool_calls for b in self.backends)
+
+    @property
+    def chunk_tokens(self) -> int:
+        return min(b.chunk_tokens for b in self.backends)
+
+    @property
+    def token_counter(self) -> TokenCounter:
+        return self.backends[0].token_counter
+
+    def get_base_response(self, messages: list[dict]):
+        """Get the response from the model without function calling, hedged if enabled"""
+        def call(agent: ApiAgent):
+            return agent.get_base_response(messages)
+
+        if not self.hedge:
+            return self._route(call)
+        response, losers = self._get_hedged(lambda index: self._run(index, call))
+        for future in losers:
+            future.cancel()
+        return response
+
+    def get_streamed_response(self, messages: list[dict]) -> Iterator[str]:
+        """Get the response from the model without function calling, streamed as the parts of its text. The request
+        is sent once the iteration starts and it is hedged on the time to the first token if enabled."""
+        if not self.hedge:
+            stream, first = self._route(lambda agent: self._start_stream(agent, messages), True)
+        else:
+            (stream, first), losers = self._get_hedged(
+                lambda i: self._run(i, lambda agent: self._start_stream(agent, messages), True), True)
+            for future in losers:
+                if not future.cancel():
+                    future.add_done_callback(self._close_stream)
+        if first is None:
+            return
+        yield first
+        yield from stream
+
+    def get_function_call(self, module: dict, functions: list, max_retries: int = 3,
+                          messages: list[Message] = None):
+        return self._route(lambda agent: agent.get_function_call(module, functions, max_retries, messages))
+
+    def get_custom_descr_function_call(self, module: dict, functions: list, max_retries: int = 3,
+                                       messages: list[Message] = None):
+        return self._route(lambda agent: agent.get_custom_descr_function_call(module, functions, max_retries,
+                                                                              messages))
+
+    def get_forced_function_call(self, module: dict, function: Callable, max_retries: int = 3,
+                                 messages: list[Message] = None):
+        return self._route(lambda agent: agent.get_forced_function_call(module, function, max_retries, messages))
+
+    def get_parallel_function_calls(self, module: dict, functions: list, max_retries: int = 3,
+                                    messages: list[Message] = None) -> list:
+        return self._route(lambda agent: agent.get_parallel_function_calls(module, functions, max_retries, messages))
+
+    def get_json_format_response(self, response_model: BaseModel, messages: list[Message] = None,
+                                 max_retries=3) -> dict:
+        return self._route(lambda agent: agent.get_json_format_response(response_model, messages, max_retries))
+
+    def _route(self, call: Callable[[ApiAgent], object], stream: bool = False):
+        """
+        Make the call on the best backend, on the next ones if it raises an error
+        :param call: Function making the call on the given agent
+        :param stream: Whether the result is a started stream
+        :return: result of the call
+        """
+        ranked = self._get_ranked()
+        for number, index in enumerate(ranked):
+            try:
+                return self._run(index, call, stream)
+            except Exception as e:
+                if number == len(ranked) - 1:
+                    raise
+                logger.warning(f"Call of {self.backends[index].model_name} failed: {e}. Routing to the next backend.")
+
+    def _run(self, index: int, call: Callable[[ApiAgent], object], stream: bool = False):
+        """Make the call on the backend of the index, its latency and outcome are added to the stats of the backend."""
+        stats = self.stats[index]
+        with self._lock:
+            stats.in_flight += 1
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = call(self.backends[index])
+            failed = self._is_failed(result[1] if stream else result)
+            return result
+        finally:
+            with self._lock:
+                stats.in_flight -= 1
+                stats.add(time.perf_counter() - start, failed)
+
+    def _get_hedged(self, run: Callable[[int], object], stream: bool = False) -> tuple[object, list[Future]]:
+        """
+        Run the call on the best backend, on the second best one too if the first does not succeed until the hedge
+        deadline
+        :param run: Function running the call on the backend of the given index
+        :param stream: Whether the results are started streams
+        :return: first successful result, the result of the first call if none succeeded, and the futures of the calls
+        that lost
+        """
+        ranked = self._get_ranked()
+        futures = [self._executor.submit(run, ranked[0])]
+        done, _ = wait(futures, timeout=self._get_hedge_deadline(ranked[0]))
+        if len(ranked) > 1 and (not done or self._has_failed(futures[0], stream)):
+            logger.info(f"Hedging the call of {self.backends[ranked[0]].model_name} with "
+                        f"{self.backends[ranked[1]].model_name}")
+            futures.append(self._executor.submit(run, ranked[1]))
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if not self._has_failed(future, stream):
+                    return future.result(), [f for f in futures if f is not future]
+        return futures[0].result(), futures[1:]
+
+    def _get_hedge_deadline(self, index: int) -> float:
+        stats = self.stats[index]
+        if len(stats.latencies) < ROUTER_MIN_SAMPLES:
+            return self.hedge_delay
+        return stats.get_latency(self.hedge_percentile)
+
+    def _get_ranked(self) -> list[int]:
+        """Returns the indexes of the backends from the healthiest one, a random one goes first by the explore rate."""
+        with self._lock:
+            ranked = sorted(range(len(self.backends)), key=lambda i: self.stats[i].get_score())
+        if len(ranked) > 1 and random.random() < self.explore_rate:
+            ranked.insert(0, ranked.pop(random.randrange(len(ranked))))
+        return ranked
+
+    def _has_failed(self, future: Future, stream: bool = False) -> bool:
+        if future.exception() is not None:
+            return True
+        return self._is_failed(future.result()[1] if stream else future.result())
+
+    @staticmethod
+    def _is_failed(result) -> bool:
+        """The agents return None or an empty dictionary when no attempt of the call succeeded."""
+        return result is None or result == {}
+
+    @staticmethod
+    def _start_stream(agent: ApiAgent, messages: list[dict]) -> tuple[Iterator[str], Optional[str]]:
+        """Returns the stream of the agent with its first part, None if the stream is empty."""
+        stream = agent.get_streamed_response(messages)
+        return stream, next(stream, None)
+
+    @staticmethod
+    def _close_stream(future: Future):
+        if not future.cancelled() and future.exception() is None:
+            future.result()[0].close()
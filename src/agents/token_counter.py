@@ -0,0 +1,76 @@
+import logging
+from functools import lru_cache
+from typing import Callable, Optional
+
+import tiktoken
+
+from src.agents.constants import DEFAULT_ENCODING
+from src.data_acquisition.constants import CHARS_PER_TOKEN
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCounter:
+    """Counts the tokens of a text with the tokenizer of a model. The tiktoken encoding of the model is used, the
+    models unknown to tiktoken (such as the local ones) use the default encoding, or the given tokenizer of the backend.
+    When no encoding can be loaded (for example offline, before the encoding files are cached), the tokens are
+    estimated from the length of the text."""
+
+    def __init__(self, model_name: str = None, tokenizer: Callable[[str], list] = None):
+        """
+        :param model_name: Name of the model whose tokenizer is used
+        :param tokenizer: Tokenizer of the backend returning the tokens of a text, used instead of tiktoken
+        """
+        self.model_name = model_name
+        self.tokenizer = tokenizer
+        if self.tokenizer is None:
+            encoding = get_encoding(model_name)
+            self.tokenizer = encoding.encode if encoding else None
+        self.name = 'tokens' if self.tokenizer else 'estimated_tokens'
+
+    def __call__(self, text: str) -> int:
+        return self.count(text)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.tokenizer is None:
+            return len(text) // CHARS_PER_TOKEN + 1
+        return len(self.tokenizer(text))
+
+    def __repr__(self):
+        return f"{self.name}:{self.model_name}"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str = None) -> Optional[tiktoken.Encoding]:
+    """Returns the tiktoken encoding of the model, the default encoding for the unknown models, None if it can not be
+    loaded."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning(f"Could not load the tiktoken encoding of {model_name}, estimating the tokens: {e}")
+        return None
+
+
+def get_prefix_length(text: str, max_size: int, length_function: Callable[[str], int] = len) -> int:
+    """
+    Returns the number of characters of the longest prefix of the text whose size is at most max_size.
+    :param text: Text to be measured
+    :param max_size: Maximal size of the prefix in the units of the length function
+    :param length_function: Function measuring the size of a text, such as len or a TokenCounter
+    :return: Number of characters of the prefix
+    """
+    if length_function is len:
+        return min(len(text), max_size)
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if length_function(text[:middle]) <= max_size:
+            low = middle
+        else:
+            high = middle - 1
+    return low
@@ -1,9 +1,12 @@
 import os
 from configparser import ConfigParser
 
+from src.agents.async_local_api_agent import AsyncLocalApiAgent
+from src.agents.async_openai_api_agent import AsyncOpenAIApiAgent
 from src.agents.llama_api_agent import LlamaApiAgent
 from src.agents.local_api_agent import LocalApiAgent
 from src.agents.openai_api_agent import OpenAIApiAgent
+from src.agents.router_agent import RouterAgent
 from src.constants import CONSTANTS_CONFIG_PATH
 
 _config = ConfigParser()
@@ -25,8 +28,36 @@ MIXTRAL = "mixtral"
 GPT_3 = "gpt-4-turbo"  # "gpt-3.5-turbo-1106"  # "gpt-3.5-turbo-0125" seems to have issues lately
 LLAMA3_70_API = "llama3-70b"
 
-LLAMA3_70_AGENT = LocalApiAgent(LOCAL_URL, LOCAL_KEY, LLAMA3_70)
-LLAMA3_8_AGENT = LocalApiAgent(LOCAL_URL, LOCAL_KEY, LLAMA3_8)
-MIXTRAL_AGENT = LocalApiAgent(LOCAL_URL, LOCAL_KEY, MIXTRAL)
-GPT_3_AGENT = OpenAIApiAgent(OPENAI_URL, OPENAI_KEY, GPT_3)
-LLAMA3_70_API_AGENT = LlamaApiAgent(LLAMA_URL, LLAMA_KEY, LLAMA3_70)
+# target chunk sizes in tokens, the local models run with a small context window
+GPT_3_CHUNK_TOKENS = 1500
+LOCAL_CHUNK_TOKENS = 700
+# token budgets of the messages sent to the models, the rest of the context window is left for the output
+GPT_3_CONTEXT_TOKENS = 12000
+LOCAL_CONTEXT_TOKENS = 3000
+# requests in flight at once per async agent of the local inference server
+LOCAL_MAX_CONCURRENCY = 32
+
+LLAMA3_70_AGENT = LocalApiAgent(LOCAL_URL, LOCAL_KEY, LLAMA3_70, chunk_tokens=LOCAL_CHUNK_TOKENS,
+                                context_tokens=LOCAL_CONTEXT_TOKENS)
+LLAMA3_8_AGENT = LocalApiAgent(LOCAL_URL, LOCAL_KEY, LLAMA3_8, chunk_tokens=LOCAL_CHUNK_TOKENS,
+                               context_tokens=LOCAL_CONTEXT_TOKENS)
+MIXTRAL_AGENT = LocalApiAgent(LOCAL_URL, LOCAL_KEY, MIXTRAL, chunk_tokens=LOCAL_CHUNK_TOKENS,
+                              context_tokens=LOCAL_CONTEXT_TOKENS)
+GPT_3_AGENT = OpenAIApiAgent(OPENAI_URL, OPENAI_KEY, GPT_3, chunk_tokens=GPT_3_CHUNK_TOKENS,
+                             context_tokens=GPT_3_CONTEXT_TOKENS)
+LLAMA3_70_API_AGENT = LlamaApiAgent(LLAMA_URL, LLAMA_KEY, LLAMA3_70, chunk_tokens=LOCAL_CHUNK_TOKENS,
+                                    context_tokens=LOCAL_CONTEXT_TOKENS)
+# calls routed to the faster of the local server and OpenAI, the answers are hedged
+ROUTER_AGENT = RouterAgent([LLAMA3_70_AGENT, GPT_3_AGENT])
+
+ASYNC_LLAMA3_70_AGENT = AsyncLocalApiAgent(LOCAL_URL, LOCAL_KEY, LLAMA3_70, chunk_tokens=LOCAL_CHUNK_TOKENS,
+                                           context_tokens=LOCAL_CONTEXT_TOKENS,
+                                           max_concurrency=LOCAL_MAX_CONCURRENCY)
+ASYNC_LLAMA3_8_AGENT = AsyncLocalApiAgent(LOCAL_URL, LOCAL_KEY, LLAMA3_8, chunk_tokens=LOCAL_CHUNK_TOKENS,
+                                          context_tokens=LOCAL_CONTEXT_TOKENS,
+                                          max_concurrency=LOCAL_MAX_CONCURRENCY)
+ASYNC_MIXTRAL_AGENT = AsyncLocalApiAgent(LOCAL_URL, LOCAL_KEY, MIXTRAL, chunk_tokens=LOCAL_CHUNK_TOKENS,
+                                         context_tokens=LOCAL_CONTEXT_TOKENS,
+                                         max_concurrency=LOCAL_MAX_CONCURRENCY)
+ASYNC_GPT_3_AGENT = AsyncOpenAIApiAgent(OPENAI_URL, OPENAI_KEY, GPT_3, chunk_tokens=GPT_3_CHUNK_TOKENS,
+                                        context_tokens=GPT_3_CONTEXT_TOKENS)
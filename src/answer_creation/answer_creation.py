@@ -1,5 +1,7 @@
+import itertools
 import json
 import logging
+from typing import Iterator, Optional
 
 from src.agents.message import SystemMessage, UserMessage, message_from_dict
 from src.constants import WEEKDAY, TODAY, TOMORROW
@@ -30,7 +32,25 @@ def answer(data, agent, messages):
     return agent.get_forced_function_call(locals(), build_answer, messages=messages)
 
 
-def eval_answer_data(agent, query, received_data, messages):
+def answer_stream(data, agent, messages):
+    """Stream the answer in plain text, the sources are listed at its end instead of the build_answer function call."""
+    return agent.get_streamed_response(messages + [get_answer_config(data)])
+
+
+def start_stream(stream: Iterator[str]) -> Optional[Iterator[str]]:
+    """Returns the stream starting with its first part, which is already received, None if the stream is empty."""
+    first = next(stream, None)
+    if not first:
+        return None
+    return itertools.chain([first], stream)
+
+
+def get_answer_config(data) -> dict:
+    return SystemMessage(
+        f"""You are a response building agent. Your task is to analyze user's last query and create answer using provided information if relevant. Adapt to chat history.  If the user asks por event with a set time, double-check that you are using only the data that fit the time requirements. Today is {WEEKDAY} {TODAY}. Here is the information to use for answering user's query: ```{data}```. Add list of used sources, response format: 'Response text. [<source(s)>]'.""").as_dict()
+
+
+def eval_answer_data(agent, query, received_data, messages, stream=False):
     try:
         if not received_data:
             received_data = search_internet(query)
@@ -53,30 +73,80 @@ def eval_answer_data(agent, query, received_data, messages):
         UserMessage(query)]
 
     data = agent.get_function_call(locals(), [get_more_data, create_answer], messages=config_messages)
+    if stream:
+        started = start_stream(answer_stream(data or received_data, agent, messages))
+        if started is not None:
+            return started
+        logger.warning("The answer stream is empty, answering without streaming")
     response = answer(data, agent, messages) if data else answer(received_data, agent, messages)
-    if len(response) > 10:
+    if response and len(response) > 10:
         return response
     while not response or len(response) < 10:
-        cfg = SystemMessage(
-            f"""You are a response building agent. Your task is to analyze user's last query and create answer using provided information if relevant. Adapt to chat history.  If the user asks por event with a set time, double-check that you are using only the data that fit the time requirements. Today is {WEEKDAY} {TODAY}. Here is the information to use for answering user's query: ```{data}```. Add list of used sources, response format: 'Response text. [<source(s)>]'.""").as_dict()
         call_messages = messages.copy()
-        call_messages.append(cfg)
+        call_messages.append(get_answer_config(data))
         response = agent.get_base_response(call_messages).choices[0].message.content
     return response
 
 
-def choose_action(agent, query, messages, vec_db):
-    def needs_event_infos():
-        """Call this function when the user wants to get information about cultural events like festivals, exhibitions, theatrical plays, e.g. "What to do this week?" or "Is something happening tomorrow in the city centre?", "Tell me about Mucha exhibition", or "I would love to go to theatre today."""
-        msg = SystemMessage(f"""You are a function calling agent. Your task is to make valid function call to provided function with arguments following this description:
-:param transformed_query: str - Transform the user question to an understandable keyword-based question not containing the time indication: "What to do this week?" -> "Events", "Is something happening tomorrow in the city centre?" -> "Events in the city centre", "I would love to go to theatre today." -> "Theatre".  Translate to englih if not english.
+BASE_INFO_INSTRUCTIONS = """:param transformed_query: str - Transform the user question to an understandable keyword-based query: "What is the address of the city hall?" -> "City hall address", "What are the opening hours of the zoo?" -> "Zoo opening hours", "How to get a tram ticket?" -> "Tram ticket"."""
+
+
+def get_event_info_instructions() -> str:
+    return f""":param transformed_query: str - Transform the user question to an understandable keyword-based question not containing the time indication: "What to do this week?" -> "Events", "Is something happening tomorrow in the city centre?" -> "Events in the city centre", "I would love to go to theatre today." -> "Theatre".  Translate to englih if not english.
 :param dates: list[str] - Today is {WEEKDAY} {TODAY}: Return list of dates that suit the user's query, provide each date in the format YYYY-MM-DD, following these instructions:
  a) If the user asks for today, return today's date: ['{TODAY}'], same with tomorrow: ['{TOMORROW}']. 
  b) If the user asks for events this weekend, return: {get_this_weekend_dates()} For next weekend, return list with computed dates of friday, saturday and sunday.
  c) If the user asks for a specific day of the week, compute it from today's date and return in requested format. 
  d) If the user asks for a whole month, return the date as YYYY-MM, for example for May 2024 return ['2024-05'].
  e) If the user asks for events next week, return list of dates of all days next week. The week starts on Monday.
- f) If the user asks about a certain event and does not specify time, return [''], make sure the empty string is included.
+ f) If the user asks about a certain event and does not specify time, return [''], make sure the empty string is included."""
+
+
+def choose_action_in_one_step(agent, query, messages, vec_db, stream=False):
+    """Choose the action and get the arguments of the data retrieval in a single response of the model. The events
+    and the base information can be retrieved at once by parallel function calls. The retrieved data are taken from
+    the results of the calls of the successful attempt, so a retried attempt does not answer from stale data."""
+
+    def get_event_info(transformed_query: str, dates: list):
+        """Call this function when the user wants to get information about cultural events like festivals, exhibitions, theatrical plays, e.g. "What to do this week?" or "Is something happening tomorrow in the city centre?", "Tell me about Mucha exhibition", or "I would love to go to theatre today." Transform the user question to an understandable keyword-based query that is more suitable for vector database hybrid search, retrieve the dates."""
+        if len(dates) < 1 or dates[0] == '':
+            dates = None
+        data = vec_db.hybrid_query_event(transformed_query, dates)
+        if not data and dates is None:
+            data = vec_db.hybrid_query_event(query)
+        return data
+
+    def get_base_info(transformed_query: str):
+        """Call this function when the user asks questions about anything that can not be a cultural event, like places (sights, restaurants or galleries etc.), administration or just Brno city in general, famous personalities that might be connected to the city ...,  e.g. "What is the address of the city hall?" or "What are the opening hours of the zoo?", "Where to get coffee?" or "How to get a tram ticket?" Transform the user question to an understandable keyword-based query that is more suitable for vector database hybrid search."""
+        return vec_db.hybrid_query_base(transformed_query) or vec_db.hybrid_query_base(query)
+
+    def answer_without_data():
+        """Call this function when the user does not ask a question e.g. "Hello I'm Kate" or "Tell me a joke." or asks a question you are sure is not relevant to Brno city."""
+        if stream:
+            return agent.get_streamed_response(messages)
+        return agent.get_base_response(messages).choices[0].message.content
+
+    config_msg = f"""Your task is to call functions based on user's message. If the user asks both about cultural events and other information, call both 'get_event_info' and 'get_base_info'. Provide the arguments following this description:
+get_event_info {get_event_info_instructions()}
+get_base_info {BASE_INFO_INSTRUCTIONS}"""
+
+    results = agent.get_parallel_function_calls(locals(), [get_event_info, get_base_info, answer_without_data],
+                                                messages=[SystemMessage(config_msg), UserMessage(query)])
+    # the retrieval functions return lists of the data, answer_without_data returns the answer
+    retrieved = [r for r in results if isinstance(r, list)]
+    if retrieved:
+        return eval_answer_data(agent, query, [d for data in retrieved for d in data], messages, stream)
+    return next((r for r in results if r), None)
+
+
+def choose_action(agent, query, messages, vec_db, stream=False):
+    if agent.parallel_tool_calls:
+        return choose_action_in_one_step(agent, query, messages, vec_db, stream)
+
+    def needs_event_infos():
+        """Call this function when the user wants to get information about cultural events like festivals, exhibitions, theatrical plays, e.g. "What to do this week?" or "Is something happening tomorrow in the city centre?", "Tell me about Mucha exhibition", or "I would love to go to theatre today."""
+        msg = SystemMessage(f"""You are a function calling agent. Your task is to make valid function call to provided function with arguments following this description:
+{get_event_info_instructions()}
 Return the function call response in valid JSON format, escape JSON reserved characters properly. Do NOT add any additional text.""")
 
         def get_event_info(transformed_query: str, dates: list):
@@ -87,13 +157,13 @@ Return the function call response in valid JSON format, escape JSON reserved cha
 
         data = agent.get_forced_function_call(locals(), get_event_info, messages=[msg, UserMessage(query)])
         if not data:
-            eval_answer_data(agent, query, vec_db.hybrid_query_event(query), messages)
-        return eval_answer_data(agent, query, data, messages)
+            eval_answer_data(agent, query, vec_db.hybrid_query_event(query), messages, stream)
+        return eval_answer_data(agent, query, data, messages, stream)
 
     def needs_base_brno_infos():
         """Call this function when the user asks questions about anything that can not be a cultural event, like places (sights, restaurants or galleries etc.), administration or just Brno city in general, famous personalities that might be connected to the city ...,  e.g. "What is the address of the city hall?" or "What are the opening hours of the zoo?", "Where to get coffee?" or "How to get a tram ticket?"""
         msg = SystemMessage(f"""Your task is to make valid function call to provided function with arguments following this description:
-:param transformed_query: str - Transform the user question to an understandable keyword-based query: "What is the address of the city hall?" -> "City hall address", "What are the opening hours of the zoo?" -> "Zoo opening hours", "How to get a tram ticket?" -> "Tram ticket".
+{BASE_INFO_INSTRUCTIONS}
 Return the function call response in valid JSON format, escape JSON reserved characters properly. Do NOT add any additional text.""")
 
         def get_base_info(transformed_query: str):
@@ -102,12 +172,14 @@ Return the function call response in valid JSON format, escape JSON reserved cha
 
         data = agent.get_forced_function_call(locals(), get_base_info, messages=[msg, UserMessage(query)])
         if not data:
-            eval_answer_data(agent, query, vec_db.hybrid_query_base(query), messages)
-        return eval_answer_data(agent, query, data, messages)
+            eval_answer_data(agent, query, vec_db.hybrid_query_base(query), messages, stream)
+        return eval_answer_data(agent, query, data, messages, stream)
 
     def answer_without_data():
         """Call this function when the user does not ask a question e.g. "Hello I'm Kate" or "Tell me a joke." or asks a question you are sure is not relevant to Brno city."""
         logger.info(messages)
+        if stream:
+            return agent.get_streamed_response(messages)
         r = agent.get_base_response(messages)
         return r.choices[0].message.content
 
@@ -1,22 +1,30 @@
 import base64
+import logging
+import time
+from typing import Iterator, Union
 
 from PIL import Image
 import streamlit as st
 
 from src.agents.api_agent import ApiAgent
-from src.agents_constants import LLAMA3_70_AGENT, LLAMA3_8_AGENT, MIXTRAL_AGENT, GPT_3_AGENT, LLAMA3_70_API_AGENT
-from src.answer_creation.answer_creation import choose_action
+from src.agents_constants import LLAMA3_70_AGENT, LLAMA3_8_AGENT, MIXTRAL_AGENT, GPT_3_AGENT, LLAMA3_70_API_AGENT, \
+    ROUTER_AGENT
+from src.answer_creation.answer_creation import choose_action, start_stream
 from src.data_acquisition.constants import ASSISTANT, SYSTEM, USER
 from src.vector_store.vector_storage import VectorStorage
 
+logger = logging.getLogger(__name__)
+
 MODELS = [{'name': 'Llama3-70B', 'agent': LLAMA3_70_AGENT},
           {'name': 'Llama3-8B', 'agent': LLAMA3_8_AGENT},
           {'name': 'Mixtral', 'agent': MIXTRAL_AGENT},
           {'name': 'GPT-3', 'agent': GPT_3_AGENT},
-          {'name': 'Llama3-70b_LlamaApi', 'agent': LLAMA3_70_API_AGENT}]
+          {'name': 'Llama3-70b_LlamaApi', 'agent': LLAMA3_70_API_AGENT},
+          {'name': 'Router', 'agent': ROUTER_AGENT}]
 
 CONFIG_MESSAGES = [{"role": ASSISTANT, "content": "Hi, I am an AI assistant for information about "
                                                   "Brno city. How may I help you?"}]
+CONNECTION_ERROR_RESPONSE = "There seems to be a connection error."
 SYSTEM_CFG_MESSAGE = [{"role": SYSTEM,
                        "content": "You are an AI assistant for information about Brno city. Put [source] with url at the "
                                   "end of the response if the information you use for the answer is from the internet. "
@@ -27,17 +35,29 @@ def init_chat_history():
     st.session_state.messages = CONFIG_MESSAGES.copy()
 
 
-def get_response(agent: ApiAgent, query: str, messages: list[dict]):
+def get_response(agent: ApiAgent, query: str, messages: list[dict], stream: bool = False) -> Union[str, Iterator[str]]:
     """Get response from the agent. If the response is empty, try again.
     :param agent: The agent to get the response from.
     :param query: The query to get the response for.
     :param messages: The list of messages in the chat.
+    :param stream: Whether the final answer is streamed, the steps choosing the data are completed first.
     """
     msg = SYSTEM_CFG_MESSAGE.copy()
     msg.extend(messages)
     vec_db = VectorStorage()
-    response = choose_action(agent, query, messages, vec_db)
-    return response or choose_action(agent, query, messages, vec_db) or "There seems to be a connection error."
+    response = choose_action(agent, query, messages, vec_db, stream)
+    return response or choose_action(agent, query, messages, vec_db, stream) or CONNECTION_ERROR_RESPONSE
+
+
+def log_time_to_first_token(stream: Iterator[str], start: float) -> Iterator[str]:
+    """Passes the stream through, logging the time from the start to its first part and to its end."""
+    first = True
+    for part in stream:
+        if first:
+            logger.info(f"Time to first token of the answer: {time.perf_counter() - start:.2f} s")
+            first = False
+        yield part
+    logger.info(f"Time to the whole answer: {time.perf_counter() - start:.2f} s")
 
 
 def set_favicon():
@@ -58,9 +78,17 @@ def generate_message(agent: ApiAgent, messages: list[dict]):
     if prompt := st.chat_input("Ask a Brno related question"):
         st.session_state.messages.append({"role": USER, "content": prompt})
         st.chat_message(USER).write(prompt)
-        response = get_response(agent, prompt, st.session_state.messages.copy())
+        start = time.perf_counter()
+        response = get_response(agent, prompt, st.session_state.messages.copy(), stream=True)
+        with st.chat_message(ASSISTANT):
+            if not isinstance(response, str):
+                # an empty stream is replaced by the error response before anything is rendered
+                response = start_stream(log_time_to_first_token(response, start)) or CONNECTION_ERROR_RESPONSE
+            if isinstance(response, str):
+                st.write(response)
+            else:
+                response = st.write_stream(response)
         st.session_state.messages.append({"role": ASSISTANT, "content": response})
-        st.chat_message(ASSISTANT).write(response)
 
 
 def set_title_and_logo():
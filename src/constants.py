@@ -12,3 +12,7 @@ TODAY = arrow.now().format(DATE_FORMAT)
 TOMORROW = arrow.now().shift(days=1).format(DATE_FORMAT)
 WEEKDAY = datetime.now().strftime('%A')
 MAX_SIZE = 2500
+# chunk size in tokens, the parsed text is returned whole so the chunk has to fit into the output of the model too
+CHUNK_TOKENS = 700
+# token budget of the messages sent to the model
+CONTEXT_TOKENS = 3000
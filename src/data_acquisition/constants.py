@@ -32,6 +32,27 @@ PLACE_URL_SUBSTRINGS = ['place', 'taste', 'ochutnejte', 'tour', 'galer', 'galler
 ADMINISTRATION_URL_SUBSTRINGS = ['expat', 'brnoid', 'en.brno.cz', 'damenavas']
 STATIC_URL_SUBSTRINGS = ['wiki', 'projekt']
 
+ZERO_SHOT_MODEL = 'facebook/bart-large-mnli'
+DISTILLED_ZERO_SHOT_MODEL = 'valhalla/distilbart-mnli-12-3'
+ZERO_SHOT_LABELS = {PLACE: 'place, restaurant, café, museum, sight or tour',
+                    EVENT: 'event, concert, exhibition, festival or performance',
+                    ADMINISTRATION: 'administration, municipal office, taxes, documents or residence',
+                    STATIC: 'article, history or personality'}
+ZERO_SHOT_BATCH_SIZE = 8
+ZERO_SHOT_CACHE_SIZE = 10000
+RECORD_TYPE_MODEL_PATH = _config.get('MODELS', 'RECORD_TYPE_MODEL_PATH',
+                                     fallback='../../models/record_type_classifier.joblib')
+URL_RULES_PATH = _config.get('MODELS', 'URL_RULES_PATH', fallback='../../models/url_rules.json')
+URL_RULE_MIN_SUPPORT = 5
+URL_RULE_MIN_PRECISION = 0.95
+
+CHARS_PER_TOKEN = 4
+BATCH_TOKEN_BUDGET = 3000
+BATCH_MAX_CHUNKS = 8
+CHUNK_ID = 'chunk_id'
+# use the locally extracted event dates instead of asking the model for them
+USE_EXTRACTED_DATES = False
+
 ROOT = 'root'
 ID = 'id'
 URL = 'url'
@@ -44,6 +65,7 @@ TYPE = 'record_type'
 TYPE_IDS = 'type_ids'
 UPDATE_INTERVAL = 'update_interval'
 ENCODED_CONTENT = 'encoded_content'
+CHUNK_HASH = 'chunk_hash'
 
 SYSTEM = "system"
 USER = "user"
@@ -1,3 +1,11 @@
+import hashlib
+import os
+import threading
+from functools import lru_cache
+from typing import Optional, Union
+
+import torch
+from cachetools import LRUCache
 from pydantic import BaseModel, Field
 from transformers import pipeline
 from src.agents.api_agent import ApiAgent
@@ -5,10 +13,21 @@ from src.agents.message import SystemMessage, UserMessage
 from src.data_acquisition.constants import logger
 from src.data_acquisition.constants import STATIC, PLACE, EVENT, ADMINISTRATION, RECORD_TYPE_LABELS, \
     EVENT_URL_SUBSTRINGS, PLACE_URL_SUBSTRINGS, ADMINISTRATION_URL_SUBSTRINGS, \
-    STATIC_URL_SUBSTRINGS
+    STATIC_URL_SUBSTRINGS, ZERO_SHOT_MODEL, ZERO_SHOT_LABELS, ZERO_SHOT_BATCH_SIZE, ZERO_SHOT_CACHE_SIZE
+from src.data_acquisition.content_processing.record_type_classifier import RecordTypeClassifier
+from src.data_acquisition.content_processing.url_rules import UrlRuleMatcher, get_url_rule_matcher
 
 
-def preclassify_by_url(url: str):
+def preclassify_by_url(url: str, matcher: UrlRuleMatcher = None) -> Optional[str]:
+    """Pre-classify the content type based on the URL. The handwritten substrings are checked first, then the rules
+    mined from the labelled sources (see url_rules.py). Returns None if the type can not be told from the URL."""
+    content_type = preclassify_by_url_substrings(url)
+    if content_type is not None:
+        return content_type
+    return (matcher or get_url_rule_matcher()).match(url)
+
+
+def preclassify_by_url_substrings(url: str) -> Optional[str]:
     """Pre-classify the content type based on the URL. If the URL contains a substring that is specific to a certain
     type of content, returns the type of content. If the URL does not contain any of the substrings, returns None."""
     for substr in EVENT_URL_SUBSTRINGS:
@@ -26,28 +45,105 @@ def preclassify_by_url(url: str):
     return None
 
 
+class ZeroShotClassifier:
+    """Zero-shot content type classifier based on a Hugging Face NLI model. The model is loaded once and kept in
+    memory, the texts are classified in batches on CPU threads and the results are cached by the hash of the text."""
+
+    def __init__(self, model: str = ZERO_SHOT_MODEL, threads: int = None, quantize: bool = False,
+                 batch_size: int = ZERO_SHOT_BATCH_SIZE, cache_size: int = ZERO_SHOT_CACHE_SIZE):
+        """
+        :param model: Name of the NLI model, a distilled model such as DISTILLED_ZERO_SHOT_MODEL is faster
+        :param threads: Number of CPU threads used for the inference, all cores by default
+        :param quantize: Whether to quantize the linear layers of the model to int8
+        :param batch_size: Number of text-label pairs processed at once
+        :param cache_size: Maximum number of cached results
+        """
+        torch.set_num_threads(threads or os.cpu_count() or 1)
+        self.classifier = pipeline("zero-shot-classification", model=model, device=-1)
+        if quantize:
+            self.classifier.model = torch.quantization.quantize_dynamic(self.classifier.model, {torch.nn.Linear},
+                                                                        dtype=torch.qint8)
+        self.batch_size = batch_size
+        self.cache = LRUCache(maxsize=cache_size)
+        self.lock = threading.Lock()
+
+    def classify(self, texts: list[str], labels: dict[str, str] = None) -> list[tuple[str, float]]:
+        """
+        Classifies the texts.
+        :param texts: Texts to be classified
+        :param labels: Dictionary of the labels and their descriptions used as the hypotheses of the model
+        :return: List of (label, score) tuples in the order of the texts
+        """
+        labels = labels or ZERO_SHOT_LABELS
+        keys = [self._get_key(text, labels) for text in texts]
+        with self.lock:
+            missing = list({key: text for key, text in zip(keys, texts) if key not in self.cache}.items())
+            if missing:
+                results = self.classifier([text for _, text in missing], list(labels.values()),
+                                          batch_size=self.batch_size)
+                results = results if isinstance(results, list) else [results]
+                label_by_description = {description: label for label, description in labels.items()}
+                for (key, _), result in zip(missing, results):
+                    self.cache[key] = (label_by_description[result['labels'][0]], result['scores'][0])
+            return [self.cache[key] for key in keys]
+
+    @staticmethod
+    def _get_key(text: str, labels: dict[str, str]) -> str:
+        return hashlib.sha256((text + str(labels)).encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_zero_shot_classifier(model: str = ZERO_SHOT_MODEL, quantize: bool = False) -> ZeroShotClassifier:
+    """Returns the classifier of the given model, loaded once per process."""
+    return ZeroShotClassifier(model, quantize=quantize)
+
+
 def get_content_type_simple(text: str, labels: list[str] = RECORD_TYPE_LABELS) -> str:
     """Simple content type classifier based on the zero-shot classification model from Hugging Face."""
-    classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
-    result = classifier(text, labels)
-    return result['labels'][0]
+    return get_zero_shot_classifier().classify([text], {label: label for label in labels})[0][0]
+
 
+def get_content_types_zero_shot(texts: list[str], classifier: ZeroShotClassifier = None) -> list[tuple[str, float]]:
+    """Returns the content types of the texts with their scores using the zero-shot classifier."""
+    return (classifier or get_zero_shot_classifier()).classify(texts)
 
-def get_content_type_preclassified_function_call(agent: ApiAgent, url: str, content: str) -> str:
+
+def get_content_type_preclassified_function_call(agent: ApiAgent, url: str, content: str, threshold: float = None,
+                                                 classifier: Union[ZeroShotClassifier, RecordTypeClassifier] = None
+                                                 ) -> str:
     """Pre-classifies the content type based on the URL.
-    If that is not possible, uses a function call to classify the content type.
+    If that is not possible and threshold is given, the local classifier is used, and its result is returned if its
+    score reaches the threshold. Otherwise, uses a function call to classify the content type.
     :param agent: ApiAgent
     :param url: the URL of the content
     :param content: the text to be classified
+    :param threshold: the minimal score of the local classifier to skip the function call
+    :param classifier: the local classifier, the zero-shot classifier by default
     :return: the content type
     """
     content_type = preclassify_by_url(url)
     if content_type is None or content_type not in RECORD_TYPE_LABELS:
         logger.info(f"Could not pre-classify content type")
+        content_type = get_content_type_local(content, threshold, classifier)
+        if content_type is not None:
+            return content_type
         return get_content_type_by_function_call(agent, content)
     return content_type
 
 
+def get_content_type_local(content: str, threshold: float = None,
+                           classifier: Union[ZeroShotClassifier, RecordTypeClassifier] = None) -> Optional[str]:
+    """Returns the content type given by the local classifier (the zero-shot classifier by default) if its score
+    reaches the threshold, None otherwise or if no threshold is given."""
+    if threshold is None:
+        return None
+    content_type, score = (classifier or get_zero_shot_classifier()).classify([content])[0]
+    if score >= threshold:
+        return content_type
+    logger.info(f"Local classification {content_type} under threshold: {score}")
+    return None
+
+
 def get_content_type_by_function_call(agent: ApiAgent, content: str) -> str:
     """
     Returns the content type based on the given text using an agent function call.
@@ -1,13 +1,22 @@
+import asyncio
+import json
 import logging
+from typing import Callable, Optional, Union
+
 from dotenv import load_dotenv
+from pydantic import Field, create_model
 
 from src.agents.api_agent import ApiAgent, Message
+from src.agents.async_api_agent import AsyncApiAgent
 from src.agents.message import SystemMessage, UserMessage
 from src.constants import TODAY
 from src.data_acquisition.constants import STATIC, PLACE, EVENT, ADMINISTRATION, DATES_EXAMPLE, DATES_FORMAT_EXAMPLE, \
-    RECORD_TYPE_LABELS
+    RECORD_TYPE_LABELS, ADDRESS, DEFAULT_ADDRESS, CHARS_PER_TOKEN, BATCH_TOKEN_BUDGET, BATCH_MAX_CHUNKS, CHUNK_ID, \
+    USE_EXTRACTED_DATES
 from src.data_acquisition.content_processing.content_classification import get_content_type_preclassified_function_call, \
-    preclassify_by_url
+    preclassify_by_url, get_content_type_local, ZeroShotClassifier
+from src.data_acquisition.content_processing.date_extraction import extract_dates, get_valid_dates
+from src.data_acquisition.content_processing.record_type_classifier import RecordTypeClassifier
 from src.data_acquisition.schemas import BaseSchema, EventSchema
 
 load_dotenv()
@@ -22,6 +31,27 @@ def get_parsed_content_by_function_call(agent: ApiAgent, url: str, content: str)
     :param content: the text to be parsed
     :return: the parsed content in the form of a BaseSchema object
     """
+    module, functions, messages = _get_function_call_request(url, content)
+    return agent.get_function_call(module, functions, messages=messages)
+
+
+async def get_parsed_content_by_function_call_async(agent: AsyncApiAgent, url: str, content: str) -> BaseSchema:
+    """
+    Asynchronous variant of get_parsed_content_by_function_call, the dates of the content are extracted in a thread.
+    :param agent: AsyncApiAgent
+    :param url: url that the content belongs to
+    :param content: the text to be parsed
+    :return: the parsed content in the form of a BaseSchema object
+    """
+    content_dates = await asyncio.to_thread(extract_dates, content)
+    module, functions, messages = _get_function_call_request(url, content, content_dates)
+    return await agent.get_function_call(module, functions, messages=messages)
+
+
+def _get_function_call_request(url: str, content: str, content_dates: list[dict] = None
+                               ) -> tuple[dict, list, list[Message]]:
+    """Returns the functions of the entities by their names, the functions to be chosen from and the messages of the
+    function call parsing the content."""
 
     def add_place(header: str, text: str, brief: str, address: str) -> BaseSchema:
         """Call this function if you encounter entity that is a place or destination in or near Brno city, such as restaurant, café, bar, bakery, museum, tour, greenery, church, castle, university, kino, theatre or similar."""
@@ -29,7 +59,8 @@ def get_parsed_content_by_function_call(agent: ApiAgent, url: str, content: str)
 
     def add_event(header: str, text: str, brief: str, address: str, dates: str) -> BaseSchema:
         """Call this function if you encounter entity that is an event such as concert, exhibition, celebration, festival, sports match, theatrical performance or similar."""
-        return EventSchema(header, EVENT, brief, text, url, TODAY, address, dates)
+        return EventSchema(header, EVENT, brief, text, url, TODAY, address,
+                           get_valid_dates(dates, content, content_dates))
 
     def add_administration(header: str, text: str, brief: str, address: str) -> BaseSchema:
         """Call this function if you encounter entity that is administrative information such as Municipal office, business, authorities, insurance, social Care, vehicle registration, taxes, fees, information for expats, school system, residence, ID cards or similar."""
@@ -51,8 +82,8 @@ def get_parsed_content_by_function_call(agent: ApiAgent, url: str, content: str)
  3. End with the function call response in valid JSON format, do NOT add any additional text."""),
                 UserMessage(f"""Here is the text to process ```{content}```""")]
 
-    return agent.get_function_call(locals(), [add_place, add_administration, add_static, add_event],
-                                   messages=messages)
+    functions = [add_place, add_administration, add_static, add_event]
+    return {f.__name__: f for f in functions}, functions, messages
 
 
 def get_parsed_content_by_divided_function_call(agent: ApiAgent, url: str, content: str):
@@ -72,32 +103,92 @@ def get_parsed_content_by_divided_function_call(agent: ApiAgent, url: str, conte
     return get_parsed_by_type(content_type, agent, url, content)
 
 
-def get_parsed_content_preclassified_function_call(agent: ApiAgent, url: str, content: str) -> BaseSchema:
+def get_parsed_content_preclassified_function_call(agent: ApiAgent, url: str, content: str, threshold: float = None,
+                                                   classifier: Union[ZeroShotClassifier, RecordTypeClassifier] = None
+                                                   ) -> BaseSchema:
     """
     Returns the parsed content based on the given text using an agent function call, where the content type is
     pre-classified for less API calls if possible.
     :param agent: ApiAgent
     :param url: url that the content belongs to
     :param content: the text to be parsed
+    :param threshold: if given, the local classifier is used when the url does not tell the type, and its result is
+    accepted if its score reaches the threshold
+    :param classifier: the local classifier, the zero-shot classifier by default
     :return: the parsed content in the form of a BaseSchema object
     """
     content_type = preclassify_by_url(url)
     if content_type is None or content_type not in RECORD_TYPE_LABELS:
         logger.info(f"Could not preclassify content type")
-        return get_parsed_content_by_function_call(agent, url, content)
+        content_type = get_content_type_local(content, threshold, classifier)
+        if content_type is None:
+            return get_parsed_content_by_function_call(agent, url, content)
     return get_parsed_by_type(content_type, agent, url, content)
 
 
-def get_parsed_by_type(record_type, agent: ApiAgent, url: str, content: str) -> BaseSchema:
+async def get_parsed_content_preclassified_function_call_async(agent: AsyncApiAgent, url: str, content: str,
+                                                               threshold: float = None,
+                                                               classifier: Union[ZeroShotClassifier,
+                                                                                 RecordTypeClassifier] = None
+                                                               ) -> BaseSchema:
+    """
+    Asynchronous variant of get_parsed_content_preclassified_function_call, the local classifier runs in a thread, so
+    it does not block the event loop.
+    :param agent: AsyncApiAgent
+    :param url: url that the content belongs to
+    :param content: the text to be parsed
+    :param threshold: if given, the local classifier is used when the url does not tell the type, and its result is
+    accepted if its score reaches the threshold
+    :param classifier: the local classifier, the zero-shot classifier by default
+    :return: the parsed content in the form of a BaseSchema object
+    """
+    content_type = preclassify_by_url(url)
+    if content_type is None or content_type not in RECORD_TYPE_LABELS:
+        logger.info(f"Could not preclassify content type")
+        content_type = await asyncio.to_thread(get_content_type_local, content, threshold, classifier)
+        if content_type is None:
+            return await get_parsed_content_by_function_call_async(agent, url, content)
+    return await get_parsed_by_type_async(content_type, agent, url, content)
+
+
+def get_parsed_by_type(record_type, agent: ApiAgent, url: str, content: str,
+                       use_extracted_dates: bool = USE_EXTRACTED_DATES) -> BaseSchema:
     """
     Returns the parsed content based on the given text using an agent function call. The function call is based on the
-    given record type.
+    given record type. For events, the dates are first extracted from the text locally and passed to the agent as a
+    hint, the extracted dates are also used when the dates provided by the agent can not be read.
     :param record_type: the type of the record [place, event, administration, static]
     :param agent: ApiAgent
     :param url: url that the content belongs to
     :param content: the text to be parsed
+    :param use_extracted_dates: if True, the extracted dates are used directly and the agent is not asked for them
+    :return: the parsed content in the form of a BaseSchema object
+    """
+    module, function, messages = _get_by_type_request(record_type, url, content, use_extracted_dates)
+    return agent.get_forced_function_call(module, function, messages=messages)
+
+
+async def get_parsed_by_type_async(record_type, agent: AsyncApiAgent, url: str, content: str,
+                                   use_extracted_dates: bool = USE_EXTRACTED_DATES) -> BaseSchema:
+    """
+    Asynchronous variant of get_parsed_by_type, the dates are extracted from the text in a thread.
+    :param record_type: the type of the record [place, event, administration, static]
+    :param agent: AsyncApiAgent
+    :param url: url that the content belongs to
+    :param content: the text to be parsed
+    :param use_extracted_dates: if True, the extracted dates are used directly and the agent is not asked for them
     :return: the parsed content in the form of a BaseSchema object
     """
+    module, function, messages = await asyncio.to_thread(_get_by_type_request, record_type, url, content,
+                                                         use_extracted_dates)
+    return await agent.get_forced_function_call(module, function, messages=messages)
+
+
+def _get_by_type_request(record_type, url: str, content: str, use_extracted_dates: bool = USE_EXTRACTED_DATES
+                         ) -> tuple[dict, Callable, list[Message]]:
+    """Returns the functions of the record type by their names, the function to be called and the messages of the
+    forced function call parsing the content."""
+    extracted_dates = extract_dates(content) if record_type == EVENT else []
 
     def get_params_base(header: str, text: str, brief: str, address: str) -> BaseSchema:
         """This function encapsulates the process of creating a BaseSchema object.
@@ -117,13 +208,26 @@ def get_parsed_by_type(record_type, agent: ApiAgent, url: str, content: str) ->
         :param dates: The date(s) of the event as list of durations. The duration format is a STRINGIFIED JSON object dates='[{"start": start_date, "end": end_date}]' with fields "start" and "end". Field "end" is optional, it is used for period of time (that are two dates from-to, like startdate-enddate, for example 31 jan–14 feb 2024). Use the 'YYYY-MM-DDTHH:mm:ss' format, where 'YYYY-MM-DD' is for date, and format 'HH:mm:ss' for time. For example '[{"start": "2024-01-11"}, {"start": "2024-01-14T15:00"}, {"start": "2024-01-31T15:00", "end": "2024-02-14"}]'.
         :return: EventSchema object."""
 
-        return EventSchema(header, record_type, brief, text, url, TODAY, address, dates)
+        return EventSchema(header, record_type, brief, text, url, TODAY, address,
+                           get_valid_dates(dates, content, extracted_dates))
+
+    def get_params_event_dated(header: str, text: str, brief: str, address: str) -> BaseSchema:
+        """This function encapsulates the process of creating an EventSchema object.
+        :param header: The header of the entity.
+        :param text: The descriptive text of the entity (for example a plot of a theatrical performance). Do NOT SHORTEN it, do NOT OMIT any important information.
+        :param brief: The sum up of the text no longer than 3 sentences.
+        :param address: The address of the entity, default: "Brno, Czech Republic".
+        :return: EventSchema object."""
+        return EventSchema(header, record_type, brief, text, url, TODAY, address, json.dumps(extracted_dates))
 
     def _get_messages(record_type) -> list[Message]:
         event_specific = ""
-        if record_type == EVENT:
+        if record_type == EVENT and not dated:
             event_specific = f""" 
 For an event entity: assign date(s) of the event as list of durations. The duration format is a STRINGIFIED JSON object {DATES_FORMAT_EXAMPLE} with fields "start" and "end". Field "end" is optional, it is used for period of time (that are two dates from-to, like startdate-enddate, for example 31 jan–14 feb 2024). Use the 'YYYY-MM-DDTHH:mm:ss' format, where 'YYYY-MM-DD' is for date, and format 'HH:mm:ss' for time For example {DATES_EXAMPLE}."""
+            if extracted_dates:
+                event_specific += f""" 
+These dates were found in the text: {json.dumps(extracted_dates)}. Use the ones that are the dates of the event."""
 
         system_message = f"""You are a smart processor of web-scraped text. Follow these instructions: 
  1. Go through the text and extract information from the article, translate to English if not in English. Use plain text. 
@@ -137,5 +241,163 @@ For an event entity: assign date(s) of the event as list of durations. The durat
         return [SystemMessage(content=system_message),
                 UserMessage(f"""Here is the text to process ```{content}```""")]
 
-    return agent.get_forced_function_call(locals(), get_params_event if record_type == EVENT else get_params_base,
-                                          messages=_get_messages(record_type))
+    dated = bool(use_extracted_dates and extracted_dates)
+    function = get_params_base
+    if record_type == EVENT:
+        function = get_params_event_dated if dated else get_params_event
+    module = {f.__name__: f for f in [get_params_base, get_params_event, get_params_event_dated]}
+    return module, function, _get_messages(record_type)
+
+
+def get_parsed_contents_batched(agent: ApiAgent, url_chunks: list[tuple[str, str]], threshold: float = None,
+                                classifier: Union[ZeroShotClassifier, RecordTypeClassifier] = None,
+                                token_budget: int = BATCH_TOKEN_BUDGET) -> list[Optional[BaseSchema]]:
+    """
+    Returns the parsed contents of the chunks, where the chunks of the same pre-classified record type are packed into
+    one request up to the token budget. The chunks whose type can not be pre-classified, and the chunks missing in the
+    response of their batch are parsed one by one.
+    :param agent: ApiAgent
+    :param url_chunks: list of (url, chunk) tuples, url is the url that the chunk belongs to
+    :param threshold: if given, the local classifier is used when the url does not tell the type, and its result is
+    accepted if its score reaches the threshold
+    :param classifier: the local classifier, the zero-shot classifier by default
+    :param token_budget: the maximal estimated number of tokens of the chunks packed into one request
+    :return: the parsed contents in the order of the chunks, None for the chunks that could not be parsed
+    """
+    by_type = {}
+    for i, (url, chunk) in enumerate(url_chunks):
+        content_type = preclassify_by_url(url)
+        if content_type is None or content_type not in RECORD_TYPE_LABELS:
+            content_type = get_content_type_local(chunk, threshold, classifier)
+        by_type.setdefault(content_type, []).append(i)
+
+    results = [None] * len(url_chunks)
+    for content_type, indices in by_type.items():
+        if content_type is None:
+            continue
+        for batch in get_chunk_batches([url_chunks[i][1] for i in indices], token_budget):
+            batch_indices = [indices[i] for i in batch]
+            if len(batch_indices) == 1:
+                url, chunk = url_chunks[batch_indices[0]]
+                results[batch_indices[0]] = get_parsed_by_type(content_type, agent, url, chunk)
+                continue
+            parsed = get_parsed_batch_by_type(content_type, agent, [url_chunks[i] for i in batch_indices])
+            for i, content in zip(batch_indices, parsed):
+                results[i] = content
+    for i, (url, chunk) in enumerate(url_chunks):
+        if results[i] is None:
+            results[i] = get_parsed_content_preclassified_function_call(agent, url, chunk, threshold, classifier)
+    return results
+
+
+async def get_parsed_contents_concurrently(agent: AsyncApiAgent, url_chunks: list[tuple[str, str]],
+                                          threshold: float = None,
+                                          classifier: Union[ZeroShotClassifier, RecordTypeClassifier] = None
+                                          ) -> list[Optional[BaseSchema]]:
+    """
+    Returns the parsed contents of the chunks, the chunks are parsed concurrently by
+    get_parsed_content_preclassified_function_call_async, the agent limits the number of the requests in flight.
+    :param agent: AsyncApiAgent
+    :param url_chunks: list of (url, chunk) tuples, url is the url that the chunk belongs to
+    :param threshold: if given, the local classifier is used when the url does not tell the type, and its result is
+    accepted if its score reaches the threshold
+    :param classifier: the local classifier, the zero-shot classifier by default
+    :return: the parsed contents in the order of the chunks, None for the chunks that could not be parsed
+    """
+    results = await asyncio.gather(*[get_parsed_content_preclassified_function_call_async(agent, url, chunk,
+                                                                                          threshold, classifier)
+                                     for url, chunk in url_chunks], return_exceptions=True)
+    for (url, _), result in zip(url_chunks, results):
+        if isinstance(result, Exception):
+            logger.error(f"Could not parse chunk of {url}: {result}")
+    return [None if isinstance(result, Exception) else result for result in results]
+
+
+def get_chunk_batches(chunks: list[str], token_budget: int = BATCH_TOKEN_BUDGET,
+                      max_chunks: int = BATCH_MAX_CHUNKS) -> list[list[int]]:
+    """Packs the chunks in order into batches of at most max_chunks chunks whose estimated number of tokens does not
+    exceed the budget, a chunk over the budget gets a batch of its own. Returns the indices of the chunks per batch."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for i, chunk in enumerate(chunks):
+        tokens = estimate_tokens(chunk)
+        if batch and (batch_tokens + tokens > token_budget or len(batch) >= max_chunks):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def get_parsed_batch_by_type(record_type, agent: ApiAgent, url_chunks: list[tuple[str, str]]
+                             ) -> list[Optional[BaseSchema]]:
+    """
+    Returns the parsed contents of several chunks of the given record type using one agent JSON call. The chunks are
+    numbered in the request and the parsed entities are mapped back to their chunks by the number.
+    :param record_type: the type of the records [place, event, administration, static]
+    :param agent: ApiAgent
+    :param url_chunks: list of (url, chunk) tuples, url is the url that the chunk belongs to
+    :return: the parsed contents in the order of the chunks, None for the chunks missing in the response
+    """
+    fields = {
+        CHUNK_ID: (int, Field(..., description="The id of the chunk the entity was extracted from.")),
+        'header': (str, Field(..., description="The header of the entity.")),
+        'text': (str, Field(..., description="The descriptive text of the entity. Do NOT SHORTEN it, do NOT OMIT any important information.")),
+        'brief': (str, Field(..., description="The sum up of the text no longer than 3 sentences.")),
+        ADDRESS: (str, Field(..., description=f"The address of the entity, default: \"{DEFAULT_ADDRESS}\".")),
+    }
+    event_specific = ""
+    if record_type == EVENT:
+        fields['dates'] = (str, Field(..., description=f"The date(s) of the event as STRINGIFIED JSON list of durations, for example {DATES_EXAMPLE}."))
+        event_specific = f"""
+    For an event entity: assign date(s) of the event as list of durations. The duration format is a STRINGIFIED JSON object {DATES_FORMAT_EXAMPLE} with fields "start" and "end". Field "end" is optional, it is used for period of time (that are two dates from-to, like startdate-enddate, for example 31 jan–14 feb 2024). Use the 'YYYY-MM-DDTHH:mm:ss' format, where 'YYYY-MM-DD' is for date, and format 'HH:mm:ss' for time For example {DATES_EXAMPLE}. The dates found in a chunk are listed after it, use the ones that are the dates of the event."""
+    entity_model = create_model('Entity', **fields)
+    entities_model = create_model('Entities', __doc__="Entities extracted from the chunks, one for each chunk",
+                                  entities=(list[entity_model], ...))
+
+    chunks_text = '\n'.join(f"<chunk id={i}>\n{chunk}\n</chunk>{_get_dates_hint(record_type, chunk)}"
+                            for i, (_, chunk) in enumerate(url_chunks))
+    messages = [SystemMessage(f"""You are a smart processor of web-scraped text. You are given {len(url_chunks)} chunks of text, each enclosed in <chunk id=...> tags. Each chunk is a separate entity. Follow these instructions: 
+ 1. Go through each chunk and extract information from it, translate to English if not in English. Use plain text. 
+ 2. For each chunk, fill in one entity of the schema with the id of the chunk as chunk_id as follows:
+    Use provided or generate a header more fitting the found text. 
+    The descriptive text of the entity (for example a plot of a theatrical performance for an event, insurance application process for administration, or a menu of a restaurant for a place) must be assigned it as the text parameter. Do NOT SHORTEN it, do NOT OMIT any important information. Do NOT mix information from different chunks. 
+    Create a brief which is a keyword-extending summary up of the text no longer than 2 sentences. 
+    If you encounter address of a place (such as address of a municipal office for administration or address of concert-hall for an event), assign is as address. Fill in "{DEFAULT_ADDRESS}" if the specific address not found but required.{event_specific}
+ 3. Return exactly one entity for each chunk in valid JSON format. Do NOT add any additional text."""),
+                UserMessage(f"""Here are the chunks to process ```{chunks_text}```""")]
+
+    response = agent.get_json_format_response(entities_model, messages)
+    results = [None] * len(url_chunks)
+    for entity in (response or {}).get('entities') or []:
+        try:
+            entity = dict(entity)
+            i = int(entity[CHUNK_ID])
+            if not 0 <= i < len(url_chunks) or results[i] is not None:
+                continue
+            results[i] = _get_schema_from_entity(record_type, *url_chunks[i], entity)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Could not read parsed entity: {e}")
+    missing = results.count(None)
+    if missing:
+        logger.info(f"{missing} of {len(url_chunks)} chunks missing in the batch response")
+    return results
+
+
+def _get_dates_hint(record_type: str, chunk: str) -> str:
+    dates = extract_dates(chunk) if record_type == EVENT else []
+    return f"\nDates found in the chunk: {json.dumps(dates)}" if dates else ""
+
+
+def _get_schema_from_entity(record_type: str, url: str, chunk: str, entity: dict) -> BaseSchema:
+    address = entity.get(ADDRESS) or DEFAULT_ADDRESS
+    if record_type == EVENT:
+        return EventSchema(entity['header'], record_type, entity['brief'], entity['text'], url, TODAY, address,
+                           get_valid_dates(entity.get('dates'), chunk))
+    return BaseSchema(entity['header'], record_type, entity['brief'], entity['text'], url, TODAY, address)
@@ -0,0 +1,205 @@
+import json
+import re
+import unicodedata
+from datetime import date, timedelta
+from typing import Optional
+
+from json_repair import repair_json
+
+START = 'start'
+END = 'end'
+
+MONTHS = {
+    1: ['january', 'jan', 'ledna', 'leden'],
+    2: ['february', 'feb', 'unora', 'unor'],
+    3: ['march', 'mar', 'brezna', 'brezen'],
+    4: ['april', 'apr', 'dubna', 'duben'],
+    5: ['may', 'kvetna', 'kveten'],
+    6: ['june', 'jun', 'cervna', 'cerven'],
+    7: ['july', 'jul', 'cervence', 'cervenec'],
+    8: ['august', 'aug', 'srpna', 'srpen'],
+    9: ['september', 'sept', 'sep', 'zari'],
+    10: ['october', 'oct', 'rijna', 'rijen'],
+    11: ['november', 'nov', 'listopadu', 'listopad'],
+    12: ['december', 'dec', 'prosince', 'prosinec'],
+}
+_MONTH_NUMBERS = {name: number for number, names in MONTHS.items() for name in names}
+# the longer names first, so that 'cervence' is not matched as 'cerven'
+_MON = '(?:' + '|'.join(sorted(_MONTH_NUMBERS, key=len, reverse=True)) + r')\b\.?'
+_DAY = r'(?:[12]\d|3[01]|0?[1-9])'
+_NUM_MONTH = r'(?:1[0-2]|0?[1-9])'
+_YEAR = r'(?:20\d{2})'
+_ORD = r'(?:st|nd|rd|th)?'
+
+_SEP = r'\s*(?:-|\bdo\b|\baz\b|\bto\b|\buntil\b)\s*'
+# the day is not a part of a longer number, a numeric month is not followed by other digits than the year
+_D = r'(?<![\d.])'
+
+
+def _num_month_end(year_group: str) -> str:
+    return rf'\.(?:\s*(?P<{year_group}>{_YEAR})\b|(?!\s*\d))'
+
+
+_PATTERNS = [
+    # 2024-05-12, 2024-05-12T19:00
+    ('iso', re.compile(rf'\b(?P<y>{_YEAR})-(?P<m>{_NUM_MONTH})-(?P<d>{_DAY})(?!\d)'
+                       rf'(?:[t ](?P<h>[01]?\d|2[0-3]):(?P<min>[0-5]\d))?')),
+    # 12. 5. 2024 - 14. 6. 2024, 12. 5. - 14. 6. 2024
+    ('num_range', re.compile(rf'{_D}\b(?P<d1>{_DAY})\.\s*(?P<m1>{_NUM_MONTH}){_num_month_end("y1")}{_SEP}'
+                             rf'(?P<d2>{_DAY})\.\s*(?P<m2>{_NUM_MONTH}){_num_month_end("y2")}')),
+    # 12.-14. 5. 2024
+    ('num_day_range', re.compile(rf'{_D}\b(?P<d1>{_DAY})\.?{_SEP}(?P<d2>{_DAY})\.\s*(?P<m2>{_NUM_MONTH})'
+                                 rf'{_num_month_end("y2")}')),
+    # 12. 5. 2024, 12.5.2024, 12. 5.
+    ('num', re.compile(rf'{_D}\b(?P<d>{_DAY})\.\s*(?P<m>{_NUM_MONTH}){_num_month_end("y")}')),
+    # 31 jan - 14 feb 2024, 12 - 14 may 2024, 12. - 14. kvetna 2024
+    ('text_range', re.compile(rf'{_D}\b(?P<d1>{_DAY}){_ORD}\.?\s*(?P<mon1>{_MON})?\s*(?P<y1>{_YEAR})?{_SEP}'
+                              rf'(?P<d2>{_DAY}){_ORD}\.?\s*(?P<mon2>{_MON})\s*,?\s*(?P<y2>{_YEAR})?')),
+    # 12 may 2024, 12. kvetna
+    ('text', re.compile(rf'{_D}\b(?P<d>{_DAY}){_ORD}\.?\s*(?:of\s+)?(?P<mon>{_MON})\s*,?\s*(?P<y>{_YEAR})?')),
+    # jan 31 - feb 14, 2024, may 12-14, 2024
+    ('text_month_first_range', re.compile(rf'\b(?P<mon1>{_MON})\s*(?P<d1>{_DAY}){_ORD}{_SEP}(?P<mon2>{_MON})?\s*'
+                                          rf'(?P<d2>{_DAY}){_ORD}\b\s*,?\s*(?P<y2>{_YEAR})?')),
+    # january 31, 2024
+    ('text_month_first', re.compile(rf'\b(?P<mon>{_MON})\s*(?P<d>{_DAY}){_ORD}\b\s*,?\s*(?P<y>{_YEAR})?')),
+]
+_TIME = re.compile(r'\s*(?:,|v|at|od|from|@|\|)?\s*(?P<h>[01]?\d|2[0-3])[:.](?P<min>[0-5]\d)\b(?!\.\d)')
+_DASHES = re.compile('[\u2010-\u2015\u2212]')
+
+
+def extract_dates(text: str, today: date = None) -> list[dict]:
+    """
+    Extracts the dates and date ranges written in the common Czech and English formats, such as "31 jan–14 feb 2024",
+    "12. 5. 2024 19:00", "12.–14. 5." or "January 31, 2024". A time following a single date is added to it. The dates
+    without a year get the year of today, or the next one if the date would be more than half a year ago.
+    :param text: Text to extract the dates from
+    :param today: Date the missing years are derived from, today by default
+    :return: List of the durations {"start": start_date, "end": end_date} in the order of the text, without duplicates,
+    the dates are in the format YYYY-MM-DD or YYYY-MM-DDTHH:MM, the end is present only for the ranges
+    """
+    today = today or date.today()
+    text = _normalise(text)
+    matches = []
+    taken = []
+    for kind, pattern in _PATTERNS:
+        for match in pattern.finditer(text):
+            if any(match.start() < end and start < match.end() for start, end in taken):
+                continue
+            duration = _get_duration(kind, match, text, today)
+            if duration:
+                taken.append(match.span())
+                matches.append((match.start(), duration))
+    durations = []
+    for _, duration in sorted(matches, key=lambda m: m[0]):
+        if duration not in durations:
+            durations.append(duration)
+    return durations
+
+
+def get_valid_dates(dates, content: str, content_dates: list[dict] = None) -> str:
+    """
+    Returns the dates from the model as a stringified JSON list of durations if they can be read, otherwise the dates
+    extracted from the text of the model dates, or from the content if there are none. If no dates are found, the
+    dates of the model are returned unchanged, so the vector store keeps their text.
+    :param dates: Dates provided by the model
+    :param content: Text the dates were extracted from
+    :param content_dates: Dates already extracted from the content, extracted from it if not given
+    :return: Stringified JSON list of durations, or the unreadable dates of the model
+    """
+    parsed = read_dates(dates)
+    if parsed is not None:
+        return json.dumps(parsed)
+    extracted = extract_dates(str(dates)) if dates else []
+    if not extracted:
+        extracted = extract_dates(content) if content_dates is None else content_dates
+    if extracted or not dates:
+        return json.dumps(extracted)
+    return dates if isinstance(dates, str) else json.dumps(dates, ensure_ascii=False, default=str)
+
+
+def read_dates(dates) -> Optional[list[dict]]:
+    """Returns the list of the durations with valid start dates, None if the dates can not be read."""
+    try:
+        if isinstance(dates, str):
+            dates = json.loads(repair_json(dates))
+        if isinstance(dates, dict):
+            dates = [dates]
+        if not isinstance(dates, list) or not dates:
+            return None
+        durations = []
+        for duration in dates:
+            if not _is_date(duration.get(START)) or (duration.get(END) and not _is_date(duration[END])):
+                return None
+            durations.append({k: duration[k] for k in [START, END] if duration.get(k)})
+        return durations
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _is_date(value) -> bool:
+    return isinstance(value, str) and re.fullmatch(r'\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2})?)?', value) is not None
+
+
+def _normalise(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return _DASHES.sub('-', text)
+
+
+def _get_duration(kind: str, match: re.Match, text: str, today: date) -> Optional[dict]:
+    groups = match.groupdict()
+    if 'd' in groups:
+        month = _get_month(groups.get('m'), groups.get('mon'))
+        start = _get_date(groups['y'], month, groups['d'], today)
+        if start is None:
+            return None
+        hour, minute = groups.get('h'), groups.get('min')
+        if hour is None:
+            time_match = _TIME.match(text, match.end())
+            if time_match:
+                hour, minute = time_match.group('h'), time_match.group('min')
+        return {START: _format(start, hour, minute)}
+
+    start_month = _get_month(groups.get('m1'), groups.get('mon1'))
+    end_month = _get_month(groups.get('m2'), groups.get('mon2')) or start_month
+    start_month = start_month or end_month
+    end = _get_date(groups.get('y2') or groups.get('y1'), end_month, groups['d2'], today)
+    if end is None:
+        return None
+    start_year = groups.get('y1') or end.year
+    start = _get_date(start_year, start_month, groups['d1'], today)
+    if start is not None and start > end and not groups.get('y1'):
+        start = _get_date(end.year - 1, start_month, groups['d1'], today)
+    if start is None or start > end:
+        return None
+    if start == end:
+        return {START: _format(start)}
+    return {START: _format(start), END: _format(end)}
+
+
+def _get_month(number: str = None, name: str = None) -> Optional[int]:
+    if number:
+        return int(number)
+    if name:
+        return _MONTH_NUMBERS.get(name.rstrip('.'))
+    return None
+
+
+def _get_date(year, month: int, day: str, today: date) -> Optional[date]:
+    if month is None:
+        return None
+    try:
+        if year:
+            return date(int(year), month, int(day))
+        result = date(today.year, month, int(day))
+        if result < today - timedelta(days=183):
+            result = date(today.year + 1, month, int(day))
+        return result
+    except ValueError:
+        return None
+
+
+def _format(value: date, hour: str = None, minute: str = None) -> str:
+    if hour is None:
+        return value.isoformat()
+    return f'{value.isoformat()}T{int(hour):02d}:{minute}'
@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+
+import joblib
+import pandas as pd
+from json_repair import repair_json
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import classification_report
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+
+from src.data_acquisition.constants import logger, PLACE, EVENT, ADMINISTRATION, STATIC, TYPE, \
+    RECORD_TYPE_MODEL_PATH
+from src.data_acquisition.sources_store.constants import PARSED_SOURCES_CSV
+
+LABELS = [PLACE, EVENT, ADMINISTRATION, STATIC]
+TEXT = 'text'
+LABEL = 'label'
+
+
+class RecordTypeClassifier:
+    """Lightweight record type classifier, hashed TF-IDF features with a linear model trained on the parsed sources
+    labelled by earlier LLM runs. It classifies thousands of chunks per second on CPU."""
+
+    def __init__(self, model: Pipeline):
+        self.model = model
+
+    @classmethod
+    def load(cls, path: str = RECORD_TYPE_MODEL_PATH) -> 'RecordTypeClassifier':
+        return cls(joblib.load(path))
+
+    def save(self, path: str = RECORD_TYPE_MODEL_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        joblib.dump(self.model, path)
+
+    def classify(self, texts: list[str]) -> list[tuple[str, float]]:
+        """
+        Classifies the texts.
+        :param texts: Texts to be classified
+        :return: List of (label, probability) tuples in the order of the texts
+        """
+        if not texts:
+            return []
+        probabilities = self.model.predict_proba(texts)
+        classes = self.model.classes_
+        return [(str(classes[row.argmax()]), float(row.max())) for row in probabilities]
+
+
+def get_model() -> Pipeline:
+    return Pipeline([
+        ('hashing', HashingVectorizer(n_features=2 ** 18, ngram_range=(1, 2), strip_accents='unicode',
+                                      alternate_sign=False, norm=None)),
+        ('tfidf', TfidfTransformer(sublinear_tf=True)),
+        ('classifier', SGDClassifier(loss='log_loss', class_weight='balanced', alpha=1e-5, max_iter=50,
+                                     random_state=0)),
+    ])
+
+
+def train(data: pd.DataFrame) -> RecordTypeClassifier:
+    """Trains the classifier on the data with 'text' and 'label' columns."""
+    model = get_model()
+    model.fit(data[TEXT], data[LABEL])
+    return RecordTypeClassifier(model)
+
+
+def get_training_data(contents: list[str]) -> pd.DataFrame:
+    """Returns the texts and record types of the parsed contents, the contents that can not be read or have other
+    record type than place, event, administration or static are skipped."""
+    rows = []
+    for content in contents:
+        try:
+            obj = json.loads(content)
+        except (ValueError, TypeError):
+            try:
+                obj = json.loads(repair_json(content))
+            except Exception as e:
+                logger.error(f"Could not read parsed content: {e}")
+                continue
+        if not isinstance(obj, dict) or obj.get(TYPE) not in LABELS:
+            continue
+        text = '\n'.join(str(obj.get(key) or '') for key in ['header', 'brief', 'text'])
+        rows.append({TEXT: text, LABEL: obj[TYPE]})
+    return pd.DataFrame(rows, columns=[TEXT, LABEL])
+
+
+def get_parsed_contents(csv_path: str = None) -> list[str]:
+    """Returns the parsed contents from the csv file, or from the parsed_sources table if no file is given."""
+    if csv_path:
+        return pd.read_csv(csv_path)['content'].tolist()
+    from src.data_acquisition.sources_store.sources_db import SourcesDB
+    return SourcesDB().get_all_parsed_sources_contents()
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Train the record type classifier on the parsed sources")
+    parser.add_argument("-c", "--csv", nargs='?', const=PARSED_SOURCES_CSV,
+                        help="Train on the parsed sources csv file instead of the parsed_sources table")
+    parser.add_argument("-o", "--output", default=RECORD_TYPE_MODEL_PATH, help="Path of the saved model")
+    parser.add_argument("--test-size", type=float, default=0.2, help="Part of the data held out for evaluation")
+    return parser.parse_args()
+
+
+def main():
+    args = process_arguments()
+    data = get_training_data(get_parsed_contents(args.csv))
+    logger.info(f"Training data: {data[LABEL].value_counts().to_dict()}")
+    if args.test_size:
+        train_data, test_data = train_test_split(data, test_size=args.test_size, stratify=data[LABEL], random_state=0)
+        classifier = train(train_data)
+        predicted = [label for label, _ in classifier.classify(test_data[TEXT].tolist())]
+        print(classification_report(test_data[LABEL], predicted))
+    classifier = train(data)
+    classifier.save(args.output)
+    logger.info(f"Model saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
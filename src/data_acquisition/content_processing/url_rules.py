@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass, asdict
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import urlparse
+
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+from src.data_acquisition.constants import logger, PLACE, EVENT, ADMINISTRATION, STATIC, TYPE, URL, \
+    URL_RULES_PATH, URL_RULE_MIN_SUPPORT, URL_RULE_MIN_PRECISION
+from src.data_acquisition.sources_store.constants import PARSED_SOURCES_CSV, SOURCES_CSV
+
+LABELS = [PLACE, EVENT, ADMINISTRATION, STATIC]
+PREFIX = 'prefix'
+TOKEN = 'token'
+_TOKEN_SPLIT = re.compile(r'[^a-z0-9]+')
+
+
+@dataclass
+class UrlRule:
+    """Rule assigning the record type to the urls of the host whose path starts with the prefix segments (prefix
+    rule), or contains the token (token rule). The precision is the share of the labelled chunks matched by the rule
+    that have the record type, the support is the number of distinct urls matched."""
+    kind: str
+    host: str
+    pattern: str
+    record_type: str
+    precision: float
+    support: int
+
+
+class UrlRuleMatcher:
+    """Matcher of the mined url rules. The prefix rules are stored in a trie of the host and the path segments, where
+    the deepest matching prefix wins, the token rules in a map by host and token, where the most precise matching
+    token wins. The prefix rules are tried first."""
+
+    def __init__(self, rules: list[UrlRule]):
+        self.trie = {}
+        self.tokens = {}
+        for rule in rules:
+            if rule.kind == PREFIX:
+                node = self.trie.setdefault(rule.host, {})
+                for segment in _get_segments(rule.pattern):
+                    node = node.setdefault(segment, {})
+                node[None] = rule.record_type
+            else:
+                current = self.tokens.get((rule.host, rule.pattern))
+                if current is None or current.precision < rule.precision:
+                    self.tokens[(rule.host, rule.pattern)] = rule
+
+    def match(self, url: str) -> Optional[str]:
+        """Returns the record type of the url given by the rules, None if no rule matches."""
+        host, segments = _split_url(url)
+        node = self.trie.get(host)
+        record_type = None
+        if node is not None:
+            record_type = node.get(None)
+            for segment in segments:
+                node = node.get(segment)
+                if node is None:
+                    break
+                record_type = node.get(None, record_type)
+        if record_type is not None or not self.tokens:
+            return record_type
+        best = None
+        for token in _get_tokens(segments):
+            rule = self.tokens.get((host, token))
+            if rule is not None and (best is None or rule.precision > best.precision):
+                best = rule
+        return best.record_type if best else None
+
+
+def mine_url_rules(labelled_urls: list[tuple[str, str]], min_support: int = URL_RULE_MIN_SUPPORT,
+                   min_precision: float = URL_RULE_MIN_PRECISION) -> list[UrlRule]:
+    """
+    Mines the path prefix and token rules per host from the labelled urls.
+    :param labelled_urls: List of (url, record type) tuples, a url may appear more times (once per parsed chunk)
+    :param min_support: Minimal number of distinct labelled urls matched by a rule
+    :param min_precision: Minimal precision of a rule
+    :return: List of the rules
+    """
+    prefix_counts = defaultdict(Counter)
+    prefix_urls = defaultdict(set)
+    token_counts = defaultdict(Counter)
+    token_urls = defaultdict(set)
+    for url, record_type in labelled_urls:
+        host, segments = _split_url(url)
+        for i in range(len(segments) + 1):
+            prefix_counts[(host, '/'.join(segments[:i]))][record_type] += 1
+            prefix_urls[(host, '/'.join(segments[:i]))].add(url)
+        for token in _get_tokens(segments):
+            token_counts[(host, token)][record_type] += 1
+            token_urls[(host, token)].add(url)
+
+    prefix_rules = {}
+    for key, counts in prefix_counts.items():
+        rule = _get_rule(PREFIX, *key, counts, len(prefix_urls[key]), min_support, min_precision)
+        if rule is not None:
+            prefix_rules[key] = rule
+    rules = [rule for key, rule in sorted(prefix_rules.items()) if not _is_redundant(rule, prefix_rules)]
+    for key, counts in sorted(token_counts.items()):
+        rule = _get_rule(TOKEN, *key, counts, len(token_urls[key]), min_support, min_precision)
+        host_rule = prefix_rules.get((key[0], ''))
+        if rule is not None and (host_rule is None or host_rule.record_type != rule.record_type):
+            rules.append(rule)
+    return rules
+
+
+def _get_rule(kind: str, host: str, pattern: str, counts: Counter, support: int, min_support: int,
+              min_precision: float) -> Optional[UrlRule]:
+    record_type, count = counts.most_common(1)[0]
+    precision = count / sum(counts.values())
+    if support < min_support or precision < min_precision:
+        return None
+    return UrlRule(kind, host, pattern, record_type, round(precision, 3), support)
+
+
+def _is_redundant(rule: UrlRule, prefix_rules: dict[tuple[str, str], UrlRule]) -> bool:
+    """The prefix rule is redundant if its closest parent prefix with a rule assigns the same record type."""
+    segments = _get_segments(rule.pattern)
+    for i in range(len(segments) - 1, -1, -1):
+        parent = prefix_rules.get((rule.host, '/'.join(segments[:i])))
+        if parent is not None:
+            return parent.record_type == rule.record_type
+    return False
+
+
+def _split_url(url: str) -> tuple[str, list[str]]:
+    parsed = urlparse(url.lower())
+    host = parsed.netloc[4:] if parsed.netloc.startswith('www.') else parsed.netloc
+    return host, _get_segments(parsed.path)
+
+
+def _get_segments(path: str) -> list[str]:
+    return [segment for segment in path.split('/') if segment]
+
+
+def _get_tokens(segments: list[str]) -> set[str]:
+    return {token for segment in segments for token in _TOKEN_SPLIT.split(segment)
+            if len(token) > 2 and not token.isdigit()}
+
+
+def save_url_rules(rules: list[UrlRule], path: str = URL_RULES_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump([asdict(rule) for rule in rules], file, ensure_ascii=False, indent=1)
+
+
+def load_url_rules(path: str = URL_RULES_PATH) -> list[UrlRule]:
+    with open(path) as file:
+        return [UrlRule(**rule) for rule in json.load(file)]
+
+
+@lru_cache(maxsize=None)
+def get_url_rule_matcher(path: str = URL_RULES_PATH) -> UrlRuleMatcher:
+    """Returns the matcher of the rules saved on the path, loaded once per process. The matcher is empty if no rules
+    were mined yet."""
+    if not os.path.exists(path):
+        logger.info(f"No url rules found at {path}")
+        return UrlRuleMatcher([])
+    return UrlRuleMatcher(load_url_rules(path))
+
+
+def get_labelled_urls_from_csv(parsed_sources_csv: str = PARSED_SOURCES_CSV,
+                               sources_csv: str = SOURCES_CSV) -> list[tuple[str, str]]:
+    """Returns the (url, record type) tuples of the sources with a single record type and of the parsed sources, one
+    per parsed chunk."""
+    sources = pd.read_csv(sources_csv)
+    labelled = [(row[URL], row[TYPE]) for _, row in sources.iterrows() if row[TYPE] in LABELS]
+    for _, row in pd.read_csv(parsed_sources_csv).iterrows():
+        try:
+            record_type = json.loads(row['content']).get(TYPE)
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if record_type in LABELS:
+            labelled.append((row[URL], record_type))
+    return labelled
+
+
+def get_labelled_urls_from_db(sources_db) -> list[tuple[str, str]]:
+    """Returns the (url, record type) tuples of the sources with a single record type and of the parsed sources, one
+    per parsed chunk."""
+    labelled = []
+    for source in sources_db.get_all_sources_with_record_types():
+        if len(source[1]) == 1 and source[1][0] in LABELS:
+            labelled.append((source[0], source[1][0]))
+    for url, content in sources_db.get_all_parsed_sources_urls_and_contents():
+        try:
+            record_type = json.loads(content).get(TYPE)
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if record_type in LABELS:
+            labelled.append((url, record_type))
+    return labelled
+
+
+def get_report(labelled_urls: list[tuple[str, str]], matcher: UrlRuleMatcher) -> dict:
+    """Returns the hit rate and the precision of the preclassification by the handwritten substrings only and with the
+    mined rules. Every hit is a classification call saved."""
+    from src.data_acquisition.content_processing.content_classification import preclassify_by_url, \
+        preclassify_by_url_substrings
+    report = {'urls': len(labelled_urls)}
+    for name, preclassify in [('before', preclassify_by_url_substrings),
+                              ('after', lambda url: preclassify_by_url(url, matcher))]:
+        predicted = [(preclassify(url), record_type) for url, record_type in labelled_urls]
+        hits = [(p, r) for p, r in predicted if p is not None]
+        report[f'{name}_hits'] = len(hits)
+        report[f'{name}_hit_rate'] = round(len(hits) / len(predicted), 3) if predicted else 0
+        report[f'{name}_precision'] = round(sum(p == r for p, r in hits) / len(hits), 3) if hits else None
+    report['calls_saved'] = report['after_hits'] - report['before_hits']
+    return report
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Mine the url preclassification rules from the labelled sources")
+    parser.add_argument("-c", "--csv", action="store_true",
+                        help="Mine from the sources and parsed sources csv files instead of the database")
+    parser.add_argument("-o", "--output", default=URL_RULES_PATH, help="Path of the saved rules")
+    parser.add_argument("-s", "--min-support", type=int, default=URL_RULE_MIN_SUPPORT)
+    parser.add_argument("-p", "--min-precision", type=float, default=URL_RULE_MIN_PRECISION)
+    parser.add_argument("--test-size", type=float, default=0.3,
+                        help="Part of the urls held out for the report, 0 to report on the training urls")
+    return parser.parse_args()
+
+
+def main():
+    args = process_arguments()
+    if args.csv:
+        labelled_urls = get_labelled_urls_from_csv()
+    else:
+        from src.data_acquisition.sources_store.sources_db import SourcesDB
+        labelled_urls = get_labelled_urls_from_db(SourcesDB())
+    if args.test_size:
+        urls = sorted({url for url, _ in labelled_urls})
+        train_urls, _ = train_test_split(urls, test_size=args.test_size, random_state=0)
+        train_urls = set(train_urls)
+        rules = mine_url_rules([(u, t) for u, t in labelled_urls if u in train_urls], args.min_support,
+                               args.min_precision)
+        print(f"Held out: {get_report([(u, t) for u, t in labelled_urls if u not in train_urls], UrlRuleMatcher(rules))}")
+    rules = mine_url_rules(labelled_urls, args.min_support, args.min_precision)
+    print(f"All: {get_report(labelled_urls, UrlRuleMatcher(rules))}")
+    save_url_rules(rules, args.output)
+    logger.info(f"{len(rules)} rules saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
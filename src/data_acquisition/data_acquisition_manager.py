@@ -1,22 +1,29 @@
 import argparse
+import asyncio
 import json
 import logging
+from typing import Iterable, Union
+
 import arrow
 import pandas as pd
 from dotenv import load_dotenv
 
 from src.agents.api_agent import ApiAgent
-from src.agents_constants import LLAMA3_70_AGENT, GPT_3_AGENT
+from src.agents.async_api_agent import AsyncApiAgent
+from src.agents_constants import LLAMA3_70_AGENT, GPT_3_AGENT, ASYNC_GPT_3_AGENT
 from src.constants import DATE_FORMAT, TODAY
 from src.data_acquisition.constants import URL, DATE_PARSED, TYPE_IDS, CRAWL_ONLY, CONTENT_SUBSTRINGS, PDF, BASE_URL, \
-    PARENT, RECORD_TYPE_LABELS, INITIAL_ITERATIONS, EVENT
-from src.data_acquisition.content_processing.content_classification import get_content_type_preclassified_function_call
+    PARENT, RECORD_TYPE_LABELS, INITIAL_ITERATIONS, EVENT, TYPE, RECORD_TYPE_MODEL_PATH, BATCH_TOKEN_BUDGET
+from src.data_acquisition.content_processing.content_classification import get_content_type_preclassified_function_call, \
+    ZeroShotClassifier
+from src.data_acquisition.content_processing.record_type_classifier import RecordTypeClassifier
 from src.data_acquisition.content_processing.content_parsing import get_parsed_content_preclassified_function_call, \
-    BaseSchema
+    BaseSchema, get_parsed_contents_batched, estimate_tokens, get_parsed_contents_concurrently
 from src.data_acquisition.sources_store.sources_db import SourcesDB
 from src.data_acquisition.data_retrieval.web_crawler import WebCrawler
 from src.data_acquisition.data_retrieval.web_scraper import WebScraper
 from src.data_acquisition.data_retrieval.pdf_processor import PdfProcessor
+from src.data_acquisition.data_retrieval.pdf_cache import PdfCache
 from src.vector_store.vector_storage import VectorStorage, setup_vector_store
 
 logger = logging.getLogger(__name__)
@@ -35,9 +42,34 @@ class DataAcquisitionManager:
     - updating the sources database with the parsed data
     """
 
-    def __init__(self, sources_db: SourcesDB, agent: ApiAgent):
+    def __init__(self, sources_db: SourcesDB, agent: ApiAgent, pdf_cache: PdfCache = None,
+                 classifier_threshold: float = None,
+                 classifier: Union[ZeroShotClassifier, RecordTypeClassifier] = None,
+                 batch_token_budget: int = None, async_agent: AsyncApiAgent = None):
+        """
+        :param sources_db: Sources database
+        :param agent: Agent used for classification and parsing
+        :param pdf_cache: Cache of the processed pdfs, the default one is opened once a pdf is processed
+        :param classifier_threshold: If given, the local classifier is used to classify the pages whose type is not
+        known from the url before the agent, and its result is accepted if its score reaches the threshold
+        :param classifier: Local record type classifier, the zero-shot classifier by default
+        :param batch_token_budget: If given, the chunks of the same record type are parsed together in one request of
+        up to this many estimated tokens, otherwise every chunk is parsed in its own request
+        :param async_agent: If given (and no batch token budget), the chunks are parsed by this agent concurrently
+        """
         self.sources_db = sources_db
         self.agent = agent
+        self._pdf_cache = pdf_cache
+        self.classifier_threshold = classifier_threshold
+        self.classifier = classifier
+        self.batch_token_budget = batch_token_budget
+        self.async_agent = async_agent
+
+    @property
+    def pdf_cache(self) -> PdfCache:
+        if self._pdf_cache is None:
+            self._pdf_cache = PdfCache()
+        return self._pdf_cache
 
     def initial_data_acquisition(self, iterations: int):
         """
@@ -75,7 +107,6 @@ class DataAcquisitionManager:
             return
         self._process_urls(self.sources_db.get_urls_by_type(type_name))
         urls = self.sources_db.get_urls_by_type_and_date_parsed(type_name, TODAY)
-        self.sources_db.delete_outdated_parsed_sources(urls)
         if type_name == EVENT:
             vec_db.event_update_urls(urls, self.sources_db)
         else:
@@ -145,15 +176,107 @@ class DataAcquisitionManager:
 
     def _update_pdfs(self):
         urls = self.sources_db.get_all_pdf_urls()
-        docs = PdfProcessor(urls).get_chunks_batch()
-        for chunks, url in docs:
-            for chunk in chunks:
-                content = get_parsed_content_preclassified_function_call(self.agent, url, chunk)
-                if content:
-                    self.sources_db.add_parsed_source(url, self._get_json_str_from_content(content),
-                                                      content.record_type)
+        self._process_pdfs(self._get_pdf_processor(urls))
         self.sources_db.update_existing_urls_date(urls, TODAY)
 
+    def _process_pdfs(self, pdf_processor: PdfProcessor):
+        """
+        This method processes the downloaded pdfs. The pdfs with the same hash as when they were last processed are
+        skipped, from the others only the chunks that were not parsed before are passed to the parser.
+        :param pdf_processor: PdfProcessor with the downloaded pdfs
+        """
+        changed = [i for i, (url, pdf_hash) in enumerate(zip(pdf_processor.urls, pdf_processor.get_hashes()))
+                   if self.sources_db.get_encoded_content(url) != pdf_hash]
+        logger.info(f'Pdfs changed: {len(changed)} of {len(pdf_processor.urls)}')
+        for chunks, url, pdf_hash in pdf_processor.get_cached_chunks_batch(changed):
+            if self._process_pdf_chunks(url, chunks):
+                self.sources_db.update_encoded_content(url, pdf_hash)
+
+    def _process_pdf_chunks(self, url: str, chunks: Iterable[str]) -> bool:
+        """
+        This method stores the parsed chunks of the pdf. The parsed sources of chunks already stored for the url are
+        kept, the chunks parsed in a previous version of any pdf are taken from the cache and the rest is passed to
+        the parser. The parsed sources of chunks no longer in the pdf are deleted.
+        :param url: Url of the pdf
+        :param chunks: Chunks of the pdf, parsed as they arrive
+        :return: True if all the chunks were parsed
+        """
+        parsed_by_hash = self.sources_db.get_parsed_contents_by_chunk_hash(url)
+        chunk_hashes = []
+        pending = {}
+        complete = True
+        for chunk in chunks:
+            chunk_hash = WebScraper.get_chunk_hash(chunk)
+            chunk_hashes.append(chunk_hash)
+            if chunk_hash in parsed_by_hash or chunk_hash in pending:
+                continue
+            contents = self.pdf_cache.get_parsed(chunk_hash)
+            if contents is None:
+                pending[chunk_hash] = chunk
+                if self._is_batch_full(list(pending.values())):
+                    complete &= self._parse_pdf_chunks(url, pending, parsed_by_hash)
+                    pending = {}
+                continue
+            self._add_pdf_contents(url, chunk_hash, contents, parsed_by_hash)
+        complete &= self._parse_pdf_chunks(url, pending, parsed_by_hash)
+        self.sources_db.delete_parsed_sources_not_in_chunk_hashes(url, chunk_hashes)
+        return complete
+
+    def _parse_pdf_chunks(self, url: str, pending: dict[str, str], parsed_by_hash: dict) -> bool:
+        """
+        This method parses the pending chunks of the pdf, caches and stores the parsed contents.
+        :param url: Url of the pdf
+        :param pending: Chunks to be parsed by their hashes
+        :param parsed_by_hash: Parsed contents of the pdf by chunk hashes, updated with the new contents
+        :return: True if all the chunks were parsed
+        """
+        complete = True
+        for chunk_hash, content in zip(pending, self._parse_chunks(url, list(pending.values()))):
+            if not content:
+                complete = False
+                continue
+            contents = [content.asdict()]
+            self.pdf_cache.set_parsed(chunk_hash, contents)
+            self._add_pdf_contents(url, chunk_hash, contents, parsed_by_hash)
+        return complete
+
+    def _add_pdf_contents(self, url: str, chunk_hash: str, contents: list[dict], parsed_by_hash: dict):
+        for content in contents:
+            content = dict(content, url=url)
+            self.sources_db.add_parsed_source(url, json.dumps(content, ensure_ascii=False), content[TYPE],
+                                              chunk_hash)
+        parsed_by_hash[chunk_hash] = contents
+
+    def _parse_chunks(self, url: str, chunks: list[str]) -> list[BaseSchema]:
+        """
+        This method parses the chunks of the url, in batches if the batch token budget is set, concurrently if the
+        async agent is set.
+        :param url: Url that the chunks belong to
+        :param chunks: Chunks to be parsed
+        :return: Parsed contents in the order of the chunks, None for the chunks that could not be parsed
+        """
+        if not chunks:
+            return []
+        if self.batch_token_budget:
+            return get_parsed_contents_batched(self.agent, [(url, chunk) for chunk in chunks],
+                                               self.classifier_threshold, self.classifier, self.batch_token_budget)
+        if self.async_agent is not None:
+            return asyncio.run(get_parsed_contents_concurrently(self.async_agent, [(url, chunk) for chunk in chunks],
+                                                                self.classifier_threshold, self.classifier))
+        return [get_parsed_content_preclassified_function_call(self.agent, url, chunk, self.classifier_threshold,
+                                                               self.classifier) for chunk in chunks]
+
+    def _get_pdf_processor(self, urls: list[str]) -> PdfProcessor:
+        """ This method returns the pdf processor splitting the pdfs into chunks of the token size of the agent. """
+        return PdfProcessor(urls, cache=self.pdf_cache, max_size=self.agent.chunk_tokens,
+                            length_function=self.agent.token_counter)
+
+    def _is_batch_full(self, chunks: list[str]) -> bool:
+        """ This method tells if the pending chunks should be parsed before collecting more. """
+        if self.batch_token_budget:
+            return sum(map(estimate_tokens, chunks)) >= self.batch_token_budget
+        return self.async_agent is None or len(chunks) >= self.async_agent.max_concurrency
+
     def _scrape_and_update_sources(self, to_scrape: pd.DataFrame):
         """
         This method scrapes the contents of the given urls and updates the sources database with the scraped data.
@@ -186,20 +309,16 @@ class DataAcquisitionManager:
         """ This method handles the pdf urls. It adds the pdf url to the sources' database. Only pdfs from
         gotobrno are allowed."""
         if BASE_URL in url:
-            self.sources_db.add_or_update_source(url, TODAY, TODAY,
-                                                 None, parent_url, [int(self.sources_db.get_type_id(PDF))])
-            pdf_parser = PdfProcessor([url])
-            chunks, url = pdf_parser.get_chunks()
-            for chunk in chunks:
-                content = get_parsed_content_preclassified_function_call(self.agent, url, chunk)
-                if content:
-                    self.sources_db.add_parsed_source(url, self._get_json_str_from_content(content),
-                                                      content.record_type)
+            self.sources_db.add_or_update_source(url, TODAY, TODAY, None, parent_url,
+                                                 [int(self.sources_db.get_type_id(PDF))],
+                                                 self.sources_db.get_encoded_content(url))
+            self._process_pdfs(self._get_pdf_processor([url]))
 
     def _process_non_crawl_only(self, new_url: str, ws: WebScraper, date_added: str, parent_url: str):
         """
         This method processes the non crawl_only urls. It scrapes the contents of the web page and passes the scraped
-        data to the parser.
+        data to the parser. Only the chunks that are new or changed since the last parsing are sent to the parser, the
+        parsed sources of unchanged chunks are kept and the ones of removed chunks are deleted.
         :param new_url: Url that is being processed
         :param ws: WebScraper object
         :param date_added: Date when the url was added
@@ -207,16 +326,45 @@ class DataAcquisitionManager:
         """
         types = []
         date_parsed = None
-        for t in ws.get_chunks():
-            content = get_parsed_content_preclassified_function_call(self.agent, new_url, t)
+        parsed_by_hash = self.sources_db.get_parsed_contents_by_chunk_hash(new_url)
+        chunk_hashes = []
+        reused = 0
+        new_chunks = {}
+        for t in ws.get_chunks(self.agent.chunk_tokens, self.agent.token_counter):
+            chunk_hash = ws.get_chunk_hash(t)
+            chunk_hashes.append(chunk_hash)
+            if chunk_hash in parsed_by_hash:
+                reused += 1
+                date_parsed = TODAY
+                types.extend(self._get_type_ids_from_contents(parsed_by_hash[chunk_hash]))
+                continue
+            new_chunks.setdefault(chunk_hash, t)
+        for chunk_hash, content in zip(new_chunks, self._parse_chunks(new_url, list(new_chunks.values()))):
             if not content:
                 continue
             date_parsed = TODAY
             type_id = self.sources_db.get_type_id(content.record_type)
-            self.sources_db.add_parsed_source(new_url, self._get_json_str_from_content(content), content.record_type)
+            self.sources_db.add_parsed_source(new_url, self._get_json_str_from_content(content), content.record_type,
+                                              chunk_hash)
             types.append(type_id)
+        logger.info(f'Reused {reused} of {len(chunk_hashes)} parsed chunks: {new_url}')
+        self.sources_db.delete_parsed_sources_not_in_chunk_hashes(new_url, chunk_hashes)
         self.sources_db.insert_or_update_source(new_url, date_added, date_parsed, False,
-                                                parent_url, types, ws.get_encoded_content())
+                                                parent_url, list(dict.fromkeys(types)), ws.get_encoded_content())
+
+    def _get_type_ids_from_contents(self, contents: list[str]) -> list[int]:
+        """
+        This method returns the record type ids of already parsed contents.
+        :param contents: Parsed contents in JSON string format
+        :return: List of record type ids
+        """
+        type_ids = []
+        for content in contents:
+            try:
+                type_ids.append(self.sources_db.get_type_id(json.loads(content)[TYPE]))
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f'Could not get record type of parsed content: {e}')
+        return type_ids
 
     def _process_new_urls_from_url(self, url: str) -> pd.DataFrame:
         """
@@ -244,7 +392,10 @@ class DataAcquisitionManager:
                 date_added = new_urls.loc[new_urls[URL] == new_url, DATE_PARSED].values[0] or arrow.now().format(
                     DATE_FORMAT)
                 if ws.is_crawl_only():
-                    type_name = get_content_type_preclassified_function_call(self.agent, ws.url, ws.get_cleaned_html())
+                    type_name = get_content_type_preclassified_function_call(self.agent, ws.url,
+                                                                             ws.get_cleaned_html(),
+                                                                             self.classifier_threshold,
+                                                                             self.classifier)
                     if not type_name or type_name not in RECORD_TYPE_LABELS:
                         continue
                     self.sources_db.insert_or_update_source(new_url, date_added, None, True, parent_url,
@@ -276,20 +427,46 @@ def process_arguments():
         description="Provide the type of data to update, leave blank for initial data acquisition")
     parser.add_argument("-t", "--type", choices=RECORD_TYPE_LABELS,
                         help=f"Type is one of {RECORD_TYPE_LABELS}")
-    args = parser.parse_args()
-    return args.type
+    classifier = parser.add_mutually_exclusive_group()
+    classifier.add_argument("-z", "--zero-shot-threshold", type=float,
+                            help="Classify pages with the local zero-shot model first, accept results scoring at "
+                                 "least this")
+    classifier.add_argument("-r", "--record-type-threshold", type=float,
+                            help="Classify pages with the trained record type model first, accept results scoring at "
+                                 "least this")
+    parser.add_argument("-m", "--record-type-model", default=RECORD_TYPE_MODEL_PATH,
+                        help="Path of the trained record type model")
+    parser.add_argument("-b", "--batch-token-budget", type=int, nargs='?', const=BATCH_TOKEN_BUDGET,
+                        help="Parse the chunks of the same record type together, up to this many tokens per request")
+    parser.add_argument("-c", "--concurrent", action="store_true",
+                        help="Parse the chunks concurrently with the async agent, ignored with the batch token budget")
+    parser.add_argument("--no-cache", action="store_true", help="Send all the requests to the model, bypassing the "
+                                                                 "response cache")
+    return parser.parse_args()
 
 
 def main():
     load_dotenv()
     sources = SourcesDB()
-    processing_type = process_arguments()
-    dam = DataAcquisitionManager(sources, GPT_3_AGENT)
+    args = process_arguments()
+    processing_type = args.type
+    GPT_3_AGENT.use_cache = not args.no_cache
+    ASYNC_GPT_3_AGENT.use_cache = not args.no_cache
+    async_agent = ASYNC_GPT_3_AGENT if args.concurrent else None
+    if args.record_type_threshold is not None:
+        dam = DataAcquisitionManager(sources, GPT_3_AGENT, classifier_threshold=args.record_type_threshold,
+                                     classifier=RecordTypeClassifier.load(args.record_type_model),
+                                     batch_token_budget=args.batch_token_budget, async_agent=async_agent)
+    else:
+        dam = DataAcquisitionManager(sources, GPT_3_AGENT, classifier_threshold=args.zero_shot_threshold,
+                                     batch_token_budget=args.batch_token_budget, async_agent=async_agent)
     if processing_type:
         dam.update_by_type_name(processing_type, VectorStorage())
     else:
         dam.initial_data_acquisition(INITIAL_ITERATIONS)
         setup_vector_store()
+    if GPT_3_AGENT.use_cache:
+        logger.info(f"Response cache: {GPT_3_AGENT.response_cache.get_stats()}")
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import ast
+import os
 from configparser import ConfigParser
 
 from src.constants import CONSTANTS_CONFIG_PATH
@@ -24,3 +25,16 @@ _config = ConfigParser()
 _config.read(CONSTANTS_CONFIG_PATH)
 BANNED_SUBSTRINGS = ast.literal_eval(_config['CONTENT_RETRIEVAL']["BANNED_SUBSTRINGS"])
 PDF_FOLDER = _config['PDF_FOLDER']['PDF_FOLDER']
+PDF_DOWNLOAD_WORKERS = 4
+PDF_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+PDF_DOWNLOAD_TIMEOUT = 60
+PDF_CACHE_FOLDER = _config.get('PDF_PROCESSING', 'PDF_CACHE_FOLDER', fallback=PDF_FOLDER + '/cache')
+
+LLAMAPARSE_BACKEND = 'llamaparse'
+LOCAL_BACKEND = 'local'
+PDF_BACKEND = _config.get('PDF_PROCESSING', 'PDF_BACKEND', fallback=LLAMAPARSE_BACKEND)
+PDF_WORKERS = os.cpu_count() or 1
+HEADING_SIZE_RATIO = 1.15
+TITLE_SIZE_RATIO = 1.6
+MAX_HEADING_LENGTH = 120
+PAGES_PER_RANGE = 10
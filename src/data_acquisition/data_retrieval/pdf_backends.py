@@ -0,0 +1,203 @@
+import asyncio
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterator
+
+from dotenv import load_dotenv
+from llama_parse import LlamaParse
+from pypdf import PdfReader, PdfWriter
+
+from src.data_acquisition.data_retrieval.constants import LLAMAPARSE_BACKEND, LOCAL_BACKEND, PDF_WORKERS, \
+    HEADING_SIZE_RATIO, TITLE_SIZE_RATIO, MAX_HEADING_LENGTH, PAGES_PER_RANGE
+
+load_dotenv()
+
+_reader = None
+
+
+class PdfBackend(ABC):
+    """Base class for backends extracting markdown from pdf files."""
+
+    @abstractmethod
+    def get_md(self, path: str) -> str:
+        """Returns the markdown string of the pdf on the given path."""
+
+    def get_mds(self, paths: list[str]) -> list[str]:
+        """Returns the markdown strings of the pdfs on the given paths."""
+        return [self.get_md(path) for path in paths]
+
+    def iter_range_mds(self, path: str, pages_per_range: int = PAGES_PER_RANGE,
+                       clean: Callable[[str], str] = None) -> Iterator[str]:
+        """Yields the markdown of consecutive page ranges of the pdf in order. The ranges are written to separate
+        files and parsed (and cleaned) in parallel threads, each range is yielded as soon as it and all the ranges
+        before it are finished."""
+        page_ranges = get_page_ranges(len(PdfReader(path).pages), pages_per_range)
+        if len(page_ranges) == 1:
+            md = self.get_md(path)
+            yield clean(md) if clean else md
+            return
+        with tempfile.TemporaryDirectory() as directory, \
+                ThreadPoolExecutor(max_workers=min(PDF_WORKERS, len(page_ranges))) as executor:
+            range_paths = write_page_ranges(path, page_ranges, directory)
+            futures = [executor.submit(self._get_range_md, range_path, clean) for range_path in range_paths]
+            for future in futures:
+                yield future.result()
+
+    def _get_range_md(self, path: str, clean: Callable[[str], str] = None) -> str:
+        md = self.get_md(path)
+        return clean(md) if clean else md
+
+
+class LlamaParseBackend(PdfBackend):
+    """Backend parsing the pdfs with the LlamaParse cloud service."""
+
+    def get_md(self, path: str) -> str:
+        documents = LlamaParse(result_type="markdown").load_data(path)
+        return documents[0].text
+
+    def get_mds(self, paths: list[str]) -> list[str]:
+        documents = asyncio.run(LlamaParse(result_type="markdown").aload_data(paths))
+        return [doc.text for doc in documents]
+
+
+class LocalPdfBackend(PdfBackend):
+    """Backend extracting the text of the pdfs locally with pypdf. The pages are extracted in parallel in a process
+    pool, and lines set in a font noticeably larger than the body text are marked as markdown headers."""
+
+    def __init__(self, workers: int = PDF_WORKERS):
+        self.workers = workers
+
+    def get_md(self, path: str) -> str:
+        return lines_to_md(self.get_lines(path))
+
+    def get_lines(self, path: str, pages: range = None) -> list[list[tuple[str, float]]]:
+        """Returns the lines of the given pages (all by default) of the pdf as (text, font size) tuples, page by
+        page."""
+        if pages is None:
+            pages = range(len(PdfReader(path).pages))
+        if self.workers <= 1 or len(pages) <= 1:
+            _init_reader(path)
+            return [_extract_page_lines(page) for page in pages]
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_reader, initargs=(path,)) as executor:
+            return list(executor.map(_extract_page_lines, pages, chunksize=max(1, len(pages) // (self.workers * 4))))
+
+    def iter_range_mds(self, path: str, pages_per_range: int = PAGES_PER_RANGE,
+                       clean: Callable[[str], str] = None) -> Iterator[str]:
+        """Yields the markdown of consecutive page ranges of the pdf in order. The ranges are extracted (and cleaned)
+        in parallel worker processes, the header levels are set by the body font size of each range."""
+        page_ranges = get_page_ranges(len(PdfReader(path).pages), pages_per_range)
+        if self.workers <= 1 or len(page_ranges) == 1:
+            for page_range in page_ranges:
+                yield _extract_range_md(path, page_range, clean)
+            return
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(page_ranges))) as executor:
+            futures = [executor.submit(_extract_range_md, path, page_range, clean) for page_range in page_ranges]
+            for future in futures:
+                yield future.result()
+
+
+def get_pdf_backend(name: str) -> PdfBackend:
+    """Returns the pdf backend of the given name."""
+    if name == LLAMAPARSE_BACKEND:
+        return LlamaParseBackend()
+    if name == LOCAL_BACKEND:
+        return LocalPdfBackend()
+    raise ValueError(f"Unknown pdf backend: {name}")
+
+
+def get_page_ranges(page_count: int, pages_per_range: int) -> list[range]:
+    """Splits the pages into consecutive ranges of the given size."""
+    return [range(start, min(start + pages_per_range, page_count))
+            for start in range(0, page_count, pages_per_range)] or [range(0)]
+
+
+def write_page_ranges(path: str, page_ranges: list[range], directory: str) -> list[str]:
+    """Writes each page range of the pdf into a separate pdf file in the directory and returns the paths."""
+    reader = PdfReader(path)
+    range_paths = []
+    for page_range in page_ranges:
+        writer = PdfWriter()
+        for page in page_range:
+            writer.add_page(reader.pages[page])
+        range_path = os.path.join(directory, f'{page_range.start}.pdf')
+        writer.write(range_path)
+        range_paths.append(range_path)
+    return range_paths
+
+
+def lines_to_md(pages: list[list[tuple[str, float]]], body_size: float = None) -> str:
+    """Joins the extracted lines into a markdown string. Lines in a font larger than the body text are turned into
+    headers, '#' for titles and '##' for section headers."""
+    body_size = body_size or get_body_font_size(pages)
+    md_lines = []
+    for page in pages:
+        for text, size in page:
+            md_lines.append(_get_header_prefix(text, size, body_size) + text)
+        md_lines.append('')
+    return '\n'.join(md_lines)
+
+
+def get_body_font_size(pages: list[list[tuple[str, float]]]) -> float:
+    """Returns the font size used for most of the characters."""
+    sizes = Counter()
+    for page in pages:
+        for text, size in page:
+            sizes[round(size, 1)] += len(text)
+    return sizes.most_common(1)[0][0] if sizes else 0
+
+
+def _get_header_prefix(text: str, size: float, body_size: float) -> str:
+    if not body_size or len(text) > MAX_HEADING_LENGTH or not any(c.isalpha() for c in text):
+        return ''
+    if size >= body_size * TITLE_SIZE_RATIO:
+        return '# '
+    if size >= body_size * HEADING_SIZE_RATIO:
+        return '## '
+    return ''
+
+
+def _init_reader(path: str):
+    """Opens the pdf once per worker process."""
+    global _reader
+    _reader = PdfReader(path)
+
+
+def _extract_range_md(path: str, page_range: range, clean: Callable[[str], str] = None) -> str:
+    """Extracts the markdown of the page range, run in a worker process."""
+    _init_reader(path)
+    md = lines_to_md([_extract_page_lines(page) for page in page_range])
+    return clean(md) if clean else md
+
+
+def _extract_page_lines(page_number: int) -> list[tuple[str, float]]:
+    """Extracts the lines of the page with the largest font size used on each line."""
+    segments = []
+
+    def visitor(text, cm, tm, font_dict, font_size):
+        scale = abs(tm[3] or 1) * abs(cm[3] or 1)
+        segments.append((text, (font_size or 0) * scale))
+
+    _reader.pages[page_number].extract_text(visitor_text=visitor)
+    return _segments_to_lines(segments)
+
+
+def _segments_to_lines(segments: list[tuple[str, float]]) -> list[tuple[str, float]]:
+    lines = []
+    current_text, current_size = '', 0
+    for text, size in segments:
+        parts = text.split('\n')
+        for i, part in enumerate(parts):
+            if i > 0:
+                if current_text.strip():
+                    lines.append((' '.join(current_text.split()), current_size))
+                current_text, current_size = '', 0
+            current_text += part
+            if part.strip():
+                current_size = max(current_size, size)
+    if current_text.strip():
+        lines.append((' '.join(current_text.split()), current_size))
+    return lines
+
@@ -0,0 +1,40 @@
+from typing import Union
+
+from diskcache import Cache
+
+from src.data_acquisition.data_retrieval.constants import PDF_CACHE_FOLDER
+
+MD_PREFIX = 'md'
+CHUNKS_PREFIX = 'chunks'
+PARSED_PREFIX = 'parsed'
+
+
+class PdfCache:
+    """Disk cache of processed pdfs. The extracted markdown and the cleaned chunks are stored under the sha256 hash of
+    the pdf file, the parsed contents under the sha256 hash of the chunk they were parsed from, so chunks that did not
+    change between two versions of a pdf are not parsed again."""
+
+    def __init__(self, directory: str = PDF_CACHE_FOLDER):
+        self.cache = Cache(directory)
+
+    def get_md(self, pdf_hash: str) -> str:
+        return self.cache.get(f'{MD_PREFIX}:{pdf_hash}')
+
+    def set_md(self, pdf_hash: str, md: str):
+        self.cache.set(f'{MD_PREFIX}:{pdf_hash}', md)
+
+    def get_chunks(self, pdf_hash: str, max_size: Union[int, str]) -> list[str]:
+        return self.cache.get(f'{CHUNKS_PREFIX}:{pdf_hash}:{max_size}')
+
+    def set_chunks(self, pdf_hash: str, max_size: Union[int, str], chunks: list[str]):
+        self.cache.set(f'{CHUNKS_PREFIX}:{pdf_hash}:{max_size}', chunks)
+
+    def get_parsed(self, chunk_hash: str) -> list[dict]:
+        """Returns the parsed contents (BaseSchema dictionaries) of the chunk, None if the chunk was not parsed yet."""
+        return self.cache.get(f'{PARSED_PREFIX}:{chunk_hash}')
+
+    def set_parsed(self, chunk_hash: str, contents: list[dict]):
+        self.cache.set(f'{PARSED_PREFIX}:{chunk_hash}', contents)
+
+    def close(self):
+        self.cache.close()
@@ -1,135 +1,338 @@
-import asyncio
+import hashlib
+import json
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional
+
 import requests
-from llama_index_client import Document
 from src.constants import MAX_SIZE
-from llama_parse import LlamaParse
 from dotenv import load_dotenv
 
-from src.data_acquisition.constants import logger
-from src.data_acquisition.data_retrieval.constants import PDF_FOLDER
+from src.agents.token_counter import get_prefix_length
+from src.data_acquisition.constants import logger, CHARS_PER_TOKEN
+from src.data_acquisition.data_retrieval.constants import PDF_FOLDER, PDF_DOWNLOAD_WORKERS, PDF_DOWNLOAD_CHUNK_SIZE, \
+    PDF_DOWNLOAD_TIMEOUT, PDF_BACKEND, PAGES_PER_RANGE
+from src.data_acquisition.data_retrieval.pdf_backends import PdfBackend, get_pdf_backend
+from src.data_acquisition.data_retrieval.pdf_cache import PdfCache
 
 load_dotenv()
 
 
-def batch_scrape_pdfs(urls: list[str]):
-    """Downloads multiple pdfs from the given urls and saves them to the destination folder."""
-    return [scrape_pdf(url, PDF_FOLDER) for url in urls]
+def batch_scrape_pdfs(urls: list[str], destination_folder: str = PDF_FOLDER,
+                      max_workers: int = PDF_DOWNLOAD_WORKERS) -> list[tuple[str, str]]:
+    """Downloads multiple pdfs from the given urls concurrently and saves them to the destination folder. Returns the
+    urls of the downloaded pdfs with their destinations in the order of the urls, the pdfs that could not be
+    downloaded are skipped."""
+    os.makedirs(destination_folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        destinations = list(executor.map(lambda url: _try_scrape_pdf(url, destination_folder), urls))
+    return [(url, destination) for url, destination in zip(urls, destinations) if destination is not None]
+
+
+def _try_scrape_pdf(url: str, destination_folder: str = PDF_FOLDER) -> Optional[str]:
+    """Downloads the pdf, returns None if the download failed."""
+    try:
+        return scrape_pdf(url, destination_folder)
+    except (requests.RequestException, OSError) as e:
+        logger.error(f"Error downloading pdf {url}: {e}. Skipping.")
+        return None
 
 
 def scrape_pdf(url: str, destination_folder: str = PDF_FOLDER) -> str:
-    """Downloads the pdf from the given url and saves it to the destination folder"""
-    destination = destination_folder + '/' + url.split('/')[-1]
-    response = requests.get(url)
-    with open(destination, 'wb') as file:
-        file.write(response.content)
+    """Downloads the pdf from the given url and saves it to the destination folder. The pdf is streamed to disk in
+    chunks and named by the sha256 hash of its content. An interrupted download is resumed with an HTTP range request,
+    and a pdf that was not modified since the last download is not downloaded again. The range request is conditional on
+    the ETag, or the Last-Modified date, of the interrupted download, a download without either is started again."""
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    meta_path = os.path.join(destination_folder, url_hash + '.json')
+    part_path = os.path.join(destination_folder, url_hash + '.part')
+    meta = _load_download_meta(meta_path)
+    headers = {}
+    downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    # the server sends the whole pdf instead of the range if it changed since the validator
+    validator = meta.get('etag') or meta.get('last_modified')
+    if downloaded and not validator:
+        logger.info(f"Interrupted download of {url} can not be validated, downloading it again")
+        os.remove(part_path)
+        downloaded = 0
+    if downloaded:
+        headers['Range'] = f'bytes={downloaded}-'
+        headers['If-Range'] = validator
+    elif meta.get('destination') and os.path.exists(meta['destination']):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with requests.get(url, headers=headers, stream=True, timeout=PDF_DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304:
+            logger.info(f"Pdf not modified: {url}")
+            return meta['destination']
+        if response.status_code == 416:
+            os.remove(part_path)
+            return scrape_pdf(url, destination_folder)
+        response.raise_for_status()
+        meta.update({'url': url, 'etag': response.headers.get('ETag'),
+                     'last_modified': response.headers.get('Last-Modified')})
+        _save_download_meta(meta_path, meta)
+        hasher = hashlib.sha256()
+        if response.status_code == 206:
+            _update_hash_from_file(hasher, part_path)
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        with open(part_path, mode) as file:
+            for chunk in response.iter_content(chunk_size=PDF_DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                hasher.update(chunk)
+
+    destination = os.path.join(destination_folder, hasher.hexdigest() + '.pdf')
+    os.replace(part_path, destination)
+    meta['destination'] = destination
+    _save_download_meta(meta_path, meta)
     return destination
 
 
+def get_file_hash(path: str) -> str:
+    """Returns the sha256 hash of the content of the file."""
+    hasher = hashlib.sha256()
+    _update_hash_from_file(hasher, path)
+    return hasher.hexdigest()
+
+
+def _update_hash_from_file(hasher, path: str):
+    """Feeds the content of the already downloaded part of the file to the hasher."""
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(PDF_DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+
+def _load_download_meta(path: str) -> dict:
+    """Loads the metadata of the previous download of the pdf (ETag, Last-Modified and destination)."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _save_download_meta(path: str, meta: dict):
+    with open(path, 'w') as file:
+        json.dump(meta, file)
+
+
 class PdfProcessor:
     """Class for processing pdfs. It can download pdfs from the given urls, parse them, clean them, split them into
     chunks, and return the chunks as a list of strings."""
 
-    def __init__(self, urls: list[str]):
-        self.urls = urls
-        self.destinations = batch_scrape_pdfs(urls) if urls else []
+    def __init__(self, urls: list[str], backend: PdfBackend = None, cache: PdfCache = None, max_size: int = MAX_SIZE,
+                 length_function: Callable[[str], int] = len):
+        """
+        :param urls: Urls of the pdfs, the ones that cannot be downloaded are left out
+        :param backend: Backend parsing the pdfs into markdown
+        :param cache: Cache of the processed pdfs
+        :param max_size: Maximal size of a chunk in the units of the length function
+        :param length_function: Function measuring the size of a chunk, len (characters) or a TokenCounter of the agent
+        """
+        self.backend = backend or get_pdf_backend(PDF_BACKEND)
+        self.cache = cache
+        self.max_size = max_size
+        self.length_function = length_function
+        downloaded = batch_scrape_pdfs(urls) if urls else []
+        self.urls = [url for url, _ in downloaded]
+        self.destinations = [destination for _, destination in downloaded]
+        self.hashes = None
 
     def get_cleaned_md(self, text: str) -> str:
         """Removes empty lines, lines with only numbers, and duplicate lines from the markdown file. Also removes lines
         that contain only 'NO_CONTENT_HERE' string. Returns the cleaned markdown as a string."""
-        num_lines = 0
-        lines = text.split('\n')
-        lines_cnt = len(lines)
-        i = 0
+        return self._clean_md(text)
+
+    @staticmethod
+    def _clean_md(text: str) -> str:
+        return '\n'.join(PdfProcessor._get_cleaned_lines(text.split('\n')))
+
+    @staticmethod
+    def _get_cleaned_lines(lines: Iterable[str]) -> list[str]:
+        """Cleans the lines in a single pass. A line repeating the previous kept line removes both of them, so the
+        kept lines are held on a stack."""
+        cleaned = []
         curr_line = ''
-        while i < lines_cnt:
-            line = lines[i]
-            alphabet_character_count = sum(c.isalpha() for c in line)
-            if alphabet_character_count == 0 or lines[i] == 'NO_CONTENT_HERE':
-                del lines[i]
-                lines_cnt -= 1
+        for line in lines:
+            if line == 'NO_CONTENT_HERE' or not any(c.isalpha() for c in line):
                 continue
-            while lines[i].isdigit() and i < lines_cnt - 1:
-                num_lines += 1
-                i += 1
-            if 0 < num_lines <= 2:
-                num_lines = 0
-            if num_lines > 2:
-                del lines[i - num_lines:i]
-                lines_cnt -= num_lines
-                i -= num_lines
-                num_lines = 0
-            i, curr_line, lines, lines_cnt = self._remove_duplicate_line(curr_line, i, lines, lines_cnt)
-            i += 1
-
-        text = '\n'.join(lines)
-        return text
+            if line == curr_line:
+                if cleaned:
+                    cleaned.pop()
+                continue
+            curr_line = line
+            cleaned.append(line)
+        return cleaned
+
+    @classmethod
+    def _split_md_into_chunks(cls, text: str, max_size: int, length_function: Callable[[str], int] = len) -> list[str]:
+        """Splits the cleaned markdown into chunks by headers, max size of a given size."""
+        return list(cls._iter_md_chunks(text, max_size, length_function))
+
+    @classmethod
+    def _iter_md_chunks(cls, text: str, max_size: int, length_function: Callable[[str], int] = len) -> Iterator[str]:
+        """Yields the chunks of the cleaned markdown split by headers in a single pass. The text between two headers
+        forms a section, sections under a map header are skipped, and sections larger than max_size are split at the
+        last newline (or whitespace) before the limit. The consecutive sections are packed into chunks as close to
+        max_size as possible."""
+        if length_function(text) < max_size:
+            yield text
+            return
+        yield from cls._pack(cls._iter_section_chunks(text, max_size, length_function), max_size, length_function)
+
+    @classmethod
+    def _iter_md_chunks_from_parts(cls, parts: Iterable[str], max_size: int,
+                                   length_function: Callable[[str], int] = len) -> Iterator[str]:
+        """Yields the same chunks as _iter_md_chunks for the markdown arriving in consecutive parts. A section is
+        chunked once the next header has arrived, so the sections spanning two parts stay intact, and the chunks of
+        the first parts are yielded before the rest of the parts is available."""
+        yield from cls._pack(cls._iter_sections_from_parts(parts, max_size, length_function), max_size,
+                             length_function)
+
+    @classmethod
+    def _iter_sections_from_parts(cls, parts: Iterable[str], max_size: int,
+                                  length_function: Callable[[str], int]) -> Iterator[str]:
+        pending = None
+        small = True
+        for part in parts:
+            pending = part if pending is None else pending + '\n' + part
+            small = small and length_function(pending) < max_size
+            last_header = pending.rfind('##')
+            if small or last_header <= 0:
+                continue
+            yield from cls._iter_section_chunks(pending[:last_header + 2], max_size, length_function)
+            pending = pending[last_header:]
+        if small and pending is not None:
+            yield pending
+
+    @classmethod
+    def _iter_section_chunks(cls, text: str, max_size: int,
+                             length_function: Callable[[str], int] = len) -> Iterator[str]:
+        """Yields the chunks of the sections between two headers, the text before the first and after the last
+        header is left out."""
+        start = None
+        for match in re.finditer('(?=##)', text):
+            if start is not None:
+                chunk = text[start:match.start()]
+                if 'map' not in chunk.partition('\n')[0].lower():
+                    for piece in cls._split_by_size(chunk, max_size, length_function):
+                        if len(piece) > 100:
+                            yield piece
+            start = match.start()
 
     @staticmethod
-    def _remove_duplicate_line(curr_line: int, i: int, lines: list, lines_cnt: int) -> tuple[int, int, list, int]:
-        """Removes duplicate lines from the markdown."""
-        if curr_line == lines[i]:
-            del lines[i]
-            del lines[i - 1]
-            lines_cnt -= 2
-            i -= 2
-        else:
-            curr_line = lines[i]
-        return i, curr_line, lines, lines_cnt
+    def _split_by_size(chunk: str, max_size: int, length_function: Callable[[str], int] = len) -> Iterator[str]:
+        """Yields the pieces of the chunk, each at most max_size long. Only a window of the text after the previous piece
+        is measured, as a piece of max_size tokens spans a bounded number of characters, so the chunk is split in
+        linear time."""
+        window = max_size if length_function is len else max_size * CHARS_PER_TOKEN * 2
+        start = 0
+        while len(chunk) - start > window or length_function(chunk[start:]) > max_size:
+            limit = start + max(get_prefix_length(chunk[start:start + window], max_size, length_function), 1)
+            end = chunk.rfind('\n', start + 1, limit)
+            if end == -1:
+                end = chunk.rfind(' ', start + 1, limit)
+            if end == -1:
+                end = limit
+            yield chunk[start:end]
+            start = end
+        yield chunk[start:]
 
     @staticmethod
-    def _split_md_into_chunks(text, max_size) -> list[str]:
-        """Splits the cleaned markdown into chunks by headers, max size of a given size."""
-        if len(text) < max_size:
-            return [text]
-        header_index = [i for i in range(len(text)) if text.startswith('##', i)]
-        chunks = [text[header_index[i]:header_index[i + 1]] for i in range(len(header_index) - 1)]
-        for i in range(len(chunks)):
-            header = chunks[i].split('\n')[0]
-            if 'map' in header.lower():
-                chunks[i] = ''
-            if len(chunks[i]) > max_size:
-                while len(chunks[i]) > max_size:
-                    last_newline = chunks[i][:max_size].rfind('\n')
-                    if last_newline == -1:
-                        last_whitespace = chunks[i][:max_size].rfind(' ')
-                        last_newline = last_whitespace if last_whitespace != -1 else max_size
-                    chunks[i] = chunks[i][last_newline:]
-                    chunks.append(chunks[i][:last_newline])
-        return [chunk for chunk in chunks if len(chunk) > 100]
-
-    def _parse_pdf(self) -> Document:
-        """Parses the pdf using LlamaParse and returns the first document as a markdown string."""
-        documents = LlamaParse(result_type="markdown").load_data(self.destinations[0])
-        return documents[0]
-
-    async def _parse_pdfs(self) -> list[Document]:
-        """Parses the pdfs using LlamaParse and returns the documents as a list of markdown strings."""
-        parser = LlamaParse(result_type="markdown")
-        documents = await parser.aload_data(self.destinations)
-        return documents
+    def _pack(chunks: Iterable[str], max_size: int, length_function: Callable[[str], int] = len) -> Iterator[str]:
+        """Joins the consecutive chunks as long as the joined chunk fits into max_size."""
+        current = None
+        current_length = 0
+        for chunk in chunks:
+            length = length_function(chunk)
+            if current is not None and current_length + length + 1 <= max_size:
+                current += '\n' + chunk
+                current_length += length + 1
+                continue
+            if current is not None:
+                yield current
+            current, current_length = chunk, length
+        if current is not None:
+            yield current
 
     def get_md(self) -> str:
         """Returns the markdown string of the parsed pdf."""
-        return self._parse_pdf().text
+        return self.backend.get_md(self.destinations[0])
 
     def get_mds(self) -> list[str]:
         """Returns the markdown strings of the parsed pdfs."""
-        docs = asyncio.run(self._parse_pdfs())
-        return [doc.text for doc in docs]
+        return self.backend.get_mds(self.destinations)
 
     def get_chunks(self) -> tuple[list[str], str]:
-        """Returns the chunks of the parsed pdf. If the parsed pdf is larger than MAX_SIZE, it will be split into chunks
-        by headers. If the chunks are still larger than MAX_SIZE, they will be split into smaller chunks."""
-        return self._split_md_into_chunks(self.get_cleaned_md(self.get_md()), MAX_SIZE), self.urls[0]
+        """Returns the chunks of the parsed pdf. If the parsed pdf is larger than max_size, it will be split into chunks
+        by headers. If the chunks are still larger than max_size, they will be split into smaller chunks."""
+        return self._split_md_into_chunks(self.get_cleaned_md(self.get_md()), self.max_size,
+                                          self.length_function), self.urls[0]
 
     def get_chunks_batch(self) -> tuple[list[str], str]:
-        """Returns the chunks of the parsed pdfs. If the parsed pdf is larger than MAX_SIZE, it will be split into chunks
-        by headers. If the chunks are still larger than MAX_SIZE, they will be split into smaller chunks."""
+        """Returns the chunks of the parsed pdfs. If the parsed pdf is larger than max_size, it will be split into chunks
+        by headers. If the chunks are still larger than max_size, they will be split into smaller chunks."""
         mds = [self.get_cleaned_md(md) for md in self.get_mds()]
         for i in range(len(self.urls)):
             md = mds[i]
-            yield self._split_md_into_chunks(md, MAX_SIZE), self.urls[i]
+            yield self._split_md_into_chunks(md, self.max_size, self.length_function), self.urls[i]
+
+    def get_hashes(self) -> list[str]:
+        """Returns the sha256 hashes of the downloaded pdfs."""
+        if self.hashes is None:
+            self.hashes = [get_file_hash(destination) for destination in self.destinations]
+        return self.hashes
+
+    def iter_chunks(self, index: int = 0, pages_per_range: int = PAGES_PER_RANGE) -> Iterator[str]:
+        """Yields the chunks of the pdf on the given index. Large pdfs are split into page ranges that are parsed and
+        cleaned in parallel, the chunks of the first ranges are yielded before the rest of the pdf is finished."""
+        parts = self.backend.iter_range_mds(self.destinations[index], pages_per_range, self._clean_md)
+        yield from self._iter_md_chunks_from_parts(parts, self.max_size, self.length_function)
+
+    def get_cached_chunks_batch(self, indices: list[int] = None) -> Iterator[tuple[Iterable[str], str, str]]:
+        """Yields the chunks, url and hash of the pdfs on the given indices (all by default). The chunks are taken
+        from the cache if the same pdf was processed before, otherwise they are yielded as the page ranges of the pdf
+        are parsed and stored in the cache once the pdf is finished."""
+        indices = range(len(self.urls)) if indices is None else indices
+        self.cache = self.cache or PdfCache()
+        hashes = self.get_hashes()
+        for i in indices:
+            chunks = self.cache.get_chunks(hashes[i], self._get_size_key())
+            md = self.cache.get_md(hashes[i]) if chunks is None else None
+            if md is not None:
+                chunks = self._split_md_into_chunks(self.get_cleaned_md(md), self.max_size, self.length_function)
+                self.cache.set_chunks(hashes[i], self._get_size_key(), chunks)
+            yield chunks if chunks is not None else self._iter_caching_chunks(i), self.urls[i], hashes[i]
+
+    def _iter_caching_chunks(self, index: int) -> Iterator[str]:
+        """Yields the chunks of the pdf on the given index and stores the cleaned markdown and the chunks in the
+        cache when all of them were yielded."""
+        parts = []
+        chunks = []
+        range_mds = self.backend.iter_range_mds(self.destinations[index], PAGES_PER_RANGE, self._clean_md)
+        for chunk in self._iter_md_chunks_from_parts(self._collect(range_mds, parts), self.max_size,
+                                                     self.length_function):
+            chunks.append(chunk)
+            yield chunk
+        self.cache.set_md(self.get_hashes()[index], '\n'.join(parts))
+        self.cache.set_chunks(self.get_hashes()[index], self._get_size_key(), chunks)
+
+    def _get_size_key(self) -> str:
+        """Returns the key of the chunk size in the cache, the chunks of the same size in other units differ."""
+        if self.length_function is len:
+            return str(self.max_size)
+        return f'{self.max_size}:{self.length_function!r}'
+
+    @staticmethod
+    def _collect(items: Iterable, collected: list) -> Iterator:
+        for item in items:
+            collected.append(item)
+            yield item
 
     def process_pdfs_from_folder(self, folder_path: str) -> tuple[list[str], str]:
         """Downloads the pdfs from the given folder and processes them."""
@@ -144,5 +347,6 @@ class PdfProcessor:
         """Processes the pdf from the given path."""
         self.destinations = [path]
         self.urls = [path.split('/')[-1]]
+        self.hashes = None
         logger.info(f"Processing pdf: {path}")
         return self.get_chunks()
@@ -6,7 +6,9 @@ from bs4 import BeautifulSoup, Comment, Doctype, Tag, element
 from fake_useragent import UserAgent
 import requests
 import copy
+from typing import Callable
 
+from src.agents.token_counter import get_prefix_length
 from src.constants import MAX_SIZE
 from src.data_acquisition.constants import FORCED_TAGS
 from src.data_acquisition.data_retrieval.constants import EXCLUDE_TAGS_BASE, DECOMPOSE_PATTERNS_BASE, WIKI_SPECIFIC
@@ -56,20 +58,27 @@ class WebScraper:
         text = self.get_text_from_html(self.get_cleaned_html())
         return self._hash_text(text)
 
-    def get_chunks(self, max_size: int = MAX_SIZE) -> list[str]:
-        """Splits the text into chunks by headers of a given size maximum."""
+    @staticmethod
+    def get_chunk_hash(chunk: str) -> str:
+        """Returns the sha256 hash of the given chunk, used to recognise chunks that did not change between scrapes."""
+        return WebScraper._hash_text(chunk)
+
+    def get_chunks(self, max_size: int = MAX_SIZE, length_function: Callable[[str], int] = len) -> list[str]:
+        """Splits the text into chunks by headers of a given size maximum. The size is measured by the length function,
+        in characters by default, or in tokens when a TokenCounter of the agent is given."""
         soup = BeautifulSoup(self.get_cleaned_html(), 'html.parser')
         text = self._get_text(soup)
-        if len(text) > max_size:
-            return self._get_cleaned_html_text_sliced_by_headers(max_size)
+        if length_function(text) > max_size:
+            return self._get_cleaned_html_text_sliced_by_headers(max_size, length_function)
         return [text]
 
-    def get_chunks_from_html(self, html: str, max_size: int = MAX_SIZE) -> list[str]:
+    def get_chunks_from_html(self, html: str, max_size: int = MAX_SIZE,
+                             length_function: Callable[[str], int] = len) -> list[str]:
         """Splits the given html into chunks by headers of a given size maximum."""
         soup = BeautifulSoup(html, 'html.parser')
         text = self._get_text(soup)
-        if len(text) > max_size:
-            return self._get_cleaned_html_text_sliced_by_headers(max_size)
+        if length_function(text) > max_size:
+            return self._get_cleaned_html_text_sliced_by_headers(max_size, length_function)
         return [text]
 
     @staticmethod
@@ -406,54 +415,58 @@ class WebScraper:
         text = re.sub(r'\n(\))', r')', text)
         return re.sub(r'([)|,])\n', r'\1 ', text)
 
-    def _slice_html_by_size(self, html: str, max_size: int = MAX_SIZE) -> list[str]:
+    def _slice_html_by_size(self, html: str, max_size: int = MAX_SIZE,
+                            length_function: Callable[[str], int] = len) -> list[str]:
         """Slices the html into chunks of a given size maximum."""
         sliced_chunks = []
         current_chunk = ''
         current_length = 0
         soup = BeautifulSoup(html, 'html.parser')
-        soup = self._unwrap_lenghty_tags(max_size, soup)
+        soup = self._unwrap_lenghty_tags(max_size, soup, length_function)
         soup = self._wrap_naked_text(soup)
         for tag in soup.find_all(recursive=False):
             current_chunk, sliced_chunks, current_length = self._slice_tag(current_chunk, current_length, max_size,
-                                                                           sliced_chunks, tag)
+                                                                           sliced_chunks, tag, length_function)
         if current_chunk:
             sliced_chunks.append(current_chunk)
         return sliced_chunks
 
     def _slice_tag(self, current_chunk: str, current_length: int, max_size: int, sliced_chunks: list,
-                   tag: BeautifulSoup) -> tuple[str, list, int]:
+                   tag: BeautifulSoup, length_function: Callable[[str], int] = len) -> tuple[str, list, int]:
         """Slices the tag insides."""
-        if current_length + len(tag.get_text().strip()) > max_size:
+        tag_length = length_function(tag.get_text().strip())
+        if current_length + tag_length > max_size:
             if current_chunk:
                 sliced_chunks.append(current_chunk)
                 current_chunk = ''
                 current_length = 0
-        if len(tag.get_text().strip()) > max_size:
+        if tag_length > max_size:
             current_chunk, current_length = self._slice_inter(current_chunk, current_length, max_size, sliced_chunks,
-                                                              tag)
+                                                              tag, length_function)
         current_chunk += str(tag).strip()
-        current_length += len(tag.get_text(strip=True))
+        current_length += length_function(tag.get_text(strip=True))
         return current_chunk, sliced_chunks, current_length
 
     @staticmethod
     def _slice_inter(current_chunk: str, current_length: int, max_size: int, sliced_chunks: list,
-                     tag: BeautifulSoup) -> tuple[str, int]:
+                     tag: BeautifulSoup, length_function: Callable[[str], int] = len) -> tuple[str, int]:
         tag_text = tag.get_text().strip()
-        while len(tag_text) > max_size:
-            index = tag_text.rfind('\n', 0, max_size) or tag_text.rfind('.', 0, max_size)
+        while length_function(tag_text) > max_size:
+            limit = get_prefix_length(tag_text, max_size, length_function)
+            index = tag_text.rfind('\n', 0, limit) or tag_text.rfind('.', 0, limit)
             if index == -1:
                 break
             current_chunk = tag_text[:index + 1]
             sliced_chunks.append(current_chunk)
             current_chunk = tag_text[index + 1:]
-            current_length = len(current_chunk)
+            current_length = length_function(current_chunk)
         return current_chunk, current_length
 
     @staticmethod
-    def _unwrap_lenghty_tags(max_size: int, soup: BeautifulSoup) -> BeautifulSoup:
+    def _unwrap_lenghty_tags(max_size: int, soup: BeautifulSoup,
+                             length_function: Callable[[str], int] = len) -> BeautifulSoup:
         for tag in soup.find_all():
-            if len(tag.get_text()) > max_size:
+            if length_function(tag.get_text()) > max_size:
                 tag.unwrap()
         return soup
 
@@ -478,35 +491,44 @@ class WebScraper:
         return slices if slices else [html]
 
     @staticmethod
-    def _apply_slicing_in_loop(slicing_method, slices: list, name: str, max_size: int):
+    def _apply_slicing_in_loop(slicing_method, slices: list, name: str, max_size: int,
+                               length_function: Callable[[str], int] = len):
         new_slices = []
         to_remove = []
         for s in slices:
             soup = BeautifulSoup(s, 'html.parser')
-            if len(soup.get_text()) > max_size:
+            if length_function(soup.get_text()) > max_size:
                 to_remove.append(s)
                 if name:
                     new_slices.extend(slicing_method(s, name))
                 else:
-                    new_slices.extend(slicing_method(s, max_size))
+                    new_slices.extend(slicing_method(s, max_size, length_function))
         slices = [s for s in slices if s not in to_remove]
         slices.extend(new_slices)
         return slices
 
-    def _get_cleaned_html_text_sliced_by_headers(self, max_size: int) -> list[str]:
-        max_size = max_size - len(self.get_main_header()) - 1 if self.get_main_header() else max_size
+    def _get_cleaned_html_text_sliced_by_headers(self, max_size: int,
+                                                 length_function: Callable[[str], int] = len) -> list[str]:
+        """Slices the cleaned html by the h2 and h3 headers and by size, and packs the consecutive slices into chunks
+        as close to max_size as possible."""
+        main_header = self.get_main_header()
+        max_size = max_size - length_function(main_header) - 1 if main_header else max_size
         html = self.get_cleaned_html()
         slices = self._slice_by_name(html, 'h2')
-        slices = self._apply_slicing_in_loop(self._slice_by_name, slices, 'h3', max_size)
-        slices = self._apply_slicing_in_loop(self._slice_html_by_size, slices, '', max_size)
+        slices = self._apply_slicing_in_loop(self._slice_by_name, slices, 'h3', max_size, length_function)
+        slices = self._apply_slicing_in_loop(self._slice_html_by_size, slices, '', max_size, length_function)
         current_chunk = ''
+        current_length = 0
         result = []
         for s in slices:
             text = self._get_text(BeautifulSoup(s, 'html.parser'))
-            if len(current_chunk) + len(text) > max_size:
+            text_length = length_function('\n' + text)
+            if current_length + text_length > max_size:
                 result.append(current_chunk)
                 current_chunk = ''
+                current_length = 0
             current_chunk += '\n' + text
+            current_length += text_length
         if current_chunk:
             result.append(current_chunk)
 
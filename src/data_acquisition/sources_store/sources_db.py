@@ -4,11 +4,12 @@ import mysql
 import mysql.connector
 import pandas as pd
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Date, ForeignKey, Table, and_
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Date, ForeignKey, Table, and_, inspect, text, \
+    or_
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base, aliased
 from sqlalchemy.exc import IntegrityError
 from src.data_acquisition.constants import TYPE_IDS, TYPE, URL, DATE_ADDED, CRAWL_ONLY, PARENT, DATE_PARSED, STATIC, \
-    PDF, ENCODED_CONTENT
+    PDF, ENCODED_CONTENT, CHUNK_HASH
 from src.data_acquisition.sources_store.constants import RECORD_TYPES_CSV, SOURCES_CSV, BANNED_SOURCES_CSV, \
     CONTENT_TYPES_CSV, PARSED_SOURCES_CSV, HOST, DB_USER, PASSWORD, DATABASE
 
@@ -47,6 +48,7 @@ class ParsedSources(Base):
     content = Column(String(5000), nullable=False)
     content_type_id = Column(Integer, ForeignKey('content_types.id'), nullable=False)
     content_type = relationship("ContentTypes")
+    chunk_hash = Column(String(64), nullable=True, index=True)
 
 
 source_record_types = Table(
@@ -86,9 +88,17 @@ class SourcesDB:
     def __init__(self, host=HOST, user=DB_USER, password=PASSWORD, database=DATABASE):
         self.engine = create_engine(f"mysql+mysqlconnector://{user}:{password}@{host}/{database}")
         Base.metadata.create_all(self.engine)
+        self._add_missing_parsed_sources_columns()
         session = sessionmaker(bind=self.engine)
         self.session = session()
 
+    def _add_missing_parsed_sources_columns(self):
+        """Adds the chunk_hash column to parsed_sources tables created before chunk hashes were stored."""
+        columns = [column['name'] for column in inspect(self.engine).get_columns(ParsedSources.__tablename__)]
+        if CHUNK_HASH not in columns:
+            with self.engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {ParsedSources.__tablename__} ADD COLUMN {CHUNK_HASH} VARCHAR(64)"))
+
     def add_or_update_source(self, url: str, date_added: str, date_parsed: str, crawl_only: bool, parent: str,
                              type_ids: list, encoded_content: str = None):
         """
@@ -313,13 +323,42 @@ class SourcesDB:
         self.session.add_all(source_objects)
         self.session.commit()
 
-    def add_parsed_source(self, url: str, content: str, type_name: str):
-        """Adds a parsed source to the database."""
+    def add_parsed_source(self, url: str, content: str, type_name: str, chunk_hash: str = None):
+        """Adds a parsed source to the database, optionally with the hash of the chunk it was parsed from."""
         source = ParsedSources(url=url, content=content,
-                               content_type_id=self.get_content_type_id_from_record_type_name(type_name))
+                               content_type_id=self.get_content_type_id_from_record_type_name(type_name),
+                               chunk_hash=chunk_hash)
         self.session.add(source)
         self.session.commit()
 
+    def get_parsed_contents_by_chunk_hash(self, url: str) -> dict[str, list[str]]:
+        """Returns the parsed contents of the given url grouped by the hash of the chunk they were parsed from.
+        Rows without a chunk hash are omitted."""
+        query = self.session.query(ParsedSources.chunk_hash, ParsedSources.content).filter(
+            and_(
+                ParsedSources.url == url,
+                ParsedSources.chunk_hash.isnot(None)
+            )
+        )
+        contents = {}
+        for chunk_hash, content in query:
+            contents.setdefault(chunk_hash, []).append(content)
+        return contents
+
+    def delete_parsed_sources_not_in_chunk_hashes(self, url: str, chunk_hashes: list[str]):
+        """Deletes the parsed sources of the given url whose chunk is no longer present on the page, including the
+        rows stored without a chunk hash."""
+        self.session.query(ParsedSources).filter(
+            and_(
+                ParsedSources.url == url,
+                or_(
+                    ParsedSources.chunk_hash.is_(None),
+                    ParsedSources.chunk_hash.notin_(chunk_hashes)
+                )
+            )
+        ).delete(synchronize_session=False)
+        self.session.commit()
+
     def get_all_pdf_urls(self) -> list:
         """Returns all pdf urls."""
         record_types_alias = aliased(RecordTypes)
@@ -334,6 +373,15 @@ class SourcesDB:
         parsed_sources = self.session.query(ParsedSources.content).all()
         return [content for content, in parsed_sources]
 
+    def get_all_parsed_sources_urls_and_contents(self) -> list[tuple[str, str]]:
+        """Returns the urls and contents of all parsed sources."""
+        return [(url, content) for url, content in self.session.query(ParsedSources.url, ParsedSources.content).all()]
+
+    def get_all_sources_with_record_types(self) -> list[tuple[str, list[str]]]:
+        """Returns the urls of all not banned sources with the names of their record types."""
+        sources = self.session.query(Sources).filter(Sources.banned.is_(False)).all()
+        return [(source.url, [record_type.record_type for record_type in source.record_types]) for source in sources]
+
     def get_all_parsed_sources_contents_by_type(self, type_name: str) -> list[str]:
         """Returns all parsed sources contents of given type."""
         parsed_sources = self.session.query(ParsedSources.content).filter(
@@ -378,6 +426,12 @@ class SourcesDB:
             return None
         return source.encoded_content
 
+    def update_encoded_content(self, url: str, encoded_content: str):
+        """Updates the encoded content of the source of the given url."""
+        self.session.query(Sources).filter(Sources.url == url).update({Sources.encoded_content: encoded_content},
+                                                                      synchronize_session=False)
+        self.session.commit()
+
     def get_urls_by_type_and_date_parsed(self, type_name: str, date_parsed: str) -> list[str]:
         """Returns the urls of sources of the given type and date parsed."""
         record_types_alias = aliased(RecordTypes)
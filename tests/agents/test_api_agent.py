@@ -0,0 +1,49 @@
+import json
+from types import SimpleNamespace
+
+from src.agents.constants import MESSAGE_TOKENS
+from src.agents.message import SystemMessage, UserMessage, AssistantMessage
+from src.agents.openai_api_agent import OpenAIApiAgent
+
+CONTEXT_TOKENS = 300
+
+
+def get_weather(city: str) -> str:
+    """Returns the weather in the city
+    :param city: Name of the city"""
+    return f"Sunny in {city}"
+
+
+def get_response(tool_call: bool):
+    calls = [SimpleNamespace(id='1', type='function',
+                             function=SimpleNamespace(name='get_weather', arguments=json.dumps({'city': 'Brno'})))]
+    message = SimpleNamespace(tool_calls=calls if tool_call else None, content=None if tool_call else 'Sunny')
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def count_request_tokens(agent: OpenAIApiAgent, request: dict) -> int:
+    messages = sum(agent.token_counter(m['content'] or '') + MESSAGE_TOKENS for m in request['messages'])
+    return messages + agent.token_counter(json.dumps(request['tools'], ensure_ascii=False))
+
+
+def test_function_call_requests_fit_context():
+    agent = OpenAIApiAgent('http://localhost:1/v1', 'key', 'model', use_cache=False, context_tokens=CONTEXT_TOKENS)
+    requests = []
+
+    def create(**request):
+        requests.append(request)
+        # the first response has no function call, so the call is retried with a correction message
+        return get_response(tool_call=len(requests) > 1)
+
+    agent.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    history = [message for i in range(20) for message in (UserMessage(f"Question {i} " + "word " * 20),
+                                                            AssistantMessage(f"Answer {i} " + "word " * 20))]
+    messages = [SystemMessage("You are a weather assistant.")] + history + [UserMessage("What is the weather?")]
+
+    assert agent.get_function_call({'get_weather': get_weather}, [get_weather], messages=messages) == "Sunny in Brno"
+    assert len(requests) == 2
+    for request in requests:
+        assert count_request_tokens(agent, request) <= CONTEXT_TOKENS
+        assert request['messages'][0]['content'] == "You are a weather assistant."
+        assert "What is the weather?" in [m['content'] for m in request['messages']]
+    assert requests[1]['messages'][-1]['content'].endswith("Retry.")
@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src.agents.async_local_api_agent import AsyncLocalApiAgent
+from src.agents.local_api_agent import LocalApiAgent
+from src.agents.response_cache import ResponseCache
+
+
+def get_events():
+    """Returns the events"""
+    return 'events'
+
+
+def get_places():
+    """Returns the places"""
+    return 'places'
+
+
+MODULE = {'get_events': get_events, 'get_places': get_places}
+
+
+def get_responses(*names):
+    """Returns a fake create function of the patched client answering the chosen functions in the order."""
+    names = list(names)
+
+    def create(response_model, **request):
+        return response_model(function_name=names.pop(0))
+
+    return create
+
+
+@pytest.fixture
+def cache(tmp_path):
+    response_cache = ResponseCache(str(tmp_path))
+    yield response_cache
+    response_cache.close()
+
+
+def test_only_successful_attempt_is_cached(cache):
+    agent = LocalApiAgent('http://localhost:1/v1', 'key', 'model', one_step_call=False, cache=cache)
+    agent.instructor_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+        create=get_responses('get_missing', 'get_places'))))
+
+    assert agent.get_function_call(MODULE, [get_events, get_places], messages=[]) == 'places'
+    cached = [cache.cache[key] for key in cache.cache.iterkeys()]
+    assert cached == [{'function_name': 'get_places'}]
+
+
+def test_only_successful_attempt_is_cached_async(cache):
+    agent = AsyncLocalApiAgent('http://localhost:1/v1', 'key', 'model', one_step_call=False, cache=cache)
+    create = get_responses('get_missing', 'get_places')
+
+    async def acreate(**request):
+        return create(**request)
+
+    agent.instructor_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=acreate)))
+
+    assert asyncio.run(agent.get_function_call(MODULE, [get_events, get_places], messages=[])) == 'places'
+    cached = [cache.cache[key] for key in cache.cache.iterkeys()]
+    assert cached == [{'function_name': 'get_places'}]
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from aiohttp import web
+from pydantic import BaseModel
+
+from evaluation.agents.mock_llm_server import MockLLMServer
+from src.agents.async_openai_api_agent import AsyncOpenAIApiAgent
+from src.agents.retry_policy import RetryPolicy
+
+
+class ContentType(BaseModel):
+    """Type of the content"""
+    type: str
+
+
+class FailingOnceServer(MockLLMServer):
+    """Mock server answering the first request by an error, the rest by the responses."""
+
+    def _get_error_response(self, status: int) -> web.Response:
+        self.error_rate = 0.0
+        return super()._get_error_response(status)
+
+
+async def run_with_server(server: MockLLMServer, run):
+    """Runs the coroutine function with the url of the server started on an ephemeral port."""
+    runner = web.AppRunner(server.get_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        return await run(f"http://127.0.0.1:{port}/v1")
+    finally:
+        await runner.cleanup()
+
+
+def test_requests_in_flight_are_limited():
+    server = MockLLMServer(latency_median=0.05)
+
+    async def run(url: str):
+        agent = AsyncOpenAIApiAgent(url, 'key', 'mock', max_concurrency=2, use_cache=False)
+        return await asyncio.gather(*[agent.get_base_response([{'role': 'user', 'content': f"Question {i}"}])
+                                      for i in range(8)])
+
+    responses = asyncio.run(run_with_server(server, run))
+    assert all(r.choices[0].message.content.startswith("Mock response") for r in responses)
+    assert server.stats['requests'] == 8
+    assert server.stats['peak_in_flight'] == 2
+
+
+def test_rate_limited_request_is_retried_after_retry_after():
+    server = FailingOnceServer([{'match': '', 'function': 'ContentType', 'arguments': {'type': 'event'}}],
+                               error_rate=1.0, error_statuses=[429])
+
+    async def run(url: str):
+        agent = AsyncOpenAIApiAgent(url, 'key', 'mock', use_cache=False, retry_policy=RetryPolicy(max_attempts=3))
+        start = time.monotonic()
+        response = await agent.get_json_format_response(ContentType, [])
+        return response, time.monotonic() - start
+
+    response, elapsed = asyncio.run(run_with_server(server, run))
+    assert response == {'type': 'event'}
+    assert server.stats['requests'] == 2
+    assert server.stats['errors'] == 1
+    # the mock asks for a retry after one second
+    assert elapsed >= 1.0